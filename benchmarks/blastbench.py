@@ -0,0 +1,392 @@
+# =============================================================================
+# Blast - Benchmark
+# Measures the blast orchestration offline.  run.py main() and
+# RunNukeBlast.run are driven over a synthetic project with the stand-in
+# modules from fakes.py, and the time spent in every stage is reported along
+# with the number of Shotgun, trax and script calls.
+#
+# Usage: python benchmarks/blastbench.py --shots 4 --formats 3 --frames 48
+#        python benchmarks/blastbench.py --blast-args="--multiformat --reopen"
+# =============================================================================
+import argparse
+import functools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakes
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+# Functions of run.py timed as stages, in report order.
+RUN_STAGES = [
+	"openComp",
+	"setFramerate",
+	"prepareGraph",
+	"prepareOutput",
+	"getBlastBackupNukePath",
+	"renderJobs",
+	"encodeJob",
+]
+
+# Methods of nukeblast.RunNukeBlast timed as stages.
+ACTION_STAGES = [
+	"getBlastArgs",
+	"fetchCachedBlast",
+	"runProcess",
+]
+
+# Measures importing a module, and creating the action for nukeblast, in a
+# fresh interpreter with the fakes installed.
+STARTUP_SCRIPT = """
+import json, os, sys, time
+sys.path.insert(0, {benchDir!r})
+import fakes
+fakes.latencies["import"] = {importLatency!r}
+fakes.install()
+sys.path.insert(0, {repoDir!r})
+start = time.time()
+module = __import__({module!r})
+imported = time.time()
+if {module!r} == "nukeblast":
+	module.RunNukeBlast()
+print json.dumps({{
+	"import" : imported - start,
+	"create" : time.time() - imported,
+	"modules" : sorted(name for name in sys.modules if name in fakes.importer.modules and "." not in name),
+}})
+"""
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+class StageTimer(object):
+	""" Wraps functions so every call adds to the time of its stage. """
+	def __init__(self):
+		self.stages = {}
+		self.order = []
+
+	def wrap(self, owner, name, stage=None):
+		stage = stage or name
+		if stage not in self.order:
+			self.order.append(stage)
+		func = getattr(owner, name)
+		isStatic = isinstance(owner.__dict__.get(name), staticmethod)
+		@functools.wraps(func)
+		def timed(*args, **kwargs):
+			start = time.time()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				self.add(stage, time.time() - start)
+		setattr(owner, name, staticmethod(timed) if isStatic else timed)
+
+	def add(self, stage, seconds):
+		count, total = self.stages.get(stage, (0, 0.0))
+		self.stages[stage] = (count + 1, total + seconds)
+
+	def reset(self):
+		self.stages.clear()
+
+	def report(self):
+		return [
+			{
+				"stage" : stage,
+				"calls" : self.stages[stage][0],
+				"seconds" : round(self.stages[stage][1], 4),
+			}
+			for stage in self.order if stage in self.stages
+		]
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def parseArgs(args=None):
+	parser = argparse.ArgumentParser(description="Benchmark the blast orchestration offline.")
+	parser.add_argument('--shots', type=int, default=3, help='Number of shots to blast')
+	parser.add_argument('--formats', type=int, default=3, help='Number of formats per blast')
+	parser.add_argument('--frames', type=int, default=24, help='Frames per shot')
+	parser.add_argument('--repeat', type=int, default=1, help='Times to blast every shot')
+	parser.add_argument('--sg-latency', dest='sgLatency', type=float, default=0.05, help='Seconds per Shotgun call')
+	parser.add_argument('--trax-latency', dest='traxLatency', type=float, default=0.02, help='Seconds per trax call')
+	parser.add_argument('--open-latency', dest='openLatency', type=float, default=0.2, help='Seconds per script open')
+	parser.add_argument('--save-latency', dest='saveLatency', type=float, default=0.05, help='Seconds per script save')
+	parser.add_argument('--frame-latency', dest='frameLatency', type=float, default=0.002, help='Seconds per rendered frame')
+	parser.add_argument('--encode-latency', dest='encodeLatency', type=float, default=0.1, help='Seconds per ffmpeg encode')
+	parser.add_argument('--import-latency', dest='importLatency', type=float, default=0.2, help='Seconds to import each Blur package')
+	parser.add_argument('--intermediate', type=str, default='png', help='Intermediate the movie formats render to: png, tiff or dpx')
+	parser.add_argument('--stage', action='store_true', help='Stage the intermediates in local scratch')
+	parser.add_argument('--blast-args', dest='blastArgs', type=str, default="", metavar='"ARGS"', help='Extra run.py arguments, given after an equals sign: --blast-args="--multiformat --reopen"')
+	parser.add_argument('--scenario', choices=['all', 'run', 'action', 'startup'], default='all', help='Which entry point to drive')
+	parser.add_argument('--json', type=str, help='Write the report to this file')
+	parser.add_argument('--keep', action='store_true', help='Keep the synthetic project for inspection')
+	return parser.parse_args(args)
+
+def writeJson(path, data):
+	with open(path, "w") as fileinfo:
+		fileinfo.write(json.dumps(data, indent=4, sort_keys=True))
+
+def createProject(root, options):
+	""" Write a synthetic project: prefs, comp and input plates.
+
+	Returns:
+		dict - The paths and names the scenarios blast with.
+
+	"""
+	prefsDir = os.path.join(root, "prefs")
+	nukeDir = os.path.join(root, "nuke")
+	os.makedirs(prefsDir)
+	os.makedirs(nukeDir)
+	formats = {}
+	for index in range(options.formats):
+		# Alternate encoded movies and jpg review frames
+		if index % 2 == 0:
+			formats["MOV{0}".format(index)] = {
+				"nodes" : ["Read1", "WriteMov{0}".format(index)],
+				"ext" : ".png",
+				"runffmpeg" : True,
+				# H.264 and ProRes from a single read of the frames
+				"encodes" : ["avc1", "apcs"],
+				"intermediate" : options.intermediate,
+				"stage_intermediate" : options.stage,
+				"relative_path" : "mov{0}".format(index),
+			}
+		else:
+			formats["JPG{0}".format(index)] = {
+				"nodes" : ["Read1", "WriteJpg{0}".format(index)],
+				"ext" : ".jpg",
+				"relative_path" : "jpg{0}".format(index),
+				"slate_node" : "Slate",
+				"slate_switch" : "SlateSwitch",
+			}
+	writeJson(os.path.join(prefsDir, "formats.json"), formats)
+	writeJson(os.path.join(prefsDir, "nukefiles.json"), {
+		"comp" : {"location" : "comp.nk"},
+		"plate" : {"location" : "comp.nk"},
+	})
+	writeJson(os.path.join(prefsDir, "presets.json"), {})
+	comp = os.path.join(nukeDir, "comp.nk")
+	fakes.writeFile(comp)
+	shots = []
+	for index in range(options.shots):
+		code = "BENCH_{0}".format(str((index + 1) * 10).zfill(4))
+		inputPattern = os.path.join(root, "plates", code, code + ".####.exr")
+		for frame in range(1001, 1001 + options.frames):
+			fakes.writeFile(inputPattern.replace("####", str(frame)))
+		shots.append({
+			"code" : code,
+			"input" : inputPattern.replace("\\", "/"),
+			"output" : os.path.join(root, "output", code).replace("\\", "/"),
+		})
+	fakes.fileTypePaths.update({
+		"Blast::Prefs" : prefsDir,
+		"Blast::Nuke" : nukeDir,
+		"BlastBackup" : os.path.join(root, "backup"),
+	})
+	return {
+		"comp" : comp,
+		"formatsfile" : os.path.join(prefsDir, "formats.json"),
+		"formats" : sorted(formats.keys()),
+		"shots" : shots,
+		"framein" : 1001,
+		"frameout" : 1000 + options.frames,
+	}
+
+def getRunArgs(project, shot, options):
+	args = [
+		project["comp"],
+		"--file", shot["input"],
+		"--filename", os.path.basename(shot["input"]),
+		"--output", shot["output"],
+		"--framein", str(project["framein"]),
+		"--frameout", str(project["frameout"]),
+		"--formatsfile", project["formatsfile"],
+		"--artist", "Bench Artist",
+		"--shot", shot["code"],
+		"--project", "Bench",
+		"--formats",
+	]
+	args.extend(project["formats"])
+	args.append("--runffmpeg")
+	args.extend(options.blastArgs.split())
+	return args
+
+def runScenario(name, timer, func):
+	""" Run a scenario and collect its timings and call counts. """
+	fakes.reset()
+	timer.reset()
+	start = time.time()
+	failures = func()
+	fakes.countFFmpeg()
+	return {
+		"scenario" : name,
+		"seconds" : round(time.time() - start, 4),
+		"failures" : failures,
+		"stages" : timer.report(),
+		"calls" : {
+			"shotgun" : fakes.countCalls("shotgun."),
+			"trax" : fakes.countCalls("trax."),
+			"scriptOpen" : fakes.countCalls("nuke.open."),
+			"scriptSave" : fakes.countCalls("nuke.save."),
+			"framesRendered" : fakes.countCalls("nuke.frame."),
+			"encodes" : fakes.countCalls("ffmpeg.encode"),
+			"movies" : fakes.countCalls("ffmpeg.output"),
+		},
+		"detail" : dict(fakes.calls),
+	}
+
+def benchRun(run, project, options):
+	""" Blast every shot through run.py main(), one script per shot. """
+	failures = 0
+	for repeat in range(options.repeat):
+		for shot in project["shots"]:
+			sys.argv = ["run.py"] + getRunArgs(project, shot, options)
+			try:
+				run.main()
+			except SystemExit as e:
+				if e.code:
+					failures += 1
+	return failures
+
+def benchAction(run, nukeblast, project, options):
+	""" Blast every shot through RunNukeBlast.run. """
+	failures = 0
+	for repeat in range(options.repeat):
+		for shot in project["shots"]:
+			action = nukeblast.RunNukeBlast(
+				project=fakes.Project("Bench"),
+				shot=fakes.Shot(shot["code"]),
+				inputFilepath=shot["input"],
+				output=shot["output"],
+				formats=" ".join(project["formats"]),
+				framein=project["framein"],
+				frameout=project["frameout"],
+				artistName="Bench Artist",
+				useRenderCache=False,
+				useWorker=False,
+			)
+			try:
+				action.run()
+			except nukeblast.BlastExecutionException:
+				failures += 1
+	return failures
+
+def benchStartup(options):
+	""" Time loading run.py and nukeblast.py, and creating a RunNukeBlast,
+	each in a fresh interpreter.
+	"""
+	benchDir = os.path.dirname(os.path.abspath(__file__))
+	results = {}
+	for module in ["run", "nukeblast"]:
+		samples = []
+		for repeat in range(max(options.repeat, 3)):
+			output = subprocess.check_output([
+				sys.executable,
+				"-c",
+				STARTUP_SCRIPT.format(
+					benchDir=benchDir,
+					repoDir=os.path.dirname(benchDir),
+					module=module,
+					importLatency=options.importLatency
+				),
+			])
+			samples.append(json.loads(output.strip().splitlines()[-1]))
+		results[module] = {
+			"import" : round(min(sample["import"] for sample in samples), 4),
+			"create" : round(min(sample["create"] for sample in samples), 4),
+			"loadedAtStartup" : samples[0]["modules"],
+		}
+	return {"scenario" : "startup", "startup" : results}
+
+def printReport(results):
+	for result in results:
+		if result["scenario"] == "startup":
+			print "\n== startup (best of runs)"
+			for module, times in sorted(result["startup"].iteritems()):
+				print "  {0:<12} import {1:.3f}s create {2:.3f}s".format(
+					module,
+					times["import"],
+					times["create"]
+				)
+				print "  {0:<12} loaded: {1}".format("", ", ".join(times["loadedAtStartup"]) or "-")
+			continue
+		print "\n== {0}: {1:.3f}s, {2} failed".format(
+			result["scenario"],
+			result["seconds"],
+			result["failures"]
+		)
+		for stage in result["stages"]:
+			print "  {0:<24} {1:>5} calls {2:>9.3f}s".format(
+				stage["stage"],
+				stage["calls"],
+				stage["seconds"]
+			)
+		for name, count in sorted(result["calls"].iteritems()):
+			print "  {0:<24} {1:>5}".format(name, count)
+
+def main(args=None):
+	options = parseArgs(args)
+	fakes.latencies.update({
+		"import" : options.importLatency,
+		"shotgun" : options.sgLatency,
+		"trax" : options.traxLatency,
+		"nuke.open" : options.openLatency,
+		"nuke.save" : options.saveLatency,
+		"nuke.frame" : options.frameLatency,
+		"ffmpeg" : options.encodeLatency,
+	})
+	root = tempfile.mkdtemp(prefix="BlastBench")
+	# Keep the Shotgun, prefs and render caches out of the real ones
+	os.environ["BLAST_CACHE_DIR"] = os.path.join(root, "cache")
+	fakes.install()
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	import run
+	run.FFMPEG_EXECUTABLE = fakes.installFFmpeg(root)
+	import nukeblast
+	import sgresolver
+	timer = StageTimer()
+	for name in RUN_STAGES:
+		timer.wrap(run, name)
+	timer.wrap(sgresolver.ShotgunResolver, "resolve", "shotgunResolve")
+	timer.wrap(run.BackupWriter, "save", "backupSave")
+	timer.wrap(run.EncodePool, "wait", "encodeWait")
+	try:
+		project = createProject(root, options)
+		results = []
+		if options.scenario in ("all", "run"):
+			results.append(runScenario(
+				"run.main",
+				timer,
+				lambda: benchRun(run, project, options)
+			))
+		if options.scenario in ("all", "action"):
+			# Run the arguments the action would launch Nuke with in this
+			# process instead
+			nukeblast.RunNukeBlast.runProcess = lambda action, cmdArgs: run.runJob(cmdArgs[3:])
+			for name in ACTION_STAGES:
+				timer.wrap(nukeblast.RunNukeBlast, name)
+			results.append(runScenario(
+				"RunNukeBlast.run",
+				timer,
+				lambda: benchAction(run, nukeblast, project, options)
+			))
+		if options.scenario in ("all", "startup"):
+			results.append(benchStartup(options))
+		printReport(results)
+		if options.json:
+			writeJson(options.json, results)
+	finally:
+		if options.keep:
+			print "\nSynthetic project kept in {0}".format(root)
+		else:
+			shutil.rmtree(root, ignore_errors=True)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,550 @@
+# =============================================================================
+# Blast - Benchmark fakes
+# Stand-in nuke, blursg, trax, blur3d and blurdev modules.  Every call into
+# them is counted and can be slowed down by a configurable latency, so the
+# blast orchestration can be measured without a Nuke license, Shotgun or
+# trax.
+# =============================================================================
+import copy
+import os
+import re
+import sys
+import time
+import types
+import zlib
+
+# =============================================================================
+# GLOBALS
+# =============================================================================
+# Number of calls keyed by "<service>.<call>".
+calls = {}
+
+# Seconds each call of a service takes, keyed by service.  nuke.frame is
+# paid for every rendered frame and import for every fake package imported.
+latencies = {
+	"import" : 0.0,
+	"shotgun" : 0.0,
+	"trax" : 0.0,
+	"nuke.open" : 0.0,
+	"nuke.save" : 0.0,
+	"nuke.frame" : 0.0,
+	"ffmpeg" : 0.0,
+}
+
+# trax file type paths keyed by file type id.  Set by the benchmark.
+fileTypePaths = {}
+
+# The fake ffmpeg executable, see installFFmpeg.
+ffmpegPath = None
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def record(service, name, count=1):
+	""" Count a call, or count units of work such as frames, and pay its
+	latency.
+	"""
+	key = "{0}.{1}".format(service, name)
+	calls[key] = calls.get(key, 0) + count
+	latency = latencies.get(service, 0.0) * count
+	if latency:
+		time.sleep(latency)
+
+def reset():
+	calls.clear()
+
+def countCalls(prefix):
+	""" Returns the number of calls whose key starts with prefix. """
+	return sum(count for key, count in calls.iteritems() if key.startswith(prefix))
+
+def writeFile(path):
+	directory = os.path.dirname(path)
+	if directory and not os.path.exists(directory):
+		os.makedirs(directory)
+	with open(path, "wb") as fileinfo:
+		fileinfo.write("\0" * 64)
+
+# =============================================================================
+# NUKE
+# =============================================================================
+class Knob(object):
+	def __init__(self, value=""):
+		self._value = value
+
+	def value(self):
+		return self._value
+
+	def setValue(self, value):
+		self._value = value
+
+	def setValueAt(self, value, frame):
+		self._value = value
+
+	def setAnimated(self):
+		pass
+
+	def animations(self):
+		return []
+
+	def execute(self):
+		pass
+
+	def toScript(self):
+		return str(self._value)
+
+	def fromScript(self, script):
+		self._value = script
+
+
+class FrameRange(object):
+	def __init__(self, first, last):
+		self._first = first
+		self._last = last
+
+	def first(self):
+		return self._first
+
+	def last(self):
+		return self._last
+
+
+class Node(object):
+	def __init__(self, name):
+		self.name = name
+		self._knobs = {}
+		self._inputs = []
+
+	def __getitem__(self, name):
+		if name not in self._knobs:
+			self._knobs[name] = Knob()
+		return self._knobs[name]
+
+	def knob(self, name):
+		return self[name]
+
+	def knobs(self):
+		return dict(self._knobs)
+
+	def fullName(self):
+		return self.name
+
+	def frameRange(self):
+		return FrameRange(int(self["first"].value() or 1001), int(self["last"].value() or 1001))
+
+	def metadata(self):
+		return {"input/bitsperchannel" : "16-bit half float"}
+
+	def width(self):
+		return 1920
+
+	def height(self):
+		return 1080
+
+	def inputs(self):
+		return len(self._inputs)
+
+	def input(self, index):
+		if index < len(self._inputs):
+			return self._inputs[index]
+		return None
+
+	def setInput(self, index, node):
+		while len(self._inputs) <= index:
+			self._inputs.append(None)
+		self._inputs[index] = node
+
+	def dependent(self, *args):
+		return []
+
+
+class NukeModule(types.ModuleType):
+	""" The nuke module.  Nodes are created the first time they are looked
+	up, so any comp and formats file can be driven.
+	"""
+	INPUTS = 1
+
+	def __init__(self):
+		types.ModuleType.__init__(self, "nuke")
+		self._nodes = {}
+		self._root = Node("root")
+		# Graphs saved in this session, so a reopened script keeps its edits
+		self._scripts = {}
+
+	def scriptOpen(self, path):
+		record("nuke.open", "scriptOpen")
+		if path in self._scripts:
+			self._nodes, self._root = copy.deepcopy(self._scripts[path])
+		else:
+			self._nodes = {}
+			self._root = Node("root")
+
+	def scriptSave(self, path=None):
+		record("nuke.save", "scriptSave")
+		if path:
+			self._scripts[path] = copy.deepcopy((self._nodes, self._root))
+		# Skip hard coded paths that only exist on the studio machines
+		if path and os.path.isdir(os.path.dirname(path)):
+			writeFile(path)
+
+	def scriptClose(self):
+		record("nuke", "scriptClose")
+		self._nodes = {}
+
+	def scriptClear(self):
+		record("nuke", "scriptClear")
+		self._nodes = {}
+		self._root = Node("root")
+
+	def toNode(self, name):
+		if name not in self._nodes:
+			self._nodes[name] = Node(name)
+		return self._nodes[name]
+
+	def allNodes(self):
+		return self._nodes.values()
+
+	def delete(self, node):
+		self._nodes.pop(node.fullName(), None)
+
+	def nodePaste(self, path):
+		record("nuke", "nodePaste")
+		return self.toNode("Postmove")
+
+	def Root(self):
+		return self._root
+
+	def execute(self, node, start, end, increment=1):
+		self.executeMultiple([node], ((start, end, increment),))
+
+	def executeMultiple(self, nodes, ranges):
+		for first, last, increment in ranges:
+			frames = range(first, last + 1, max(increment, 1))
+			record("nuke.frame", "render", len(frames) * len(nodes))
+			for node in nodes:
+				path = node["file"].value()
+				for frame in frames:
+					writeFile(path.replace("####", str(frame).zfill(4)))
+
+# =============================================================================
+# SHOTGUN
+# =============================================================================
+class FakeShotgun(object):
+	""" Answers every Shot lookup with a shot and every Version lookup with
+	the configured versions, none by default.
+	"""
+	def __init__(self):
+		self.versions = []
+
+	@staticmethod
+	def getShot(code):
+		return {"type" : "Shot", "id" : zlib.crc32(code) & 0xffffff, "code" : code}
+
+	@staticmethod
+	def getFilterValue(filters, field):
+		for item in filters:
+			if isinstance(item, list) and item[0] == field:
+				return item[2]
+		return None
+
+	def find_one(self, entity, filters, fields=None):
+		record("shotgun", "find_one")
+		if self.getFilterValue(filters, "updated_at") is not None:
+			return None
+		if entity == "Shot":
+			return self.getShot(self.getFilterValue(filters, "code"))
+		return None
+
+	def find(self, entity, filters, fields=None, order=None):
+		record("shotgun", "find")
+		if entity == "Shot":
+			return [self.getShot(code) for code in self.getFilterValue(filters, "code")]
+		return copy.deepcopy(self.versions)
+
+
+shotgun = FakeShotgun()
+
+def sg():
+	return shotgun
+
+# =============================================================================
+# TRAX
+# =============================================================================
+class Record(object):
+	def __init__(self, name=""):
+		self._name = name
+
+	def isRecord(self):
+		return bool(self._name)
+
+	def name(self):
+		return self._name
+
+	def displayName(self):
+		return self._name
+
+	@classmethod
+	def recordByName(cls, name):
+		record("trax", "{0}.recordByName".format(cls.__name__))
+		return cls(name)
+
+
+class Output(object):
+	def fps(self):
+		return 23.976
+
+
+class Project(Record):
+	def primaryOutput(self):
+		return Output()
+
+
+class Shot(Record):
+	pass
+
+
+class Asset(Record):
+	pass
+
+
+class AssetType(Record):
+	pass
+
+
+class Employee(Record):
+	@classmethod
+	def recordByDisplayName(cls, name):
+		record("trax", "Employee.recordByDisplayName")
+		return cls(name)
+
+	def username(self):
+		return self._name.lower().replace(" ", "")
+
+
+class FileType(Record):
+	@classmethod
+	def recordByAssetTypeAndId(cls, assetType, uniqueId):
+		record("trax", "FileType.recordByAssetTypeAndId")
+		return cls(uniqueId)
+
+	@classmethod
+	def recordByUniqueId(cls, uniqueId):
+		record("trax", "FileType.recordByUniqueId")
+		return cls(uniqueId)
+
+	def fullPath(self, element=None):
+		record("trax", "FileType.fullPath")
+		path = fileTypePaths.get(self._name, "")
+		if element is not None and self._name == "BlastBackup":
+			path = os.path.join(path, element.name())
+		return path
+
+
+class File(Record):
+	@classmethod
+	def findLatestVersionByElementAndFileType(cls, element, fileType, variation=None):
+		record("trax", "File.findLatestVersionByElementAndFileType")
+		return cls()
+
+
+class Software(Record):
+	def installedPath(self):
+		return os.path.dirname(sys.executable)
+
+	def executable(self):
+		return os.path.basename(sys.executable)
+
+
+def findShot(shot, group, project):
+	record("trax", "findShot")
+	return Shot("{0}_{1}".format(group, shot))
+
+def findAsset(asset, project):
+	record("trax", "findAsset")
+	return Asset(asset)
+
+# =============================================================================
+# BLUR3D
+# =============================================================================
+class FileSequence(object):
+	def __init__(self, path):
+		self.path = path
+
+	def delete(self):
+		record("blur3d", "FileSequence.delete")
+		match = re.search(r"(\d+)-(\d+)", os.path.basename(self.path))
+		if not match:
+			return
+		first, last = int(match.group(1)), int(match.group(2))
+		pattern = self.path[:len(self.path) - len(os.path.basename(self.path))]
+		pattern += os.path.basename(self.path).replace(match.group(0), "{0}")
+		for frame in range(first, last + 1):
+			path = pattern.format(str(frame).zfill(len(match.group(1))))
+			if os.path.exists(path):
+				os.remove(path)
+
+
+# A stand-in ffmpeg executable.  It drains piped frames, pays the encode
+# latency and writes every output, then logs the encode so the benchmark can
+# count it.
+FFMPEG_SCRIPT = """#!{python}
+import sys, time
+args = sys.argv[1:]
+if "-" in args:
+	sys.stdin.read()
+time.sleep({latency!r})
+outputs = [args[index + 2] for index, arg in enumerate(args) if arg == "-r"]
+for output in outputs:
+	open(output, "w").close()
+with open({logPath!r}, "a") as log:
+	log.write("{{0}}\\n".format(len(outputs)))
+"""
+
+def installFFmpeg(directory):
+	""" Write the fake ffmpeg executable and return its path. """
+	global ffmpegPath
+	path = os.path.join(directory, "ffmpeg")
+	with open(path, "w") as fileinfo:
+		fileinfo.write(FFMPEG_SCRIPT.format(
+			python=sys.executable,
+			latency=latencies["ffmpeg"],
+			logPath=path + ".log",
+		))
+	os.chmod(path, 0755)
+	ffmpegPath = path
+	return path
+
+def countFFmpeg():
+	""" Count the encodes the fake ffmpeg ran since the last count. """
+	if ffmpegPath is None:
+		return
+	logPath = ffmpegPath + ".log"
+	if not os.path.exists(logPath):
+		return
+	with open(logPath, "r") as log:
+		outputs = [int(line) for line in log.read().split()]
+	os.remove(logPath)
+	for key, count in (("ffmpeg.encode", len(outputs)), ("ffmpeg.output", sum(outputs))):
+		if count:
+			calls[key] = calls.get(key, 0) + count
+
+# =============================================================================
+# BLURDEV
+# =============================================================================
+class Apps(object):
+	Nuke = "Nuke"
+	XSI = "XSI"
+	Max = "Max"
+	External = "External"
+
+App = str
+
+def argproperty(atype=None, default=None):
+	def decorator(func):
+		name = func.__name__
+		def getter(self):
+			if name not in self._args:
+				self._args[name] = copy.copy(default)
+			return self._args[name]
+		def setter(self, value):
+			self._args[name] = value
+		return property(getter, setter, doc=func.__doc__)
+	return decorator
+
+def executehook(application):
+	def decorator(func):
+		return func
+	return decorator
+
+
+class Services(object):
+	Nuke9 = "Nuke9"
+
+
+class FarmAction(object):
+	def __init__(self, *args, **kwargs):
+		self._args = {}
+		self.services = []
+		for name, value in kwargs.iteritems():
+			setattr(self, name, value)
+
+	@argproperty(atype=Project, default=Project())
+	def project(self):
+		pass
+
+	def pickle(self, path):
+		pass
+
+	def submit(self):
+		record("farm", "submit")
+		return self
+
+# =============================================================================
+# INSTALL
+# =============================================================================
+class FakeImporter(object):
+	""" Serves the fake modules to import statements, so only the modules a
+	code path actually imports end up in sys.modules.
+	"""
+	def __init__(self):
+		self.modules = {}
+
+	def find_module(self, fullname, path=None):
+		if fullname in self.modules:
+			return self
+		return None
+
+	def load_module(self, fullname):
+		if fullname not in sys.modules:
+			if "." not in fullname:
+				record("import", fullname)
+			sys.modules[fullname] = self.modules[fullname]
+		return sys.modules[fullname]
+
+
+importer = FakeImporter()
+
+def createModule(name, **attributes):
+	module = types.ModuleType(name)
+	# Every fake can hold submodules
+	module.__path__ = []
+	module.__dict__.update(attributes)
+	importer.modules[name] = module
+	return module
+
+def install():
+	""" Put the fakes ahead of any real install. """
+	nuke = NukeModule()
+	importer.modules["nuke"] = nuke
+	createModule("blursg", sg=sg)
+	data = createModule(
+		"trax.api.data",
+		Project=Project,
+		Shot=Shot,
+		Asset=Asset,
+		AssetType=AssetType,
+		Employee=Employee,
+		FileType=FileType,
+		File=File,
+		Software=Software,
+	)
+	api = createModule("trax.api", data=data, findShot=findShot, findAsset=findAsset)
+	createModule("trax", api=api)
+	filesequence = createModule("blur3d.pipe.cinematic.api.filesequence", FileSequence=FileSequence)
+	cinematicApi = createModule("blur3d.pipe.cinematic.api", filesequence=filesequence)
+	cinematic = createModule("blur3d.pipe.cinematic", api=cinematicApi)
+	pipe = createModule("blur3d.pipe", cinematic=cinematic)
+	farm = createModule("blur3d.actions.farm", FarmAction=FarmAction, Services=Services)
+	actions = createModule("blur3d.actions", farm=farm)
+	createModule("blur3d", pipe=pipe, actions=actions)
+	action = createModule(
+		"blurdev.action",
+		Apps=Apps,
+		App=App,
+		argproperty=argproperty,
+		executehook=executehook,
+		__all__=["Apps", "App", "argproperty", "executehook"],
+	)
+	createModule("blurdev", action=action)
+	if importer not in sys.meta_path:
+		sys.meta_path.insert(0, importer)
+	return nuke
@@ -0,0 +1,192 @@
+# =============================================================================
+# Blast - Project prefs
+# Loads, validates and caches the project blast prefs (formats.json,
+# nukefiles.json and presets.json).
+# =============================================================================
+import copy
+import hashlib
+import json
+import os
+
+from encodeprofiles import EncodeProfileException, getEncodeEntries, getIntermediate
+from fileutils import makeDirs, writeFile
+from sgcache import getCacheDir
+
+# =============================================================================
+# EXCEPTIONS
+# =============================================================================
+class BlastPrefsException(Exception):
+	pass
+
+# =============================================================================
+# GLOBALS
+# =============================================================================
+# Parsed prefs keyed by path, along with the mtime they were parsed at.
+_prefsCache = {}
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def getDiskCachePath(path):
+	cacheDir = makeDirs(os.path.join(getCacheDir(), "prefs"))
+	return os.path.join(cacheDir, hashlib.sha1(os.path.normcase(path)).hexdigest() + ".json")
+
+def loadJson(path):
+	""" Load a prefs json file.
+
+	Parsed files are kept in memory and in the local blast cache, keyed by
+	path and modification time, so an unchanged file on the network is only
+	ever stat'ed.
+
+	Args:
+		path(str) : The prefs file to load.
+
+	Returns:
+		dict - A copy of the parsed prefs, free to be modified.
+
+	Raises:
+		BlastPrefsException : If the file is missing or is not valid json.
+
+	"""
+	path = os.path.normpath(path)
+	try:
+		mtime = os.path.getmtime(path)
+	except OSError:
+		raise BlastPrefsException("Prefs file does not exist: {0}".format(path))
+	cached = _prefsCache.get(path)
+	if cached and cached[0] == mtime:
+		return copy.deepcopy(cached[1])
+	diskCachePath = getDiskCachePath(path)
+	data = None
+	if os.path.exists(diskCachePath):
+		try:
+			with open(diskCachePath, "r") as fileinfo:
+				diskCache = json.loads(fileinfo.read())
+			if diskCache["mtime"] == mtime:
+				data = diskCache["data"]
+		except (IOError, ValueError, KeyError):
+			data = None
+	if data is None:
+		try:
+			with open(path, "r") as fileinfo:
+				data = json.loads(fileinfo.read())
+		except ValueError as e:
+			raise BlastPrefsException("Invalid json in {0}: {1}".format(path, e))
+		try:
+			writeFile(diskCachePath, json.dumps({"mtime" : mtime, "data" : data}))
+		except (IOError, OSError):
+			# The local cache is only an optimization
+			pass
+	_prefsCache[path] = (mtime, data)
+	return copy.deepcopy(data)
+
+def validateFormats(formats, path, names=None):
+	""" Check the formats entries a blast relies on.
+
+	Args:
+		formats(dict) : The parsed formats.json.
+		path(str) : The formats file, for error messages.
+		names(list) : Formats that must exist and are checked.  Every entry
+			is checked if not given.
+
+	Raises:
+		BlastPrefsException : On the first invalid entry.
+
+	"""
+	if not isinstance(formats, dict):
+		raise BlastPrefsException("{0} must map format names to settings".format(path))
+	for name in names or []:
+		if name not in formats:
+			raise BlastPrefsException("Format {0} is not defined in {1}".format(name, path))
+	for name in names or formats.keys():
+		formatinfo = formats[name]
+		if not isinstance(formatinfo, dict):
+			raise BlastPrefsException("Format {0} in {1} is not a mapping".format(name, path))
+		nodes = formatinfo.get("nodes")
+		if (not isinstance(nodes, list) or len(nodes) != 2 or
+				not all(isinstance(node, basestring) for node in nodes)):
+			raise BlastPrefsException(
+				"Format {0} in {1} needs nodes set to [input node, output node]".format(name, path)
+			)
+		ext = formatinfo.get("ext")
+		if ext and (not isinstance(ext, basestring) or not ext.startswith(".")):
+			raise BlastPrefsException(
+				"Format {0} in {1} has an invalid ext: {2}".format(name, path, ext)
+			)
+		chunks = formatinfo.get("render_chunks", 1)
+		if not isinstance(chunks, int) or chunks < 1:
+			raise BlastPrefsException(
+				"Format {0} in {1} needs render_chunks to be a positive integer".format(name, path)
+			)
+		if not isinstance(formatinfo.get("encodes", []), list):
+			raise BlastPrefsException("Format {0} in {1} needs encodes to be a list".format(name, path))
+		try:
+			getEncodeEntries(formatinfo)
+		except EncodeProfileException as e:
+			raise BlastPrefsException("Format {0} in {1} has invalid encodes: {2}".format(name, path, e))
+		try:
+			getIntermediate(formatinfo)
+		except EncodeProfileException as e:
+			raise BlastPrefsException("Format {0} in {1} has an invalid intermediate: {2}".format(name, path, e))
+		if not isinstance(formatinfo.get("stage_intermediate", False), (bool, basestring)):
+			raise BlastPrefsException(
+				"Format {0} in {1} needs stage_intermediate to be true or a directory".format(name, path)
+			)
+		# ffmpeg applies the LUT to the written frames, so the format must
+		# write them in the space the shot's CDL and 3DL expect
+		if formatinfo.get("encode_lut") and not formatinfo.get("colorspace"):
+			raise BlastPrefsException(
+				"Format {0} in {1} uses encode_lut and needs the colorspace its frames are "
+				"written in, the input space of the shot's CDL and 3DL".format(name, path)
+			)
+
+def loadFormats(path, names=None):
+	""" Load and validate formats.json.
+
+	Args:
+		path(str) : The formats file.
+		names(list) : Formats the blast will use.  These must exist.
+
+	Returns:
+		dict - The formats.
+
+	"""
+	formats = loadJson(path)
+	validateFormats(formats, path, names)
+	return formats
+
+def loadNukeFiles(path, filetype=None):
+	""" Load and validate nukefiles.json.
+
+	Args:
+		path(str) : The nukefiles file.
+		filetype(str) : Key that must exist with a location.
+
+	Returns:
+		dict - The nuke files.
+
+	"""
+	nukefiles = loadJson(path)
+	if not isinstance(nukefiles, dict):
+		raise BlastPrefsException("{0} must map file types to nuke files".format(path))
+	for key, info in nukefiles.iteritems():
+		if not isinstance(info, dict) or not info.get("location"):
+			raise BlastPrefsException("Nuke file {0} in {1} needs a location".format(key, path))
+	if filetype and filetype not in nukefiles:
+		raise BlastPrefsException("Nuke file {0} is not defined in {1}".format(filetype, path))
+	return nukefiles
+
+def loadPresets(path):
+	""" Load and validate presets.json.
+
+	Returns:
+		dict - The presets, each a mapping of blast attribute to value.
+
+	"""
+	presets = loadJson(path)
+	if not isinstance(presets, dict):
+		raise BlastPrefsException("{0} must map preset names to settings".format(path))
+	for name, settings in presets.iteritems():
+		if not isinstance(settings, dict):
+			raise BlastPrefsException("Preset {0} in {1} is not a mapping".format(name, path))
+	return presets
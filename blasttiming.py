@@ -0,0 +1,152 @@
+# =============================================================================
+# Blast - Timing
+# Records how long every stage of a blast takes and writes it out as a json
+# report, and optionally as a Chrome trace (chrome://tracing, Perfetto).
+# =============================================================================
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+class BlastTimer(object):
+	""" Collects timing spans of a blast.
+
+	Spans hold absolute times so spans recorded by the client that launched
+	the blast can be merged in.  Spans may be added from any thread.
+	"""
+	def __init__(self):
+		self.started = time.time()
+		self.spans = []
+		self.lock = threading.Lock()
+
+	@contextlib.contextmanager
+	def span(self, name, **args):
+		""" Time the body of the with statement as a stage.
+
+		Args:
+			name(str) : The stage name.
+			args(dict) : Details stored with the span, such as the formats.
+
+		"""
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.add(name, start, time.time(), **args)
+
+	def add(self, name, start, end, thread=None, **args):
+		span = {
+			"name" : name,
+			"start" : start,
+			"end" : end,
+			"thread" : thread or threading.current_thread().name,
+			"args" : args,
+		}
+		with self.lock:
+			self.spans.append(span)
+
+	def save(self, path):
+		""" Write the spans so another process can merge them. """
+		with open(path, "w") as fileinfo:
+			fileinfo.write(json.dumps({"saved" : time.time(), "spans" : self.spans}))
+
+	def load(self, path, thread="client"):
+		""" Merge the spans saved by another process.
+
+		Returns:
+			float - When the spans were saved, or None if they are unreadable.
+
+		"""
+		try:
+			with open(path, "r") as fileinfo:
+				saved = json.loads(fileinfo.read())
+		except (IOError, ValueError):
+			return None
+		for span in saved["spans"]:
+			self.add(span["name"], span["start"], span["end"], thread, **span["args"])
+		return saved["saved"]
+
+	def getStages(self):
+		""" Returns the number of calls and total seconds of every stage. """
+		stages = {}
+		for span in self.spans:
+			stage = stages.setdefault(span["name"], {"calls" : 0, "seconds" : 0.0})
+			stage["calls"] += 1
+			stage["seconds"] += span["end"] - span["start"]
+		return stages
+
+	def getRenders(self):
+		""" Returns the frame rate of every render span. """
+		renders = []
+		for span in self.spans:
+			if span["name"] != "render":
+				continue
+			seconds = span["end"] - span["start"]
+			frames = span["args"].get("frames", 0)
+			renders.append({
+				"formats" : span["args"].get("formats", []),
+				"frames" : frames,
+				"seconds" : seconds,
+				"framesPerSecond" : frames / seconds if seconds else None,
+				"secondsPerFrame" : seconds / frames if frames else None,
+			})
+		return renders
+
+	def getReport(self, **info):
+		""" Returns the report of the blast.
+
+		Args:
+			info(dict) : Details of the blast stored at the top of the report.
+
+		"""
+		start = min([self.started] + [span["start"] for span in self.spans])
+		end = max([time.time()] + [span["end"] for span in self.spans])
+		report = dict(info)
+		report.update({
+			"host" : socket.gethostname(),
+			"started" : time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start)),
+			"seconds" : end - start,
+			"stages" : self.getStages(),
+			"renders" : self.getRenders(),
+			"spans" : [
+				dict(span, start=span["start"] - start, end=span["end"] - start)
+				for span in sorted(self.spans, key=lambda span: span["start"])
+			],
+		})
+		return report
+
+	def writeReport(self, path, **info):
+		with open(path, "w") as fileinfo:
+			fileinfo.write(json.dumps(self.getReport(**info), indent=4, sort_keys=True))
+
+	def writeChromeTrace(self, path):
+		""" Write the spans in the Chrome trace event format. """
+		start = min([self.started] + [span["start"] for span in self.spans])
+		threadIds = {}
+		events = []
+		for span in sorted(self.spans, key=lambda span: span["start"]):
+			if span["thread"] not in threadIds:
+				threadIds[span["thread"]] = len(threadIds)
+				events.append({
+					"name" : "thread_name",
+					"ph" : "M",
+					"pid" : os.getpid(),
+					"tid" : threadIds[span["thread"]],
+					"args" : {"name" : span["thread"]},
+				})
+			events.append({
+				"name" : span["name"],
+				"ph" : "X",
+				"pid" : os.getpid(),
+				"tid" : threadIds[span["thread"]],
+				"ts" : int((span["start"] - start) * 1000000),
+				"dur" : int((span["end"] - span["start"]) * 1000000),
+				"args" : span["args"],
+			})
+		with open(path, "w") as fileinfo:
+			fileinfo.write(json.dumps({"traceEvents" : events}))
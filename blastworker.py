@@ -0,0 +1,159 @@
+# =============================================================================
+# Blast - Worker protocol
+# A long lived Nuke process (run.py --worker) accepts blast jobs over a local
+# socket so the Nuke startup and license checkout are only paid once.  Jobs
+# must carry the token the worker writes to a file only its user can read, so
+# other users of the machine can not run blasts through it.
+# =============================================================================
+import binascii
+import hmac
+import json
+import os
+import socket
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+WORKER_HOST = "127.0.0.1"
+WORKER_PORT = int(os.environ.get("BLAST_WORKER_PORT", 5829))
+
+# Seconds a client waits on a worker for the result of a blast.
+WORKER_TIMEOUT = float(os.environ.get("BLAST_WORKER_TIMEOUT", 4 * 60 * 60))
+
+TOKEN_PATH = os.environ.get("BLAST_WORKER_TOKEN") or os.path.join(
+	os.path.expanduser("~"),
+	".blastworker.token"
+)
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def readMessage(connection):
+	""" Read a single newline terminated json message from the socket. """
+	data = ""
+	while not data.endswith("\n"):
+		chunk = connection.recv(4096)
+		if not chunk:
+			break
+		data += chunk
+	if not data:
+		return None
+	return json.loads(data)
+
+def writeMessage(connection, message):
+	connection.sendall(json.dumps(message) + "\n")
+
+def createToken(path=TOKEN_PATH):
+	""" Write a new random token to a file only the current user can read.
+
+	Returns:
+		str - The token.
+
+	"""
+	token = binascii.hexlify(os.urandom(32))
+	if os.path.exists(path):
+		os.remove(path)
+	fileno = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+	with os.fdopen(fileno, "w") as fileinfo:
+		fileinfo.write(token)
+	return token
+
+def readToken(path=TOKEN_PATH):
+	""" Returns the token of the running worker, or None. """
+	try:
+		with open(path, "r") as fileinfo:
+			return fileinfo.read().strip() or None
+	except IOError:
+		return None
+
+def isWorkerAvailable(host=WORKER_HOST, port=WORKER_PORT, timeout=0.5):
+	""" Returns True if a blast worker of this user is listening on the port. """
+	if readToken() is None:
+		return False
+	try:
+		connection = socket.create_connection((host, port), timeout)
+	except socket.error:
+		return False
+	connection.close()
+	return True
+
+def sendJob(args, host=WORKER_HOST, port=WORKER_PORT, timeout=WORKER_TIMEOUT):
+	""" Send a blast job to a running worker and wait for it to finish.
+
+	Args:
+		args(list) : The run.py command line arguments for the blast.
+		timeout(float) : Seconds to wait for the result.
+
+	Returns:
+		tuple - (returncode, output, error)
+
+	Raises:
+		socket.error : If the worker can not be reached.
+
+	"""
+	connection = socket.create_connection((host, port), timeout)
+	try:
+		writeMessage(connection, {"token" : readToken(), "args" : args})
+		response = readMessage(connection)
+	except socket.timeout:
+		return (1, "", "The blast worker did not finish the blast within {0} seconds.".format(timeout))
+	except ValueError as e:
+		return (1, "", "The blast worker sent an invalid result: {0}".format(e))
+	finally:
+		connection.close()
+	if response is None:
+		return (1, "", "The blast worker closed the connection without a result.")
+	return (response["returncode"], response["output"], response["error"])
+
+def serve(runJob, host=WORKER_HOST, port=WORKER_PORT):
+	""" Serve blast jobs one at a time until the process is killed.
+
+	Jobs without the worker's token, and messages that are not jobs, are
+	answered with an error and do not stop the worker.
+
+	Args:
+		runJob(callable) : Called with the job arguments.  Returns a
+			(returncode, output, error) tuple.
+
+	"""
+	token = createToken()
+	server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	server.bind((host, port))
+	# Jobs queue up on the listening socket while one is running
+	server.listen(16)
+	print "Blast worker listening on {0}:{1}".format(host, port)
+	try:
+		while True:
+			connection, address = server.accept()
+			try:
+				try:
+					message = readMessage(connection)
+					if message is None:
+						continue
+					if not hmac.compare_digest(str(message.get("token") or ""), token):
+						raise ValueError("the token does not match this worker")
+					args = message.get("args")
+					if not isinstance(args, list):
+						raise ValueError("args must be a list")
+				except (ValueError, AttributeError) as e:
+					writeMessage(connection, {
+						"returncode" : 1,
+						"output" : "",
+						"error" : "Invalid blast job: {0}".format(e),
+					})
+					continue
+				returncode, output, error = runJob(args)
+				writeMessage(connection, {
+					"returncode" : returncode,
+					"output" : output,
+					"error" : error,
+				})
+			except socket.error as e:
+				print "Lost connection to the blast client: {0}".format(e)
+			finally:
+				connection.close()
+	finally:
+		server.close()
+		if readToken() == token:
+			os.remove(TOKEN_PATH)
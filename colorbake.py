@@ -0,0 +1,282 @@
+# =============================================================================
+# Blast - Color bake
+# Combines a shot's CDL and 3DL into a single cube LUT, cached locally so the
+# bake only happens when one of the source files changes.
+# =============================================================================
+import bisect
+import hashlib
+import json
+import os
+import xml.etree.ElementTree as ET
+
+from fileutils import makeDirs, writeFile
+from sgcache import getCacheDir
+
+# =============================================================================
+# EXCEPTIONS
+# =============================================================================
+class ColorBakeException(Exception):
+	pass
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+DEFAULT_LUT_SIZE = 33
+
+# Rec. 709 luma weights used by the ASC CDL saturation.
+LUMA_WEIGHTS = (0.2126, 0.7152, 0.0722)
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def getLocalName(tag):
+	""" Returns the tag of an xml element without its namespace. """
+	return tag.rsplit("}", 1)[-1]
+
+def getChildText(element, name):
+	for child in element.iter():
+		if getLocalName(child.tag) == name and child.text:
+			return child.text
+	return None
+
+def parseCDL(cdlPath, cccid=None):
+	""" Read the correction of a .cdl, .cc or .ccc file.
+
+	Args:
+		cdlPath(str) : The CDL file.
+		cccid(str) : Id of the correction to read, the first one by default.
+
+	Returns:
+		CDLCorrection - The slope, offset, power and saturation.
+
+	Raises:
+		ColorBakeException : The file is unreadable or has no correction.
+
+	"""
+	try:
+		root = ET.parse(cdlPath).getroot()
+	except (IOError, ET.ParseError) as e:
+		raise ColorBakeException("Unable to read CDL {0}: {1}".format(cdlPath, e))
+	for element in root.iter():
+		if getLocalName(element.tag) != "ColorCorrection":
+			continue
+		if cccid and element.attrib.get("id") != cccid:
+			continue
+		try:
+			slope = [float(value) for value in (getChildText(element, "Slope") or "1 1 1").split()]
+			offset = [float(value) for value in (getChildText(element, "Offset") or "0 0 0").split()]
+			power = [float(value) for value in (getChildText(element, "Power") or "1 1 1").split()]
+			saturation = float(getChildText(element, "Saturation") or 1.0)
+		except ValueError as e:
+			raise ColorBakeException("Invalid CDL {0}: {1}".format(cdlPath, e))
+		if not len(slope) == len(offset) == len(power) == 3:
+			raise ColorBakeException("Invalid CDL {0}: SOP values need 3 channels".format(cdlPath))
+		return CDLCorrection(slope, offset, power, saturation)
+	raise ColorBakeException("No ColorCorrection {0}found in {1}".format(
+		"{0} ".format(cccid) if cccid else "",
+		cdlPath
+	))
+
+def getMaxCode(value):
+	""" Returns the largest code of the smallest bit depth holding value. """
+	bits = 1
+	while (1 << bits) - 1 < value:
+		bits += 1
+	return float((1 << bits) - 1)
+
+def parse3DL(lutPath):
+	""" Read an Autodesk .3dl LUT.
+
+	Args:
+		lutPath(str) : The 3DL file.
+
+	Returns:
+		Lut3D - The LUT, scaled to 0-1.
+
+	Raises:
+		ColorBakeException : The file is unreadable or is not a 3DL LUT.
+
+	"""
+	shaper = None
+	table = []
+	try:
+		with open(lutPath, "r") as fileinfo:
+			for line in fileinfo:
+				line = line.split("#", 1)[0].strip()
+				if not line:
+					continue
+				try:
+					values = [int(value) for value in line.split()]
+				except ValueError:
+					# Keywords such as 3DMESH and Mesh are not needed
+					continue
+				if len(values) == 3:
+					table.append(values)
+				elif shaper is None and not table:
+					shaper = values
+	except IOError as e:
+		raise ColorBakeException("Unable to read 3DL {0}: {1}".format(lutPath, e))
+	size = int(round(len(table) ** (1.0 / 3)))
+	if size < 2 or size ** 3 != len(table):
+		raise ColorBakeException("Invalid 3DL {0}: {1} entries".format(lutPath, len(table)))
+	if shaper is None:
+		shaper = [index * 1023.0 / (size - 1) for index in range(size)]
+	if len(shaper) != size:
+		raise ColorBakeException("Invalid 3DL {0}: the input shaper has {1} entries for a size {2} mesh".format(
+			lutPath,
+			len(shaper),
+			size
+		))
+	shaperMax = getMaxCode(shaper[-1])
+	outputMax = getMaxCode(max(max(values) for values in table))
+	return Lut3D(
+		[value / shaperMax for value in shaper],
+		[[value / outputMax for value in values] for values in table]
+	)
+
+def getLUTKey(cdlPath, lutPath, cccid, size):
+	""" Returns the cache key of a bake, which changes whenever a source file
+	is replaced or modified.
+	"""
+	sources = []
+	for path in (cdlPath, lutPath):
+		if path:
+			try:
+				mtime = os.path.getmtime(path)
+			except OSError as e:
+				raise ColorBakeException("Unable to read {0}: {1}".format(path, e))
+			sources.append([os.path.normcase(os.path.abspath(path)), mtime])
+		else:
+			sources.append(None)
+	return hashlib.sha1(json.dumps([sources, cccid, size])).hexdigest()
+
+def bakeLUT(outputPath, cdl=None, lut=None, size=DEFAULT_LUT_SIZE):
+	""" Write the CDL followed by the 3DL as a .cube LUT.
+
+	The cube's domain is 0-1, so input values outside of it are clamped
+	before the CDL, where the separate CDL node only clamps its result.
+	Values above 1 that the CDL brings back into range, such as with a slope
+	under 1, come out as 1 would.  Comps sending the baked LUT node values
+	above 1 should keep the separate CDL and 3DL nodes.  Encodes are not
+	affected, their intermediate frames never hold values outside of 0-1.
+
+	Args:
+		outputPath(str) : The .cube file to write.
+		cdl(CDLCorrection) : The correction applied first.
+		lut(Lut3D) : The LUT applied after the correction.
+		size(int) : Number of samples along every axis of the cube.
+
+	"""
+	lines = [
+		"# Baked by Blast",
+		"LUT_3D_SIZE {0}".format(size),
+		"DOMAIN_MIN 0.0 0.0 0.0",
+		"DOMAIN_MAX 1.0 1.0 1.0",
+	]
+	steps = [index / float(size - 1) for index in range(size)]
+	# Cube files have red changing fastest
+	for blue in steps:
+		for green in steps:
+			for red in steps:
+				rgb = [red, green, blue]
+				if cdl is not None:
+					rgb = cdl.apply(rgb)
+				if lut is not None:
+					rgb = lut.sample(rgb)
+				lines.append("{0:.6f} {1:.6f} {2:.6f}".format(*rgb))
+	writeFile(outputPath, "\n".join(lines) + "\n")
+
+def getBakedLUT(cdlPath=None, lutPath=None, cccid=None, size=DEFAULT_LUT_SIZE, cacheDir=None):
+	""" Returns the cube LUT combining the CDL and the 3DL, baking it if the
+	cache does not hold it yet.
+
+	Args:
+		cdlPath(str) : The shot's CDL, if it has one.
+		lutPath(str) : The shot's 3DL, if it has one.
+		cccid(str) : Id of the correction to read from the CDL.
+		size(int) : Number of samples along every axis of the cube.
+		cacheDir(str) : Where the baked LUTs are kept.
+
+	Returns:
+		str - Path to the .cube file, or None if there is no color to bake.
+
+	Raises:
+		ColorBakeException : A source file is missing or invalid.
+
+	"""
+	if not (cdlPath or lutPath):
+		return None
+	cacheDir = cacheDir or os.path.join(getCacheDir(), "luts")
+	outputPath = os.path.join(cacheDir, getLUTKey(cdlPath, lutPath, cccid, size) + ".cube")
+	if os.path.exists(outputPath):
+		return outputPath
+	makeDirs(cacheDir)
+	cdl = parseCDL(cdlPath, cccid) if cdlPath else None
+	lut = parse3DL(lutPath) if lutPath else None
+	print "Baking {0} into {1}".format(" and ".join(filter(None, [cdlPath, lutPath])), outputPath)
+	bakeLUT(outputPath, cdl, lut, size)
+	return outputPath
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+class CDLCorrection(object):
+	""" An ASC CDL slope, offset, power and saturation. """
+	def __init__(self, slope, offset, power, saturation=1.0):
+		self.slope = slope
+		self.offset = offset
+		self.power = power
+		self.saturation = saturation
+
+	def apply(self, rgb):
+		rgb = [
+			min(max(value * slope + offset, 0.0), 1.0) ** power
+			for value, slope, offset, power in zip(rgb, self.slope, self.offset, self.power)
+		]
+		if self.saturation != 1.0:
+			luma = sum(value * weight for value, weight in zip(rgb, LUMA_WEIGHTS))
+			rgb = [
+				min(max(luma + self.saturation * (value - luma), 0.0), 1.0)
+				for value in rgb
+			]
+		return rgb
+
+class Lut3D(object):
+	""" A 3D LUT sampled with trilinear interpolation.
+
+	Args:
+		shaper(list) : Input value of every mesh position, from 0 to 1.
+		table(list) : RGB output values, blue changing fastest.
+
+	"""
+	def __init__(self, shaper, table):
+		self.shaper = shaper
+		self.table = table
+		self.size = len(shaper)
+
+	def getPosition(self, value):
+		""" Returns the mesh index below value and the weight of the next one. """
+		value = min(max(value, self.shaper[0]), self.shaper[-1])
+		index = min(max(bisect.bisect_right(self.shaper, value) - 1, 0), self.size - 2)
+		low = self.shaper[index]
+		high = self.shaper[index + 1]
+		return index, (value - low) / (high - low) if high > low else 0.0
+
+	def sample(self, rgb):
+		(red, redWeight), (green, greenWeight), (blue, blueWeight) = [
+			self.getPosition(value) for value in rgb
+		]
+		size = self.size
+		result = [0.0, 0.0, 0.0]
+		for redStep, redAmount in ((0, 1.0 - redWeight), (1, redWeight)):
+			for greenStep, greenAmount in ((0, 1.0 - greenWeight), (1, greenWeight)):
+				for blueStep, blueAmount in ((0, 1.0 - blueWeight), (1, blueWeight)):
+					weight = redAmount * greenAmount * blueAmount
+					if not weight:
+						continue
+					values = self.table[
+						((red + redStep) * size + green + greenStep) * size + blue + blueStep
+					]
+					for channel in range(3):
+						result[channel] += weight * values[channel]
+		return result
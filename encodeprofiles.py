@@ -0,0 +1,280 @@
+# =============================================================================
+# Blast - Encode profiles
+# Builds a single ffmpeg command writing every movie a format delivers, so
+# the rendered frames are only decoded once.
+# =============================================================================
+import copy
+import os
+
+# =============================================================================
+# EXCEPTIONS
+# =============================================================================
+class EncodeProfileException(Exception):
+	pass
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+DEFAULT_FPS = 23.976
+
+# apcs == Prores
+# avc1 == H264
+ENCODE_PROFILES = {
+	"apcs" : {
+		"format" : "mov",
+		"ext" : ".mov",
+		"pix_fmt" : "yuv422p10le",
+		"args" : ["-codec:v", "prores", "-profile:v", "1", "-qscale:v", "5", "-vendor", "ap10"],
+	},
+	"avc1" : {
+		"format" : "mov",
+		"ext" : ".mov",
+		"pix_fmt" : "yuv420p",
+		"args" : ["-vcodec", "h264", "-preset", "slow", "-b:v", "10M"],
+	},
+}
+
+# The movie a format delivers when formats.json does not list its encodes.
+# It keeps the settings blasts delivered H.264 with before formats could
+# list encodes, which are lighter than the avc1 profile.
+DEFAULT_ENCODES = [{
+	"profile" : "avc1",
+	"args" : ["-vcodec", "h264", "-preset", "fast", "-b:v", "5M", "-maxrate", "5M"],
+}]
+
+# Settings an encode entry in formats.json may hold.
+ENCODE_KEYS = ["profile", "format", "ext", "pix_fmt", "scale", "args", "suffix"]
+
+# Image formats Nuke can render the frames of an encoded format to.  The
+# knobs are set on the write node when it has them, and bytesPerPixel is an
+# upper bound used to check a staging directory has the space.  Formats with
+# encode_lut render at the deep settings instead, as ffmpeg applies the LUT
+# to the frames and it bands on 8 bit ones.
+INTERMEDIATE_FORMATS = {
+	# Nuke's zlib compressed png, the only intermediate blasts used to have.
+	# The write node keeps the settings saved with the comp.
+	"png" : {
+		"ext" : ".png",
+		"fileType" : "png",
+		"codec" : "png",
+		"bytesPerPixel" : 3,
+		"knobs" : {},
+		"deepBytesPerPixel" : 6,
+		"deepKnobs" : {"datatype" : "16 bit"},
+	},
+	"tiff" : {
+		"ext" : ".tif",
+		"fileType" : "tiff",
+		"codec" : "tiff",
+		"bytesPerPixel" : 3,
+		"knobs" : {"datatype" : "8 bit", "compression" : "none"},
+		"deepBytesPerPixel" : 6,
+		"deepKnobs" : {"datatype" : "16 bit"},
+	},
+	"dpx" : {
+		"ext" : ".dpx",
+		"fileType" : "dpx",
+		"codec" : "dpx",
+		"bytesPerPixel" : 4,
+		"knobs" : {"datatype" : "10 bit"},
+		"deepBytesPerPixel" : 4,
+		"deepKnobs" : {"datatype" : "10 bit"},
+	},
+}
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def getEncodeEntries(formatinfo):
+	""" Returns the encodes of a format as a list of settings.
+
+	formats.json lists them under "encodes", either as profile names or as
+	settings overriding a profile, for example:
+
+		"encodes" : ["avc1", {"profile" : "apcs", "scale" : "1920:-2"}]
+
+	Raises:
+		EncodeProfileException : An entry is invalid.
+
+	"""
+	entries = []
+	for encode in formatinfo.get("encodes") or DEFAULT_ENCODES:
+		if isinstance(encode, basestring):
+			encode = {"profile" : encode}
+		if not isinstance(encode, dict):
+			raise EncodeProfileException("Encodes must be profile names or settings, not {0!r}".format(encode))
+		unknown = sorted(set(encode) - set(ENCODE_KEYS))
+		if unknown:
+			raise EncodeProfileException("Unknown encode settings: {0}".format(", ".join(unknown)))
+		profileName = encode.get("profile")
+		if profileName is None and "args" not in encode:
+			raise EncodeProfileException("Encodes need a profile or args: {0!r}".format(encode))
+		if profileName is not None and profileName not in ENCODE_PROFILES:
+			raise EncodeProfileException("Unknown encode profile {0}, expected one of {1}".format(
+				profileName,
+				", ".join(sorted(ENCODE_PROFILES))
+			))
+		entry = copy.deepcopy(ENCODE_PROFILES.get(profileName, {}))
+		entry.update(copy.deepcopy(encode))
+		entry.setdefault("format", "mov")
+		entry.setdefault("ext", "." + entry["format"])
+		entry.setdefault("args", [])
+		entries.append(entry)
+	return entries
+
+def getEncodeOutputs(formatinfo, moviePath):
+	""" Returns the encodes of a format with the movie each one writes.
+
+	The first encode writes moviePath, the others add their suffix, which
+	defaults to the profile name.
+
+	Args:
+		formatinfo(dict) : Dictionary of blast format options
+		moviePath(str) : The movie of the format.
+
+	Returns:
+		list - The encode settings, with the movie under "path".
+
+	Raises:
+		EncodeProfileException : The encodes are invalid or write the same movie.
+
+	"""
+	root = os.path.splitext(moviePath)[0]
+	outputs = []
+	paths = set()
+	for index, entry in enumerate(getEncodeEntries(formatinfo)):
+		suffix = entry.get("suffix")
+		if suffix is None:
+			suffix = "_{0}".format(entry.get("profile", index)) if index else ""
+		entry["path"] = root + suffix + entry["ext"]
+		if entry["path"] in paths:
+			raise EncodeProfileException("Several encodes write {0}, give them a suffix".format(entry["path"]))
+		paths.add(entry["path"])
+		outputs.append(entry)
+	return outputs
+
+def getIntermediate(formatinfo):
+	""" Returns the intermediate format the frames of a format are rendered
+	to before they are encoded.
+
+	formats.json picks one of INTERMEDIATE_FORMATS with "intermediate",
+	and can override its write node knobs with "intermediate_knobs".
+	Formats without it use png when their ext is .png.  Formats with
+	encode_lut always get the deep bit depth, whatever their knobs say.
+
+	Returns:
+		dict - The intermediate, or None if the format is not encoded.
+
+	Raises:
+		EncodeProfileException : The intermediate is unknown.
+
+	"""
+	name = formatinfo.get("intermediate")
+	if name is None:
+		if formatinfo.get("ext") != ".png":
+			return None
+		name = "png"
+	if name not in INTERMEDIATE_FORMATS:
+		raise EncodeProfileException("Unknown intermediate {0}, expected one of {1}".format(
+			name,
+			", ".join(sorted(INTERMEDIATE_FORMATS))
+		))
+	intermediate = copy.deepcopy(INTERMEDIATE_FORMATS[name])
+	intermediate["name"] = name
+	intermediate["knobs"].update(formatinfo.get("intermediate_knobs") or {})
+	deepKnobs = intermediate.pop("deepKnobs")
+	deepBytesPerPixel = intermediate.pop("deepBytesPerPixel")
+	if formatinfo.get("encode_lut"):
+		intermediate["knobs"].update(deepKnobs)
+		intermediate["bytesPerPixel"] = deepBytesPerPixel
+	return intermediate
+
+def isEncoded(formatinfo):
+	""" Returns True if the frames of a format are encoded to movies when
+	the blast runs ffmpeg.
+	"""
+	return bool(formatinfo.get("runffmpeg") and getIntermediate(formatinfo) is not None)
+
+def getFrameExt(formatinfo, inputPath):
+	""" Returns the extension a format renders with.  Encoded formats use
+	their intermediate, and formats without an ext take the input's.
+	"""
+	intermediate = getIntermediate(formatinfo)
+	if intermediate:
+		return intermediate["ext"]
+	return formatinfo.get("ext") or os.path.splitext(inputPath)[1]
+
+def getFilterPath(path):
+	""" Returns the path quoted for an ffmpeg filter option. """
+	path = path.replace("\\", "/").replace(":", "\\:")
+	return "'{0}'".format(path.replace("'", "'\\''"))
+
+def getSequenceInput(filesequence, startFrame, fps=DEFAULT_FPS):
+	""" Returns the ffmpeg input arguments reading a %04d image sequence. """
+	return [
+		"-start_number", str(startFrame),
+		"-framerate", str(fps),
+		"-f", "image2",
+		"-i", filesequence,
+	]
+
+def getPipeInput(fps=DEFAULT_FPS, codec="png"):
+	""" Returns the ffmpeg input arguments reading frames piped to stdin. """
+	return [
+		"-f", "image2pipe",
+		"-vcodec", codec,
+		"-framerate", str(fps),
+		"-i", "-",
+	]
+
+def getFilterGraph(outputs, lutFile=None):
+	""" Returns the filter graph splitting the decoded frames between the
+	outputs, with the output of every encode labeled [v0], [v1]...
+	"""
+	shared = ["lut3d=file={0}".format(getFilterPath(lutFile))] if lutFile else []
+	chains = []
+	for output in outputs:
+		chain = []
+		if output.get("scale"):
+			chain.append("scale={0}".format(output["scale"]))
+		if output.get("pix_fmt"):
+			chain.append("format={0}".format(output["pix_fmt"]))
+		chains.append(chain or ["null"])
+	if len(outputs) == 1:
+		return "[0:v]{0}[v0]".format(",".join(shared + chains[0]))
+	graph = ["[0:v]{0}{1}".format(
+		",".join(shared + ["split={0}".format(len(outputs))]),
+		"".join("[s{0}]".format(index) for index in range(len(outputs)))
+	)]
+	for index, chain in enumerate(chains):
+		graph.append("[s{0}]{1}[v{0}]".format(index, ",".join(chain)))
+	return ";".join(graph)
+
+def buildEncodeCommand(executable, inputArgs, outputs, audio=None, lutFile=None, fps=DEFAULT_FPS):
+	""" Build the ffmpeg command writing every output from a single decode.
+
+	Args:
+		executable(str) : The ffmpeg executable.
+		inputArgs(list) : Arguments reading the frames, see getSequenceInput
+			and getPipeInput.
+		outputs(list) : The encodes, see getEncodeOutputs.
+		audio(str) : Optional audio file muxed into every output.
+		lutFile(str) : Optional cube LUT applied before the split.
+		fps(float) : Frame rate of the movies.
+
+	Returns:
+		list - The command arguments.
+
+	"""
+	cmdArgs = [executable, "-y"] + list(inputArgs)
+	if audio:
+		cmdArgs.extend(["-i", audio])
+	cmdArgs.extend(["-filter_complex", getFilterGraph(outputs, lutFile)])
+	for index, output in enumerate(outputs):
+		cmdArgs.extend(["-map", "[v{0}]".format(index)])
+		if audio:
+			cmdArgs.extend(["-map", "1:a"])
+		cmdArgs.extend(["-f", output["format"]])
+		cmdArgs.extend(output["args"])
+		cmdArgs.extend(["-r", str(fps), output["path"]])
+	return cmdArgs
@@ -0,0 +1,84 @@
+# =============================================================================
+# Blast - File utils
+# Directory creation and file replacement that are safe when several blasts
+# write the same paths at once.
+# =============================================================================
+import os
+import sys
+import threading
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+# MoveFileEx flags
+MOVEFILE_REPLACE_EXISTING = 0x1
+MOVEFILE_WRITE_THROUGH = 0x8
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def makeDirs(path):
+	""" Create a directory and its parents if they do not exist.  Another
+	blast creating it at the same time is not an error.
+
+	Returns:
+		str - The directory.
+
+	"""
+	if not os.path.exists(path):
+		try:
+			os.makedirs(path)
+		except OSError:
+			if not os.path.isdir(path):
+				raise
+	return path
+
+def getTempPath(path):
+	""" Returns a temporary name next to path, unique to this process and
+	thread.
+	"""
+	return "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+
+def toUnicodePath(path):
+	if isinstance(path, unicode):
+		return path
+	return path.decode(sys.getfilesystemencoding() or "utf-8")
+
+def replaceFile(source, destination):
+	""" Move source over destination in a single step, so readers of
+	destination see either the old file or the new one and never a missing
+	file.
+
+	os.rename will not replace an existing file on Windows, where MoveFileEx
+	is used instead.
+
+	Raises:
+		OSError : The file could not be moved.
+
+	"""
+	if os.name != "nt":
+		os.rename(source, destination)
+		return
+	import ctypes
+	flags = MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH
+	if not ctypes.windll.kernel32.MoveFileExW(toUnicodePath(source), toUnicodePath(destination), flags):
+		raise ctypes.WinError()
+
+def writeFile(path, data):
+	""" Write data aside and move it over path, so readers never see a half
+	written file.
+
+	Args:
+		path(str) : The file to write.
+		data(str) : Its contents.
+
+	"""
+	tempPath = getTempPath(path)
+	try:
+		with open(tempPath, "w") as fileinfo:
+			fileinfo.write(data)
+		replaceFile(tempPath, path)
+	except (IOError, OSError):
+		if os.path.exists(tempPath):
+			os.remove(tempPath)
+		raise
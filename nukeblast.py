@@ -3,20 +3,29 @@
 # One item
 # Another item
 # =============================================================================
+import contextlib
 import json
 import os
 import tempfile
 import subprocess
 import re
+import time
+import uuid
 
 from blurdev.action import *
 from blur3d.actions.farm import FarmAction, Services
 
-import blurdev
-import blursg
-from trax.api import data
+# Shot and Asset are needed to declare the action's properties.  The rest of
+# trax, and the Shotgun and cache modules, are imported where they are used
+# so creating the action stays cheap.
+from trax.api.data import Shot, Asset
 
-from trax.api.data import Shot, Asset, Software, FileType, File
+import blastprefs
+import blastworker
+from blasttiming import BlastTimer
+import encodeprofiles
+import processlog
+from sequenceindex import indexSequence
 
 # =============================================================================
 # EXCEPTIONS
@@ -24,6 +33,16 @@ from trax.api.data import Shot, Asset, Software, FileType, File
 class BlastExecutionException(subprocess.CalledProcessError):
 	pass
 
+class BlastPreflightException(Exception):
+	pass
+
+# =============================================================================
+# GLOBALS
+# =============================================================================
+# Blast prefs directory and its _virtual_project fallback keyed by project
+# name, resolved once per session.
+_prefsPaths = {}
+
 # =============================================================================
 # CLASSES
 # =============================================================================
@@ -62,6 +81,14 @@ class RunNukeBlast(FarmAction):
 	def createSlate(self):
 		pass
 
+	@argproperty(atype=bool, default=False)
+	def farmGraph(self):
+		""" Submit the blast as per format render tasks, split into
+		render_chunks frame chunks, instead of running it all on one farm
+		slot.  The last chunk of a format to finish encodes its movie.
+		"""
+		pass
+
 	@argproperty(atype=basestring, default="")
 	def filetype(self):
 		""" This is the file type that is used with this particular action."""
@@ -83,6 +110,32 @@ class RunNukeBlast(FarmAction):
 	def noLUT(self):
 		pass
 
+	@argproperty(atype=int, default=2)
+	def encodeThreads(self):
+		""" Number of format encodes allowed to run at once. """
+		pass
+
+	@argproperty(atype=bool, default=False)
+	def incremental(self):
+		""" Only re-render the frames whose source frame or render settings
+		changed since the last blast to the same output.
+		"""
+		pass
+
+	@argproperty(atype=bool, default=False)
+	def usePlateCache(self):
+		""" Read the input plates from a local copy, which is kept between
+		blasts so only changed frames are copied again.
+		"""
+		pass
+
+	@argproperty(atype=bool, default=False)
+	def writeBehind(self):
+		""" Render to a local directory and publish the outputs to the output
+		path in the background, instead of having Nuke write to the network.
+		"""
+		pass
+
 	@argproperty(atype=basestring, default="")
 	def inputFilepath(self):
 		"""
@@ -106,6 +159,11 @@ class RunNukeBlast(FarmAction):
 		""" Out frame """
 		pass
 
+	@argproperty(atype=bool, default=False)
+	def multiFormat(self):
+		""" Render compatible formats together in a single Nuke pass. """
+		pass
+
 	@argproperty(atype=str, default="")
 	def name(self):
 		""" Client name for the burn-in/slate. """
@@ -140,11 +198,34 @@ class RunNukeBlast(FarmAction):
 		""" ** TO BE DEPRECATED ** """
 		pass
 
+	@argproperty(atype=bool, default=True)
+	def preflight(self):
+		""" Check the input sequence for missing and truncated frames before
+		Nuke is launched.  Problems are printed as warnings unless
+		strictPreflight is set.
+		"""
+		pass
+
+	@argproperty(atype=bool, default=False)
+	def strictPreflight(self):
+		""" Fail the blast when the preflight finds missing or truncated
+		frames, before any Nuke time is spent.
+		"""
+		pass
+
 	@argproperty(atype=basestring, default="")
 	def preset(self):
 		""" This is an override for allowing to blast based off presets."""
 		pass
 
+	@argproperty(atype=bool, default=False)
+	def reopenScript(self):
+		""" Save, close and reopen the comp before rendering every format
+		instead of reverting the edits in place.  Slower, but some comps only
+		evaluate correctly from a freshly opened script.
+		"""
+		pass
+
 	@argproperty(atype=bool, default=False)
 	def marketing(self):
 		""" **TO BE DEPRECATED** """
@@ -155,6 +236,33 @@ class RunNukeBlast(FarmAction):
 		""" Priority for assfreezer. """
 		pass
 
+	@argproperty(atype=bool, default=False)
+	def streamEncode(self):
+		""" Pipe the rendered frames of movie formats straight into ffmpeg
+		instead of writing the image sequence to the output directory.
+		"""
+		pass
+
+	@argproperty(atype=bool, default=False)
+	def overlapEncode(self):
+		""" Encode movie formats while their frames are still rendering. """
+		pass
+
+	@argproperty(atype=bool, default=False)
+	def useRenderCache(self):
+		""" Reuse the outputs of a previous blast with the same inputs instead
+		of rendering again.
+		"""
+		pass
+
+	@argproperty(atype=bool, default=False)
+	def useWorker(self):
+		""" Send the blast to a running blast worker (run.py --worker) when
+		one is available instead of launching a new Nuke process.  Off by
+		default, the worker must be started by the same user.
+		"""
+		pass
+
 	@argproperty(atype=Shot, default=Shot())
 	def shot(self):
 		""" The shot for the current blast. """
@@ -167,6 +275,7 @@ class RunNukeBlast(FarmAction):
 
 	def getApplicationExecutable(self, application=None):
 		""" Returns the application. """
+		from trax.api.data import Software
 		application = application or self.application
 		executables = {}
 		s = Software.recordByName('Nuke 9.0')
@@ -177,19 +286,28 @@ class RunNukeBlast(FarmAction):
 		""" Returns the file path to the projects blast prefs files. """
 		if not self.project.isRecord():
 			return ""
-		aType = data.AssetType.recordByName("Project")
-		fType = data.FileType.recordByAssetTypeAndId(aType, "Blast::Prefs")
-		prefsPath = fType.fullPath(self.project)
+		projectName = str(self.project.name())
+		if projectName not in _prefsPaths:
+			from trax.api import data
+			aType = data.AssetType.recordByName("Project")
+			fType = data.FileType.recordByAssetTypeAndId(aType, "Blast::Prefs")
+			_prefsPaths[projectName] = (
+				fType.fullPath(self.project),
+				fType.fullPath(data.Project.recordByName('_virtual_project')),
+			)
+		prefsPath, virtualPrefsPath = _prefsPaths[projectName]
 		if not os.path.exists(prefsPath):
 			# Use the prefs stored in _virtual_project as a default to fall back on
-			# if the current project doesn't have a prefs file.
-			prefsPath = fType.fullPath(data.Project.recordByName('_virtual_project'))
+			# if the current project doesn't have a prefs file.  This is checked
+			# every time so prefs added to the project are picked up.
+			return virtualPrefsPath
 		return prefsPath
 
 	def getNukeProjectPath(self):
 		""" Returns the file path to the projects nuke template files. """
 		if not self.project.isRecord():
 			return ""
+		from trax.api import data
 		aType = data.AssetType.recordByName("Project")
 		fType = data.FileType.recordByAssetTypeAndId(aType, "Blast::Nuke")
 		nukeProjectPath = fType.fullPath(self.project)
@@ -197,6 +315,7 @@ class RunNukeBlast(FarmAction):
 
 	def getCompVariationFile(self):
 		""" Retrieve the comp variation file. """
+		from trax.api.data import FileType, File
 		shotCompFileType = FileType.recordByUniqueId("Shot::Composition")
 		tCompFile = File.findLatestVersionByElementAndFileType(
 			self.shot,
@@ -237,20 +356,75 @@ class RunNukeBlast(FarmAction):
 			None
 
 		Raises:
-			None
+			BlastPrefsException : If the project prefs are missing or invalid.
+			BlastPreflightException : If strictPreflight is set and the input
+				sequence is incomplete.
+
+		"""
+		if self.application == Apps.Nuke:
+			if self.farmGraph:
+				return self.submitFarmGraph()
+			timer = BlastTimer()
+			tempDir = tempfile.mkdtemp()
+			pickleFile = os.path.join(tempDir, 'action.pickle')
+			self.pickle(pickleFile)
+			with timer.span("getBlastArgs"):
+				blastArgs = self.getBlastArgs()
+			if self.useRenderCache:
+				with timer.span("fetchCachedBlast"):
+					cached = self.fetchCachedBlast(blastArgs, self.output.replace("\\", "/"))
+				if cached is not None:
+					return (0, "Reused cached blast outputs:\n" + "\n".join(cached))
+			# Hand the client side timings to run.py for the blast report
+			spansPath = os.path.join(tempDir, "clientspans.json")
+			timer.save(spansPath)
+			blastArgs.extend(["--clientspans", spansPath])
+			cmdArgs = [
+				self.getApplicationExecutable(),
+				'-t',
+				os.path.join(os.path.dirname(__file__), "run.py"),
+			] + blastArgs
+			if self.useWorker and blastworker.isWorkerAvailable():
+				# The worker already has Nuke loaded
+				rc, output, error = blastworker.sendJob(blastArgs)
+				print output
+			else:
+				print " ".join(cmdArgs)
+				# The output is printed as it arrives
+				rc, output, error = self.runProcess(cmdArgs)
+			if rc != 0:
+				print error
+				raise BlastExecutionException(rc, " ".join(cmdArgs), error)
+			else:
+				return (rc, output)
+		else:
+			raise NotImplementedError(
+				"Build Process is not implemented for {0}.".format(
+					str(self.application),
+				)
+			)
+
+	def getBlastArgs(self):
+		""" Builds the run.py arguments for the blast.
+
+		Returns:
+			list - The arguments, starting with the comp to open.
+
+		Raises:
+			BlastPrefsException : If the project prefs are missing or invalid.
+			BlastPreflightException : If strictPreflight is set and the input
+				sequence is incomplete.
 
 		"""
 		self.setArgsFromPresets()
 		# Prefs and Nuke files stored in a blast location
 		prefsPath = self.getProjectPrefs()
 		nukeProjectPath = self.getNukeProjectPath()
-		nukeFilesJsonPath = os.path.normpath(
-			os.path.join(prefsPath, "nukefiles.json")
-		)
-		with open(nukeFilesJsonPath, "r") as fileinfo:
-			filesdata = fileinfo.read()
-		nukefiles = json.loads(filesdata)
 		self.overrideFileType()
+		nukefiles = blastprefs.loadNukeFiles(
+			os.path.join(prefsPath, "nukefiles.json"),
+			self.filetype
+		)
 		nukeComp = None
 		# If provided an override comp variation,
 		# Attempt to find the comp file and use it.
@@ -272,91 +446,266 @@ class RunNukeBlast(FarmAction):
 				filename = self.outputFilename
 		else:
 			filename = os.path.splitext(os.path.basename(self.inputFilepath))[0]
-		if self.application == Apps.Nuke:
-			tempDir = tempfile.mkdtemp()
-			pickleFile = os.path.join(tempDir, 'action.pickle')
-			self.pickle(pickleFile)
-			inputFilepath = self.inputFilepath.replace("\\", "/")
-			output = self.output.replace("\\", "/")
-			cmdArgs = [
-				self.getApplicationExecutable(),
-				'-t',
-				os.path.join(os.path.dirname(__file__), "run.py"),
-				nukeComp,
-				'--file',
-				inputFilepath,
-				'--filename',
-				filename,
-				'--output',
-				output,
-				'--framein',
-				str(self.framein),
-				'--frameout',
-				str(self.frameout),
-				'--formatsfile',
-				str(os.path.join(prefsPath, "formats.json")),
-			]
-			if self.notes:
-				cmdArgs.extend(["--notes", self.notes])
-			if self.artistName:
-				cmdArgs.extend(["--artist", self.artistName])
-			if self.name:
-				cmdArgs.extend(["--clientShotName", self.name])
-			if self.version:
-				cmdArgs.extend(["--version", self.version])
-			if self.shot.isRecord():
-				cmdArgs.extend(["--shot", str(self.shot.displayName()).replace(" ", "_")])
-			if self.asset.isRecord():
-				cmdArgs.extend(["--asset", str(self.asset.displayName())])
-			if self.project.isRecord():
-				cmdArgs.extend(["--project", str(self.project.name())])
-			# If no formats are present, use the default
-			if not self.formats:
-				self.formats = "DEFAULT"
-			cmdArgs.append('--formats')
-			cmdArgs.extend(self.formats.split(' '))
-			if self.createSlate:
-				cmdArgs.append('--createSlate')
-			if self.noLUT:
-				cmdArgs.append('--nolut')
-			if self.noCDL:
-				cmdArgs.append('--nocdl')
-			if self.applyDistortion:
-				cmdArgs.append('--applyDistortion')
-			if self.applyUndistortion:
-				cmdArgs.append('--applyUndistortion')
-			if self.applyPostmove:
-				cmdArgs.append('--applyPostmove')
-			if self.noAudio:
-				cmdArgs.append('--noaudio')
-			cmdArgs.append('--runffmpeg')
-			print " ".join(cmdArgs)
-			# Ensure we don't get a DOS window popping up when shelling
-			# to python.
-			flags = subprocess.STARTUPINFO()
-			flags.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-			response = subprocess.Popen(
-				cmdArgs,
-				stdin=subprocess.PIPE,
-				stdout=subprocess.PIPE,
-				stderr=subprocess.PIPE,
-				startupinfo=flags,
-				shell=True,
-			)
-			output, error = response.communicate()
-			rc = response.returncode
-			if rc != 0:
-				print error
-				raise BlastExecutionException(rc, " ".join(cmdArgs), error)
-			else:
-				print output
-				return (rc, output)
-		else:
-			raise NotImplementedError(
-				"Build Process is not implemented for {0}.".format(
-					str(self.application),
+		inputFilepath = self.inputFilepath.replace("\\", "/")
+		output = self.output.replace("\\", "/")
+		args = [
+			nukeComp,
+			'--file',
+			inputFilepath,
+			'--filename',
+			filename,
+			'--output',
+			output,
+			'--framein',
+			str(self.framein),
+			'--frameout',
+			str(self.frameout),
+			'--formatsfile',
+			str(os.path.join(prefsPath, "formats.json")),
+		]
+		if self.notes:
+			args.extend(["--notes", self.notes])
+		if self.artistName:
+			args.extend(["--artist", self.artistName])
+		if self.name:
+			args.extend(["--clientShotName", self.name])
+		if self.version:
+			args.extend(["--version", self.version])
+		if self.shot.isRecord():
+			args.extend(["--shot", self.getShotCode()])
+		if self.asset.isRecord():
+			args.extend(["--asset", str(self.asset.displayName())])
+		if self.project.isRecord():
+			args.extend(["--project", str(self.project.name())])
+		if self.preflight:
+			inputRange = self.preflightInput()
+			if inputRange:
+				# Saves Nuke probing the range of the read node
+				args.extend(["--inputrange", str(inputRange[0]), str(inputRange[1])])
+		# If no formats are present, use the default
+		if not self.formats:
+			self.formats = "DEFAULT"
+		# Reject bad formats before paying for a Nuke launch
+		blastprefs.loadFormats(
+			os.path.join(prefsPath, "formats.json"),
+			self.formats.split(' ')
+		)
+		args.append('--formats')
+		args.extend(self.formats.split(' '))
+		if self.createSlate:
+			args.append('--createSlate')
+		if self.noLUT:
+			args.append('--nolut')
+		if self.noCDL:
+			args.append('--nocdl')
+		if self.applyDistortion:
+			args.append('--applyDistortion')
+		if self.applyUndistortion:
+			args.append('--applyUndistortion')
+		if self.applyPostmove:
+			args.append('--applyPostmove')
+		if self.noAudio:
+			args.append('--noaudio')
+		if self.multiFormat:
+			args.append('--multiformat')
+		if self.reopenScript:
+			args.append('--reopen')
+		if self.streamEncode:
+			args.append('--streamencode')
+		if self.overlapEncode:
+			args.append('--overlapencode')
+		args.extend(['--encodethreads', str(self.encodeThreads)])
+		if self.useRenderCache:
+			args.append('--rendercache')
+		if self.incremental:
+			args.append('--incremental')
+		if self.usePlateCache:
+			args.append('--platecache')
+		if self.writeBehind:
+			args.append('--writebehind')
+		args.append('--runffmpeg')
+		return args
+
+	def preflightInput(self):
+		""" Check the input sequence on disk in a single directory pass.
+
+		Blasts without a frame range render the range found on disk.
+
+		Returns:
+			tuple - The (first, last) frames on disk, or None if the input
+			is not a #### sequence or has no frames.
+
+		Raises:
+			BlastPreflightException : If strictPreflight is set and frames
+				the blast needs are missing or truncated.
+
+		"""
+		index = indexSequence(self.inputFilepath)
+		if index is None:
+			return None
+		first, last = None, None
+		if self.framein or self.frameout:
+			first, last = self.framein, self.frameout
+		problems = index.getProblems(first, last)
+		if problems:
+			if self.strictPreflight:
+				raise BlastPreflightException("\n".join(problems))
+			for problem in problems:
+				print "Warning: {0}".format(problem)
+		if not index.frames:
+			return None
+		return (index.first, index.last)
+
+	def getShotCode(self):
+		""" Returns the shot code used by run.py and Shotgun. """
+		return str(self.shot.displayName()).replace(" ", "_")
+
+	def getFarmTasks(self):
+		""" Expand the blast into farm tasks.
+
+		Every format gets its own render tasks, one per frame chunk.  The
+		tasks need no dependencies between them: the last chunk of an encoded
+		format to finish runs the encode, see run.claimEncode.
+
+		Returns:
+			list - The tasks in submission order.
+
+		"""
+		blastArgs = self.getBlastArgs()
+		formats = blastprefs.loadFormats(
+			os.path.join(self.getProjectPrefs(), "formats.json"),
+			self.formats.split(' ')
+		)
+		from rendercache import parseArgList
+		options = parseArgList(blastArgs)
+		comp = options.pop(None)[0]
+		# Each task renders one chunk of one format.  Chunks rendering side by
+		# side can not share a manifest.
+		for flag in ["--formats", "--rendercache", "--incremental", "--renderonly", "--chunk", "--farmjob"]:
+			options.pop(flag, None)
+		sharedArgs = [comp]
+		for flag, values in options.iteritems():
+			sharedArgs.append(flag)
+			sharedArgs.extend(values)
+		sharedArgs.extend(["--renderonly", "--farmjob", uuid.uuid4().hex])
+		settings = self.getFarmTaskSettings()
+		tasks = []
+		for formatname in self.formats.split(' '):
+			formatinfo = formats[formatname]
+			chunks = int(formatinfo.get("render_chunks", 1))
+			# A movie can only be written by a single process
+			if encodeprofiles.getFrameExt(formatinfo, self.inputFilepath) == ".mov":
+				chunks = 1
+			for index in range(chunks):
+				renderTask = RunNukeBlastRender(
+					blastArgs=sharedArgs + [
+						"--formats", formatname,
+						"--chunk", "{0}/{1}".format(index, chunks),
+					],
+					shot=self.shot,
+					asset=self.asset,
+					**settings
 				)
+				tasks.append(renderTask)
+		return tasks
+
+	def getFarmTaskSettings(self):
+		""" Returns the submission settings every task of a farm graph blast
+		takes from the blast.
+		"""
+		return {
+			"project" : self.project,
+			"priority" : self.priority,
+		}
+
+	def submitFarmGraph(self):
+		""" Submit the blast as per format, per chunk farm tasks.
+
+		Returns:
+			tuple - (returncode, output)
+
+		"""
+		tasks = self.getFarmTasks()
+		for task in tasks:
+			task.submit()
+		output = "Submitted {0} blast tasks".format(len(tasks))
+		print output
+		return (0, output)
+
+	def fetchCachedBlast(self, args, output):
+		""" Link the outputs of a previous blast with the same fingerprint
+		into the output directory.
+
+		Args:
+			args(list) : The run.py arguments of the blast.
+			output(str) : The blast output directory.
+
+		Returns:
+			list - The reused files, or None if the blast has to run.
+
+		"""
+		from rendercache import BlastFingerprint, RenderCache
+		from sgcache import ShotgunCache
+		from sgresolver import ShotgunResolver
+		versions = {}
+		if self.shot.isRecord() and self.project.isRecord():
+			resolver = ShotgunResolver(
+				str(self.project.name()),
+				self.getShotCode(),
+				cache=ShotgunCache()
 			)
+			versions = resolver.resolve()
+		fingerprint = BlastFingerprint(args, versions)
+		return RenderCache().fetch(fingerprint.getDigest(), output)
+
+	def getLogPath(self):
+		""" Returns the log of the blast process.  Its frame progress is
+		written alongside it, see processlog.getProgressPath.
+		"""
+		name = self.getShotCode() if self.shot.isRecord() else type(self).__name__
+		return os.path.join(
+			processlog.getLogDir(),
+			"{0}_{1}_{2}.log".format(name, os.getpid(), int(time.time()))
+		)
+
+	def runProcess(self, cmdArgs):
+		""" Launch a new Nuke process for the blast.
+
+		The output is printed and logged as it arrives, only its last lines
+		are returned.
+
+		Returns:
+			tuple - (returncode, output, error)
+
+		"""
+		# Ensure we don't get a DOS window popping up when shelling
+		# to python.
+		flags = subprocess.STARTUPINFO()
+		flags.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+		return processlog.runStreamed(
+			cmdArgs,
+			self.getLogPath(),
+			stdin=subprocess.PIPE,
+			startupinfo=flags,
+			shell=True,
+		)
+
+	def runBlastProcess(self, cmdArgs):
+		""" Run a blast process, raising if it fails.
+
+		Returns:
+			tuple - (returncode, output)
+
+		Raises:
+			BlastExecutionException : If the process failed.
+
+		"""
+		print " ".join(cmdArgs)
+		rc, output, error = self.runProcess(cmdArgs)
+		if rc != 0:
+			print error
+			raise BlastExecutionException(rc, " ".join(cmdArgs), error)
+		return (rc, output)
 
 	@executehook(Apps.XSI)
 	def launchFromXSIAndRunComp(self):
@@ -379,12 +728,7 @@ class RunNukeBlast(FarmAction):
 		if not self.preset:
 			return
 		prefsPath = self.getProjectPrefs()
-		presetsPath = os.path.normpath(
-			os.path.join(prefsPath, "presets.json")
-		)
-		with open(presetsPath, "r") as fileinfo:
-			filesdata = fileinfo.read()
-		presets = json.loads(filesdata)
+		presets = blastprefs.loadPresets(os.path.join(prefsPath, "presets.json"))
 		presetSettings = presets.get(self.preset)
 		if presetSettings:
 			# Attempt to eval the value if possible
@@ -395,3 +739,139 @@ class RunNukeBlast(FarmAction):
 					setattr(self, attr, value)
 				except (NameError, SyntaxError) as e:
 					setattr(self, attr, str(value))
+
+
+class RunNukeBlastBatch(RunNukeBlast):
+	""" Blasts many shots from a single Nuke process.
+
+	Every record in blasts overrides attributes of this action for one shot,
+	the rest of the settings are shared.  The Shotgun data for all of the
+	shots is fetched in bulk up front and a failing shot does not stop the
+	others from blasting.
+	"""
+	@argproperty(atype=list, default=[])
+	def blasts(self):
+		""" Mappings of attribute to value for each shot, such as shot,
+		inputFilepath, output and version.
+		"""
+		pass
+
+	def run(self):
+		""" Builds the arguments for every shot and blasts them in one Nuke
+		process.
+
+		Returns:
+			tuple - (returncode, output)
+
+		Raises:
+			BlastExecutionException : If any of the shots failed.
+
+		"""
+		if self.application != Apps.Nuke:
+			raise NotImplementedError(
+				"Build Process is not implemented for {0}.".format(
+					str(self.application),
+				)
+			)
+		self.prefetchShotgun()
+		results = []
+		batchArgs = []
+		for record in self.blasts:
+			try:
+				blastArgs = self.getRecordArgs(record)
+			except Exception as e:
+				results.append((1, "", "Unable to build blast for {0}: {1}".format(record, e)))
+				continue
+			if self.useRenderCache:
+				with self.recordAttributes(record):
+					cached = self.fetchCachedBlast(blastArgs, self.output.replace("\\", "/"))
+				if cached is not None:
+					results.append((0, "Reused cached blast outputs:\n" + "\n".join(cached), ""))
+					continue
+			batchArgs.append(blastArgs)
+		if batchArgs:
+			if self.useWorker and blastworker.isWorkerAvailable():
+				for blastArgs in batchArgs:
+					results.append(blastworker.sendJob(blastArgs))
+			else:
+				results.append(self.runBatchProcess(batchArgs))
+		rc = max([result[0] for result in results] or [0])
+		output = "\n".join(result[1] for result in results if result[1])
+		error = "\n".join(result[2] for result in results if result[2])
+		if rc != 0:
+			print error
+			raise BlastExecutionException(rc, "Blast batch", error)
+		print output
+		return (rc, output)
+
+	def getRecordArgs(self, record):
+		""" Returns the run.py arguments for one record of the batch. """
+		with self.recordAttributes(record):
+			return self.getBlastArgs()
+
+	@contextlib.contextmanager
+	def recordAttributes(self, record):
+		""" Apply a record's attributes to the action, restoring the shared
+		settings afterwards.
+		"""
+		# Blasts fill in the filetype and formats they resolve, so those
+		# are restored as well.
+		saved = {}
+		for attr in set(record.keys() + ["filetype", "formats"]):
+			saved[attr] = getattr(self, attr)
+		try:
+			for attr, value in record.iteritems():
+				setattr(self, attr, value)
+			yield self
+		finally:
+			for attr, value in saved.iteritems():
+				setattr(self, attr, value)
+
+	def prefetchShotgun(self):
+		""" Resolve the Shotgun data of every shot in the batch at once. """
+		from sgcache import ShotgunCache
+		from sgresolver import ShotgunResolver
+		if not self.project.isRecord():
+			return
+		shots = []
+		for record in self.blasts:
+			shot = record.get("shot", self.shot)
+			if shot.isRecord():
+				shots.append(str(shot.displayName()).replace(" ", "_"))
+		ShotgunResolver.prefetch(str(self.project.name()), shots, ShotgunCache())
+
+	def runBatchProcess(self, batchArgs):
+		""" Launch one Nuke process that blasts every shot in turn.
+
+		Returns:
+			tuple - (returncode, output, error)
+
+		"""
+		batchFile = os.path.join(tempfile.mkdtemp(), "batch.json")
+		with open(batchFile, "w") as fileinfo:
+			fileinfo.write(json.dumps({"blasts" : batchArgs}))
+		cmdArgs = [
+			self.getApplicationExecutable(),
+			'-t',
+			os.path.join(os.path.dirname(__file__), "run.py"),
+			'--batch',
+			batchFile,
+		]
+		print " ".join(cmdArgs)
+		return self.runProcess(cmdArgs)
+
+
+
+class RunNukeBlastRender(RunNukeBlast):
+	""" Farm task rendering one chunk of one format of a farm graph blast. """
+	@argproperty(atype=list, default=[])
+	def blastArgs(self):
+		""" The run.py arguments of the task. """
+		pass
+
+	def run(self):
+		return self.runBlastProcess([
+			self.getApplicationExecutable(),
+			'-t',
+			os.path.join(os.path.dirname(__file__), "run.py"),
+		] + self.blastArgs)
@@ -0,0 +1,199 @@
+# =============================================================================
+# Blast - Plate cache
+# Local read-through copy of the input plates.  The frames a blast reads are
+# copied from network storage in parallel, and later blasts of the same shot
+# only copy the frames that changed.
+# =============================================================================
+import hashlib
+import json
+import os
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
+
+from fileutils import getTempPath, makeDirs, replaceFile, writeFile
+from rendercache import getFileStats
+from sequenceindex import FRAME_TOKEN, indexSequence
+from sgcache import getCacheDir
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+DEFAULT_MAX_BYTES = int(os.environ.get("BLAST_PLATE_CACHE_SIZE", 100 * 1024 ** 3))
+
+# Frames copied at once.  Network storage serves parallel reads much faster
+# than a single stream.
+DEFAULT_THREADS = int(os.environ.get("BLAST_PLATE_CACHE_THREADS", 8))
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+class PlateCache(object):
+	""" Local store of input plate frames, one entry per source sequence.
+
+	Every entry records the size and modification time of the frames it
+	copied, so a frame is copied again only when the source changes.
+	Entries are evicted least recently used first once the store grows past
+	maxBytes.
+
+	Args:
+		path(str) : Location of the store.  Defaults to the blast cache dir.
+		maxBytes(int) : Size the store is trimmed down to.
+		threads(int) : Number of frames copied at once.
+
+	"""
+	def __init__(self, path=None, maxBytes=DEFAULT_MAX_BYTES, threads=DEFAULT_THREADS):
+		self.path = path or os.path.join(getCacheDir(), "plates")
+		self.maxBytes = maxBytes
+		self.threads = threads
+		self.lock = threading.Lock()
+		# Local patterns of the sequences fetched by this process
+		self.fetched = {}
+		self.hits = 0
+		self.copies = 0
+		self.copiedBytes = 0
+		makeDirs(self.path)
+
+	def getEntryDir(self, pattern):
+		source = os.path.normcase(pattern.replace("\\", "/"))
+		return os.path.join(self.path, hashlib.sha1(source).hexdigest())
+
+	def getManifestPath(self, entryDir):
+		return os.path.join(entryDir, "manifest.json")
+
+	def loadManifest(self, entryDir):
+		try:
+			with open(self.getManifestPath(entryDir), "r") as fileinfo:
+				return json.loads(fileinfo.read())
+		except (IOError, ValueError):
+			return {"frames" : {}, "size" : 0}
+
+	def saveManifest(self, entryDir, manifest):
+		writeFile(self.getManifestPath(entryDir), json.dumps(manifest))
+
+	def fetch(self, pattern, frames=None):
+		""" Make the frames of a #### sequence available locally.
+
+		Args:
+			pattern(str) : The source sequence, such as //server/A_0010.####.exr
+			frames(list) : Frames to copy.  Every frame on disk by default.
+
+		Returns:
+			str - The pattern of the local copy, or the source pattern if the
+			sequence could not be cached.
+
+		"""
+		if not pattern or FRAME_TOKEN not in os.path.basename(pattern):
+			return pattern
+		key = (pattern, tuple(frames) if frames is not None else None)
+		with self.lock:
+			if key not in self.fetched:
+				try:
+					self.fetched[key] = self.copySequence(pattern, frames)
+				except (IOError, OSError) as e:
+					print "Unable to cache {0}, reading it from the network: {1}".format(pattern, e)
+					self.fetched[key] = pattern
+			return self.fetched[key]
+
+	def copySequence(self, pattern, frames):
+		""" Copy the frames of the sequence missing from its entry.
+
+		Returns:
+			str - The pattern of the local copy.
+
+		"""
+		index = indexSequence(pattern)
+		wanted = index.frames
+		if frames is not None:
+			frames = set(frames)
+			wanted = [frame for frame in wanted if frame in frames]
+		if not wanted:
+			return pattern
+		entryDir = self.getEntryDir(pattern)
+		makeDirs(entryDir)
+		manifest = self.loadManifest(entryDir)
+		manifest["source"] = pattern
+		basename = os.path.basename(pattern)
+		tasks = []
+		for frame in wanted:
+			name = basename.replace(FRAME_TOKEN, str(frame).zfill(len(FRAME_TOKEN)))
+			tasks.append((
+				name,
+				os.path.join(os.path.dirname(pattern), name),
+				os.path.join(entryDir, name),
+				manifest["frames"].get(name),
+			))
+		pool = ThreadPool(max(min(self.threads, len(tasks)), 1))
+		try:
+			results = pool.map(self.copyFrame, tasks)
+		finally:
+			pool.close()
+			pool.join()
+		for name, stats, copied in results:
+			if stats is None:
+				continue
+			manifest["frames"][name] = stats
+			if copied:
+				self.copies += 1
+				self.copiedBytes += stats[0]
+			else:
+				self.hits += 1
+		manifest["size"] = sum(stats[0] for stats in manifest["frames"].itervalues())
+		# Saving the manifest also marks the entry as recently used
+		self.saveManifest(entryDir, manifest)
+		self.evict(keep=entryDir)
+		return os.path.join(entryDir, basename).replace("\\", "/")
+
+	def copyFrame(self, task):
+		""" Copy a frame unless the local copy is up to date.
+
+		Returns:
+			tuple - (name, [size, mtime] of the source, whether it was copied).
+			The stats are None if the source frame is missing.
+
+		"""
+		name, source, destination, cachedStats = task
+		stats = getFileStats(source)
+		if stats is None:
+			return (name, None, False)
+		if stats == cachedStats and getFileStats(destination) is not None:
+			return (name, stats, False)
+		tempPath = getTempPath(destination)
+		shutil.copyfile(source, tempPath)
+		try:
+			replaceFile(tempPath, destination)
+		except OSError:
+			# Another blast copied the frame at the same time
+			if not os.path.exists(destination):
+				raise
+			os.remove(tempPath)
+		return (name, stats, True)
+
+	def evict(self, keep=None):
+		""" Remove the least recently used entries until the store fits.  The
+		entry in use is never removed.
+		"""
+		entries = []
+		total = 0
+		for name in os.listdir(self.path):
+			entryDir = os.path.join(self.path, name)
+			manifestPath = self.getManifestPath(entryDir)
+			if not os.path.exists(manifestPath):
+				continue
+			size = self.loadManifest(entryDir)["size"]
+			entries.append((os.path.getmtime(manifestPath), size, entryDir))
+			total += size
+		for lastUsed, size, entryDir in sorted(entries):
+			if total <= self.maxBytes:
+				break
+			if keep and os.path.normcase(entryDir) == os.path.normcase(keep):
+				continue
+			shutil.rmtree(entryDir, ignore_errors=True)
+			total -= size
+
+	def stats(self):
+		return "Plate cache: {0} frames reused, {1} frames copied ({2} MB)".format(
+			self.hits,
+			self.copies,
+			self.copiedBytes // (1024 * 1024)
+		)
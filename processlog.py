@@ -0,0 +1,225 @@
+# =============================================================================
+# Blast - Process log
+# Runs Nuke and ffmpeg processes with their output streamed line by line to
+# the console and a rotating log file.  Only the last lines are kept in
+# memory for error reports, and frame progress is written to a json file
+# that farm monitoring can poll.
+# =============================================================================
+import collections
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fileutils import makeDirs, replaceFile, writeFile
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+# Lines of stdout and stderr kept in memory for error reports.
+TAIL_LINES = 200
+
+# Size a log grows to before it is rotated, and number of rotated logs kept.
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+
+# Progress lines, with the frame as the first group.  Nuke prints
+# "Frame 1001 (1 of 24)" and ffmpeg "frame=  120 fps= 48 ...".
+PROGRESS_PATTERNS = [
+	("nuke", re.compile(r"^Frame (-?\d+)(?: \((\d+) of (\d+)\))?")),
+	("ffmpeg", re.compile(r"^frame=\s*(\d+)")),
+]
+
+# ffmpeg ends its progress lines with a carriage return.
+LINE_END_REGEX = re.compile(r"\r\n|\r|\n")
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def getLogDir():
+	""" Returns the directory process logs are written to, which can be set
+	with BLAST_LOG_DIR.
+	"""
+	return makeDirs(os.environ.get("BLAST_LOG_DIR") or os.path.join(tempfile.gettempdir(), "BlastLogs"))
+
+def getProgressPath(logPath):
+	""" Returns the progress file written alongside a log. """
+	return os.path.splitext(logPath)[0] + ".progress.json"
+
+def parseProgress(line):
+	""" Returns the progress event of a Nuke or ffmpeg line, or None. """
+	for source, regex in PROGRESS_PATTERNS:
+		match = regex.match(line)
+		if not match:
+			continue
+		groups = match.groups()
+		event = {"source" : source, "frame" : int(groups[0])}
+		if len(groups) == 3 and groups[1]:
+			event["done"] = int(groups[1])
+			event["total"] = int(groups[2])
+		return event
+	return None
+
+def runStreamed(cmdArgs, logPath=None, echo=True, **popenArgs):
+	""" Run a process, streaming its output instead of buffering it.
+
+	Args:
+		cmdArgs(list) : The command to run.
+		logPath(str) : The log to write, progress goes alongside it.
+		echo(bool) : Print the output as it arrives.
+		popenArgs(dict) : Extra arguments for subprocess.Popen.
+
+	Returns:
+		tuple - (returncode, output, error) with the last lines of stdout and
+		stderr.
+
+	"""
+	process = StreamedProcess(cmdArgs, logPath, echo=echo, **popenArgs)
+	# Like communicate(), send the process an empty stdin
+	if process.stdin:
+		process.stdin.close()
+	returncode = process.wait()
+	return (returncode, process.getOutput(), process.getError())
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+class RotatingLog(object):
+	""" A log file that is rotated to .1, .2... once it grows too large.
+	Lines may be written from any thread.
+	"""
+	def __init__(self, path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT):
+		self.path = path
+		self.maxBytes = maxBytes
+		self.backupCount = backupCount
+		self.lock = threading.Lock()
+		self.fileinfo = open(path, "a")
+
+	def write(self, line):
+		with self.lock:
+			if self.fileinfo is None:
+				return
+			self.fileinfo.write(line + "\n")
+			self.fileinfo.flush()
+			if self.maxBytes and self.fileinfo.tell() >= self.maxBytes:
+				self.rotate()
+
+	def rotate(self):
+		self.fileinfo.close()
+		for index in range(self.backupCount - 1, 0, -1):
+			source = "{0}.{1}".format(self.path, index)
+			if os.path.exists(source):
+				replaceFile(source, "{0}.{1}".format(self.path, index + 1))
+		if self.backupCount:
+			replaceFile(self.path, self.path + ".1")
+		self.fileinfo = open(self.path, "w")
+
+	def close(self):
+		with self.lock:
+			if self.fileinfo is not None:
+				self.fileinfo.close()
+				self.fileinfo = None
+
+class StreamedProcess(object):
+	""" A process whose stdout and stderr are read line by line on threads.
+
+	Every line is echoed and written to the log, the last lines of each
+	stream are kept for error reports and progress lines are written to the
+	progress file as they arrive.
+
+	Args:
+		cmdArgs(list) : The command to run.
+		logPath(str) : Optional log to write, progress goes alongside it.
+		tailLines(int) : Lines of each stream kept in memory.
+		echo(bool) : Print the output as it arrives.
+		popenArgs(dict) : Extra arguments for subprocess.Popen, such as stdin.
+
+	"""
+	def __init__(self, cmdArgs, logPath=None, tailLines=TAIL_LINES, echo=True, **popenArgs):
+		self.echo = echo
+		self.echoLock = threading.Lock()
+		self.log = RotatingLog(logPath) if logPath else None
+		self.progressPath = getProgressPath(logPath) if logPath else None
+		self.progress = None
+		self.started = time.time()
+		self.tails = {
+			"stdout" : collections.deque(maxlen=tailLines),
+			"stderr" : collections.deque(maxlen=tailLines),
+		}
+		if logPath:
+			print "Logging to {0}".format(logPath)
+		self.process = subprocess.Popen(
+			cmdArgs,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE,
+			**popenArgs
+		)
+		self.stdin = self.process.stdin
+		self.readers = [
+			threading.Thread(target=self.read, args=(self.process.stdout, "stdout", sys.stdout)),
+			threading.Thread(target=self.read, args=(self.process.stderr, "stderr", sys.stderr)),
+		]
+		for reader in self.readers:
+			reader.daemon = True
+			reader.start()
+
+	def read(self, stream, name, echoStream):
+		""" Read a stream until the process closes it. """
+		pending = ""
+		while True:
+			data = os.read(stream.fileno(), 65536)
+			if not data:
+				break
+			lines = LINE_END_REGEX.split(pending + data)
+			pending = lines.pop()
+			for line in lines:
+				self.addLine(line, name, echoStream)
+		if pending:
+			self.addLine(pending, name, echoStream)
+		stream.close()
+
+	def addLine(self, line, name, echoStream):
+		self.tails[name].append(line)
+		if self.log:
+			self.log.write(line)
+		if self.echo:
+			with self.echoLock:
+				echoStream.write(line + "\n")
+				echoStream.flush()
+		event = parseProgress(line.strip())
+		if event:
+			self.setProgress(event)
+
+	def setProgress(self, event):
+		event.update({
+			"pid" : self.process.pid,
+			"time" : time.time(),
+			"seconds" : time.time() - self.started,
+		})
+		self.progress = event
+		if not self.progressPath:
+			return
+		# Monitors poll the file, so they must never see it half written
+		try:
+			writeFile(self.progressPath, json.dumps(event))
+		except (IOError, OSError):
+			pass
+
+	def wait(self):
+		""" Wait for the process and its output.  Returns its return code. """
+		returncode = self.process.wait()
+		for reader in self.readers:
+			reader.join()
+		if self.log:
+			self.log.close()
+		return returncode
+
+	def getOutput(self):
+		return "\n".join(self.tails["stdout"])
+
+	def getError(self):
+		return "\n".join(self.tails["stderr"])
@@ -0,0 +1,153 @@
+# =============================================================================
+# Blast - Publisher
+# Write-behind upload of blast outputs.  Frames and movies are rendered to a
+# local directory and copied to the delivery share on background threads,
+# so the render never waits on the network.
+# =============================================================================
+import os
+import shutil
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from fileutils import getTempPath, makeDirs, replaceFile
+
+# =============================================================================
+# EXCEPTIONS
+# =============================================================================
+class PublishError(Exception):
+	pass
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+# Files uploaded at once.
+DEFAULT_THREADS = int(os.environ.get("BLAST_PUBLISH_THREADS", 4))
+
+# Attempts made after a failed upload, and seconds waited before the first
+# of them.  The wait doubles with every attempt.
+DEFAULT_RETRIES = int(os.environ.get("BLAST_PUBLISH_RETRIES", 3))
+DEFAULT_RETRY_DELAY = float(os.environ.get("BLAST_PUBLISH_RETRY_DELAY", 2.0))
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def getPublishBaseDir():
+	""" Returns the directory blasts render under before they publish, which
+	can be set with BLAST_PUBLISH_DIR.  Deliveries can be large, so this is
+	the temp directory rather than shared memory.
+	"""
+	return os.environ.get("BLAST_PUBLISH_DIR") or tempfile.gettempdir()
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+class OutputPublisher(object):
+	""" Copies files from a local directory to the same relative path under
+	the delivery directory.
+
+	Every file is copied to a temporary name next to its destination and
+	moved over it once its size matches, so readers of the delivery share
+	see either the previous file or the complete new one.  Failed copies are
+	retried, and flush blocks until every upload is done.
+
+	Args:
+		localDir(str) : The directory the blast writes to.
+		deliveryDir(str) : The directory the outputs are published to.
+		threads(int) : Number of files copied at once.
+		retries(int) : Attempts made after a failed copy.
+		retryDelay(float) : Seconds before the first retry.
+
+	"""
+	def __init__(self, localDir, deliveryDir, threads=DEFAULT_THREADS,
+			retries=DEFAULT_RETRIES, retryDelay=DEFAULT_RETRY_DELAY):
+		self.localDir = localDir
+		self.deliveryDir = deliveryDir
+		self.retries = retries
+		self.retryDelay = retryDelay
+		self.pool = ThreadPool(max(threads, 1))
+		self.lock = threading.Lock()
+		# Upload results by local path
+		self.results = {}
+		self.uploads = 0
+		self.uploadedBytes = 0
+
+	def getDeliveryPath(self, localPath):
+		relativePath = os.path.relpath(localPath, self.localDir)
+		if relativePath.startswith(os.pardir):
+			raise PublishError("{0} is not under {1}".format(localPath, self.localDir))
+		return os.path.join(self.deliveryDir, relativePath)
+
+	def publish(self, localPath):
+		""" Queue a file for upload.  Files already queued are skipped. """
+		with self.lock:
+			if localPath in self.results:
+				return
+			self.results[localPath] = self.pool.apply_async(self.upload, (localPath,))
+
+	def upload(self, localPath):
+		""" Copy a file to the delivery directory, retrying on failure.
+
+		Returns:
+			str - The published file.
+
+		Raises:
+			PublishError : Every attempt failed.
+
+		"""
+		deliveryPath = self.getDeliveryPath(localPath)
+		size = os.path.getsize(localPath)
+		tempPath = getTempPath(deliveryPath)
+		for attempt in range(self.retries + 1):
+			try:
+				makeDirs(os.path.dirname(deliveryPath))
+				shutil.copyfile(localPath, tempPath)
+				if os.path.getsize(tempPath) != size:
+					raise IOError("{0} was truncated".format(tempPath))
+				replaceFile(tempPath, deliveryPath)
+				break
+			except (IOError, OSError) as e:
+				if os.path.exists(tempPath):
+					try:
+						os.remove(tempPath)
+					except OSError:
+						pass
+				if attempt == self.retries:
+					raise PublishError("Unable to publish {0}: {1}".format(deliveryPath, e))
+				delay = self.retryDelay * 2 ** attempt
+				print "Publishing {0} failed, retrying in {1}s: {2}".format(deliveryPath, delay, e)
+				time.sleep(delay)
+		with self.lock:
+			self.uploads += 1
+			self.uploadedBytes += size
+		return deliveryPath
+
+	def flush(self):
+		""" Wait for every upload and check the published files.
+
+		Returns:
+			list - A message for every file that was not published.
+
+		"""
+		self.pool.close()
+		self.pool.join()
+		errors = []
+		for localPath, result in sorted(self.results.iteritems()):
+			try:
+				deliveryPath = result.get()
+				if os.path.getsize(deliveryPath) != os.path.getsize(localPath):
+					errors.append("{0} does not match {1}".format(deliveryPath, localPath))
+			except Exception as e:
+				errors.append(str(e))
+		return errors
+
+	def cleanup(self):
+		""" Remove the local directory once the outputs are published. """
+		shutil.rmtree(self.localDir, ignore_errors=True)
+
+	def stats(self):
+		return "Publisher: {0} files published ({1} MB)".format(
+			self.uploads,
+			self.uploadedBytes // (1024 * 1024)
+		)
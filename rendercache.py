@@ -0,0 +1,340 @@
+# =============================================================================
+# Blast - Render cache
+# Content addressed store of finished blast outputs.  A blast whose inputs
+# have not changed reuses the previous outputs instead of rendering again.
+# =============================================================================
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+import blastprefs
+from fileutils import makeDirs, writeFile
+from sgcache import getCacheDir
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+DEFAULT_MAX_BYTES = int(os.environ.get("BLAST_RENDER_CACHE_SIZE", 20 * 1024 ** 3))
+
+# run.py arguments that change how a blast runs but not what it produces.
+NON_CONTENT_ARGS = [
+	"--output",
+	"--encodethreads",
+	"--multiformat",
+	"--reopen",
+	"--streamencode",
+	"--overlapencode",
+	"--nosgcache",
+	"--rendercache",
+	"--incremental",
+	"--farmjob",
+	"--chrometrace",
+	"--clientspans",
+	"--inputrange",
+	"--platecache",
+	"--writebehind",
+]
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def getFileStats(path):
+	""" Returns the size and modification time of a file, or None. """
+	try:
+		stat = os.stat(path)
+	except OSError:
+		return None
+	return [stat.st_size, int(stat.st_mtime)]
+
+def getSequenceStats(pattern):
+	""" Returns the name, size and modification time of every frame that
+	matches a #### file pattern.
+	"""
+	directory, basename = os.path.split(pattern)
+	regex = re.compile("^" + re.escape(basename).replace(re.escape("####"), r"-?\d+") + "$")
+	try:
+		names = os.listdir(directory or ".")
+	except OSError:
+		return []
+	return [
+		[name] + (getFileStats(os.path.join(directory, name)) or [])
+		for name in sorted(names) if regex.match(name)
+	]
+
+def parseArgList(args):
+	""" Split a run.py argument list into a mapping of long flag to values.
+	Positional arguments are stored under None.
+	"""
+	options = {None : []}
+	flag = None
+	for arg in args:
+		if arg.startswith("--"):
+			flag = arg
+			options[flag] = []
+		else:
+			options[flag].append(arg)
+	return options
+
+def linkFile(source, destination):
+	""" Hard link source to destination, copying if they are on different
+	volumes or the platform does not support it.
+	"""
+	makeDirs(os.path.dirname(destination))
+	if os.path.exists(destination):
+		os.remove(destination)
+	try:
+		if hasattr(os, "link"):
+			os.link(source, destination)
+			return
+		import ctypes
+		if ctypes.windll.kernel32.CreateHardLinkW(unicode(destination), unicode(source), None):
+			return
+	except (OSError, AttributeError):
+		pass
+	shutil.copy2(source, destination)
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+class BlastFingerprint(object):
+	""" Fingerprints the inputs of a blast.
+
+	The fingerprint covers the comp file, the input sequence (frame names,
+	sizes and mtimes), the resolved Shotgun versions, the formats entries and
+	every argument that changes the output, such as the burn-in and slate
+	text.  Arguments that only change how the blast runs are left out.
+
+	Args:
+		args(list) : The run.py arguments of the blast, using long flags.
+		versions(dict) : The resolved Shotgun versions for the shot.
+
+	"""
+	def __init__(self, args, versions):
+		options = parseArgList(args)
+		for flag in NON_CONTENT_ARGS:
+			options.pop(flag, None)
+		formatsfile = options.pop("--formatsfile", [None])[0]
+		self.formats = options.pop("--formats", [])
+		self.formatsData = {}
+		if formatsfile:
+			# Only hashed here, the blast validates the formats it uses
+			self.formatsData = blastprefs.loadJson(formatsfile)
+		inputFile = options.pop("--file", [""])[0]
+		comp = options.pop(None)[0]
+		self.parts = {
+			"comp" : getFileStats(comp),
+			"input" : getSequenceStats(inputFile),
+			"shotgun" : versions,
+			"args" : options,
+		}
+
+	def getDigest(self, formats=None):
+		""" Returns the fingerprint for the formats, all of them by default. """
+		return self.hashParts(self.parts, formats)
+
+	def getSettingsDigest(self, formats=None):
+		""" Returns the fingerprint for the formats without the input
+		sequence, which is fingerprinted frame by frame instead.
+		"""
+		parts = dict(self.parts)
+		del parts["input"]
+		return self.hashParts(parts, formats)
+
+	def hashParts(self, parts, formats=None):
+		formats = formats or self.formats
+		parts = dict(parts)
+		parts["formats"] = [[name, self.formatsData.get(name)] for name in formats]
+		return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+class FrameManifest(object):
+	""" Maps every rendered output frame to the digest of its source frame
+	and render settings, so a re-blast only renders the frames that changed.
+
+	Args:
+		path(str) : Location of the manifest, next to the output frames.
+
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.frames = {}
+		if os.path.exists(path):
+			with open(path, "r") as fileinfo:
+				self.frames = json.loads(fileinfo.read())
+
+	@staticmethod
+	def getFrameDigest(settingsDigest, sourcePath):
+		""" Returns the digest of an output frame from its source frame stats. """
+		parts = [settingsDigest, getFileStats(sourcePath)]
+		return hashlib.sha1(json.dumps(parts)).hexdigest()
+
+	def getChangedFrames(self, frameDigests, getOutputPath):
+		""" Returns the sorted frames whose digest changed or whose output is
+		missing.
+
+		Args:
+			frameDigests(dict) : Mapping of frame to its current digest.
+			getOutputPath(callable) : Returns the output path of a frame.
+
+		"""
+		return sorted(
+			frame for frame, digest in frameDigests.iteritems()
+			if self.frames.get(str(frame)) != digest or
+			not os.path.exists(getOutputPath(frame))
+		)
+
+	def update(self, frameDigests, frames):
+		for frame in frames:
+			self.frames[str(frame)] = frameDigests[frame]
+
+	def save(self):
+		writeFile(self.path, json.dumps(self.frames, sort_keys=True))
+
+class RenderCache(object):
+	""" Local store of blast outputs keyed by fingerprint.
+
+	Entries are kept under the blast cache dir and evicted least recently
+	used first once the store grows past maxBytes.  An entry holds the
+	outputs of one format, or lists the entries a whole blast is made of.
+
+	Args:
+		path(str) : Location of the store.  Defaults to the blast cache dir.
+		maxBytes(int) : Size the store is trimmed down to.
+
+	"""
+	def __init__(self, path=None, maxBytes=DEFAULT_MAX_BYTES):
+		self.path = path or os.path.join(getCacheDir(), "renders")
+		self.maxBytes = maxBytes
+		# Encodes finishing side by side store and evict at the same time
+		self.lock = threading.Lock()
+		makeDirs(self.path)
+
+	def getManifestPath(self, fingerprint):
+		return os.path.join(self.path, fingerprint, "manifest.json")
+
+	def fetch(self, fingerprint, outputDir):
+		""" Link the cached outputs for the fingerprint into outputDir.
+
+		Returns:
+			list - The linked files, or None if there is no entry.
+
+		"""
+		manifestPath = self.getManifestPath(fingerprint)
+		if not os.path.exists(manifestPath):
+			return None
+		try:
+			with open(manifestPath, "r") as fileinfo:
+				manifest = json.loads(fileinfo.read())
+		except (IOError, ValueError):
+			# Evicted by another blast
+			return None
+		entryDir = os.path.dirname(manifestPath)
+		outputs = []
+		if "entries" in manifest:
+			for entry in manifest["entries"]:
+				entryOutputs = self.fetch(entry, outputDir)
+				if entryOutputs is None:
+					return None
+				outputs.extend(entryOutputs)
+		else:
+			try:
+				for relativePath in manifest["files"]:
+					destination = os.path.join(outputDir, relativePath)
+					linkFile(os.path.join(entryDir, "files", relativePath), destination)
+					outputs.append(destination)
+			except (IOError, OSError) as e:
+				print "Unable to reuse cached render {0}: {1}".format(fingerprint, e)
+				return None
+		# Mark the entry as recently used
+		os.utime(manifestPath, None)
+		return outputs
+
+	def store(self, fingerprint, files, outputDir):
+		""" Add finished outputs to the store.
+
+		Args:
+			fingerprint(str) : The fingerprint of the blast or format.
+			files(list) : Output files, which must live under outputDir.
+			outputDir(str) : The blast output directory.
+
+		"""
+		files = [path for path in files if os.path.isfile(path)]
+		if not files or os.path.exists(self.getManifestPath(fingerprint)):
+			return
+		# Build the entry aside and move it in place so a half written
+		# entry is never picked up.
+		tempDir = tempfile.mkdtemp(prefix="tmp", dir=self.path)
+		relativePaths = []
+		size = 0
+		try:
+			for path in files:
+				relativePath = os.path.relpath(path, outputDir).replace("\\", "/")
+				# Blasts remove their outputs before rewriting them, so the
+				# entry can share them with the output directory.
+				linkFile(path, os.path.join(tempDir, "files", relativePath))
+				relativePaths.append(relativePath)
+				size += os.path.getsize(path)
+			with open(os.path.join(tempDir, "manifest.json"), "w") as fileinfo:
+				fileinfo.write(json.dumps({"files" : relativePaths, "size" : size}))
+			os.rename(tempDir, os.path.join(self.path, fingerprint))
+		except (IOError, OSError) as e:
+			print "Unable to cache render {0}: {1}".format(fingerprint, e)
+			shutil.rmtree(tempDir, ignore_errors=True)
+			return
+		self.evict()
+
+	def storeEntries(self, fingerprint, entries):
+		""" Add an entry made of other entries, such as a whole blast made of
+		its formats.  Nothing is copied, fetching it fetches each of them.
+
+		Args:
+			fingerprint(str) : The fingerprint of the blast.
+			entries(list) : Fingerprints of the entries it is made of.
+
+		"""
+		manifestPath = self.getManifestPath(fingerprint)
+		if not entries or os.path.exists(manifestPath):
+			return
+		if not all(os.path.exists(self.getManifestPath(entry)) for entry in entries):
+			return
+		try:
+			makeDirs(os.path.dirname(manifestPath))
+			writeFile(manifestPath, json.dumps({"entries" : entries, "size" : 0}))
+		except (IOError, OSError) as e:
+			print "Unable to cache render {0}: {1}".format(fingerprint, e)
+
+	def evict(self):
+		""" Remove the least recently used entries until the store fits, and
+		the entries made of any that were removed.
+		"""
+		with self.lock:
+			entries = []
+			groups = []
+			total = 0
+			for fingerprint in os.listdir(self.path):
+				manifestPath = self.getManifestPath(fingerprint)
+				try:
+					with open(manifestPath, "r") as fileinfo:
+						manifest = json.loads(fileinfo.read())
+					lastUsed = os.path.getmtime(manifestPath)
+				except (IOError, OSError, ValueError):
+					# Still being stored, or removed by another blast
+					continue
+				if "entries" in manifest:
+					groups.append((fingerprint, manifest["entries"]))
+					continue
+				entries.append((lastUsed, manifest["size"], fingerprint))
+				total += manifest["size"]
+			kept = set(fingerprint for lastUsed, size, fingerprint in entries)
+			for lastUsed, size, fingerprint in sorted(entries):
+				if total <= self.maxBytes:
+					break
+				shutil.rmtree(os.path.join(self.path, fingerprint), ignore_errors=True)
+				kept.discard(fingerprint)
+				total -= size
+			for fingerprint, members in groups:
+				if not kept.issuperset(members):
+					shutil.rmtree(os.path.join(self.path, fingerprint), ignore_errors=True)
@@ -1,42 +1,111 @@
 
 # Built-in
+import time
+# When run.py started loading, for --startuptime
+IMPORT_STARTED = time.time()
 import argparse
+import collections
 from datetime import datetime
 import json
+import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import re
 import os
+import shutil
 import subprocess
 import sys
-import time
+import tempfile
+import threading
+import traceback
 import xml.etree.ElementTree as ET
 
 # Nuke
-import nuke
-
-# Blur
-# import blurdev
-from blur3d.pipe.cinematic.api.filesequence import FileSequence
-from blur3d.actions.ffmpeg import RunFFMpeg
-import trax
 try:
-	import blursg
+	import nuke
 except ImportError as e:
-	print "Unable to import blursg.  Please contact Pipeline to get the new custom nuke install"
+	# Farm encode tasks run outside of Nuke
+	nuke = None
+
+# Blur packages (blur3d, trax and blursg) are imported by the functions that
+# need them, so blasts that never reach those code paths don't pay for them.
+
+# Nuke does not put the script directory on the path when running with -t
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import blastprefs
+import blastworker
+from blasttiming import BlastTimer
+import colorbake
+import encodeprofiles
+from fileutils import makeDirs, writeFile
+from platecache import PlateCache
+import processlog
+from publisher import OutputPublisher, getPublishBaseDir
+from rendercache import BlastFingerprint, FrameManifest, RenderCache
+from sgcache import ShotgunCache
+from sgresolver import ShotgunResolver
+IMPORT_FINISHED = time.time()
+
+# The pipeline's ffmpeg install, with the one on the PATH as a fallback for
+# machines without it.  BLAST_FFMPEG overrides both.
+PIPELINE_FFMPEG = "C:/Program Files/ffmpeg/bin/ffmpeg.exe"
+FFMPEG_EXECUTABLE = os.environ.get(
+	"BLAST_FFMPEG",
+	PIPELINE_FFMPEG if os.path.exists(PIPELINE_FFMPEG) else "ffmpeg"
+)
+
+# Seconds to wait on a Shotgun or trax lookup before giving up on the blast.
+PREFETCH_TIMEOUT = float(os.environ.get("BLAST_PREFETCH_TIMEOUT", 300))
 
-"""
--y - override output files
--f - force format
+# Packages imported on demand, timed by --startuptime.
+LAZY_IMPORTS = [
+	"trax",
+	"blursg",
+	"blur3d.pipe.cinematic.api.filesequence",
+	"blur3d.actions.ffmpeg",
+]
 
-"""
+# Whether blursg imports, checked on first use.
+_hasShotgun = None
 
-# apcs == Prores
-# avc1 == H264
-ffmpegargs = {
-	"apcs" : "C:/Program Files/ffmpeg/bin/ffmpeg.exe -y -probesize 5000000 -start_number {framestart} -f image2 -r {fps} -i {filesequence} -codec:v prores -profile:v 1 -pix_fmt yuv422p10le -qscale:v 5 -vendor ap10 -r {fps} -y {output}",
-	"avc1" : "ffmpeg -start_number {framestart} -r {fps} -i {filesequence} -i {audio} -f mov -pix_fmt yuv420p -vcodec h264 -preset slow -b:v 10M -y {output}"
-}
+# Format settings that only affect the format's own output node.  Every other
+# setting changes the shared graph, so formats must agree on them to be
+# rendered together in a single pass.
+OUTPUT_FORMAT_KEYS = [
+	"nodes",
+	"ext",
+	"codec",
+	"colorspace",
+	"file_suffix",
+	"relative_path",
+	"pixelFormat",
+	"runffmpeg",
+	"encodes",
+	"intermediate",
+	"intermediate_knobs",
+	"stage_intermediate",
+	# Formats grouped with one that does not use it get their color from
+	# the graph instead, see runBlast
+	"encode_lut",
+]
 
-def parseArgs():
+# Format settings naming nodes that the blast edits.  These are recorded so
+# the graph can be reverted between formats.
+SNAPSHOT_NODE_KEYS = [
+	"slate_node",
+	"slate_switch",
+	"distortion_node",
+	"distortion_switch",
+	"cdl_node",
+	"lut_node",
+	"cdlswitch",
+	"lutswitch",
+	"baked_lut_node",
+	"timecode",
+	"import_flattened_plate",
+]
+
+def parseArgs(args=None):
 	parser = argparse.ArgumentParser(description="Blast some files.")
 	parser.add_argument('comp', type=str, help='File location for the comp script to be used.')
 	parser.add_argument('-t', '--formats', type=str, nargs='+', help='Formats to produce')
@@ -61,38 +130,58 @@ def parseArgs():
 	parser.add_argument('--nocdl', dest='nocdl', action='store_true')
 	parser.add_argument('--nolut', dest='nolut', action='store_true')
 	parser.add_argument('--noaudio', dest='noaudio', action='store_true')
-	parsedArgs = parser.parse_args()
+	parser.add_argument('--multiformat', dest='multiformat', action='store_true', help='Render compatible formats together in one pass')
+	parser.add_argument('--reopen', dest='reopen', action='store_true', help='Save, close and reopen the script before every render')
+	parser.add_argument('--streamencode', dest='streamencode', action='store_true', help='Pipe rendered frames straight into ffmpeg')
+	parser.add_argument('--overlapencode', dest='overlapencode', action='store_true', help='Encode movies while their frames are still rendering')
+	parser.add_argument('--encodethreads', type=int, help='Number of encodes allowed to run at once', default=2)
+	parser.add_argument('--rendercache', dest='rendercache', action='store_true', help='Reuse the outputs of a previous blast with the same inputs')
+	parser.add_argument('--incremental', dest='incremental', action='store_true', help='Only render the frames whose source or settings changed')
+	parser.add_argument('--platecache', dest='platecache', action='store_true', help='Read the input plates from a local copy')
+	parser.add_argument('--writebehind', dest='writebehind', action='store_true', help='Render locally and publish the outputs in the background')
+	parser.add_argument('--nosgcache', dest='nosgcache', action='store_true', help='Always query Shotgun instead of the local cache')
+	parser.add_argument('--renderonly', dest='renderonly', action='store_true', help='Render the frames and leave the encode to a separate task')
+	parser.add_argument('--chunk', type=str, help='Only render chunk INDEX of COUNT, given as INDEX/COUNT')
+	parser.add_argument('--farmjob', type=str, help='Id shared by the chunk tasks of a farm graph blast')
+	parser.add_argument('--chrometrace', dest='chrometrace', action='store_true', help='Also write the timing report as a Chrome trace')
+	parser.add_argument('--clientspans', type=str, help='Timing spans recorded by the client that launched the blast')
+	parser.add_argument('--inputrange', type=int, nargs=2, help='First and last frame of the input sequence on disk')
+	parsedArgs = parser.parse_args(args)
+	# Keep the raw arguments around to fingerprint the blast
+	parsedArgs.args = list(sys.argv[1:] if args is None else args)
 	return parsedArgs
 
+def hasShotgun():
+	""" Returns True if blursg can be imported.  It is only imported the
+	first time a blast asks for Shotgun data.
+	"""
+	global _hasShotgun
+	if _hasShotgun is None:
+		try:
+			import blursg
+			_hasShotgun = True
+		except ImportError as e:
+			print "Unable to import blursg.  Please contact Pipeline to get the new custom nuke install"
+			_hasShotgun = False
+	return _hasShotgun
+
 def setTextOptions(node):
 	fontSize = node.knob("font_size")
 	fontSize.setValue(40)
 
-def addAudio(outputNode, project, shot):
+def addAudio(outputNode, resolver):
 	""" Add an audio file path to the output node from shotgun.
 
 	Args:
 		outputNode(Node) : The output write node for nuke to apply the audio.
-		project(str) : The name of the project to retrieve audio from.
-		shot(str) : The name of the shot to retrieve audio from.
+		resolver(ShotgunResolver) : Resolved shotgun data for the shot.
 
 	Returns:
 		None
 
 	"""
 	normalizedAudioPath = ""
-	sg = blursg.sg()
-	sgProject = sg.find_one("Project", [["name", "is", project]], [])
-	sgShot = sg.find_one("Shot", [["project", "is", sgProject], ["code", "is", shot]])
-	audio = sg.find_one(
-		"Version",
-		[
-			['entity', 'is', sgShot],
-			['sg_version_type', 'is', 'Audio']
-		],
-		['sg_path_to_movie'],
-		[{'field_name': 'sg_version_number', 'direction' : 'desc'}]
-	)
+	audio = resolver.version("audio")
 	if audio:
 		normalizedAudioPath = audio['sg_path_to_movie'].replace("\\", "/")
 		if outputNode['file_type'].value() == 'mov':
@@ -100,38 +189,25 @@ def addAudio(outputNode, project, shot):
 			outputNode["mov32_audiofile"].setValue(normalizedAudioPath)
 	return normalizedAudioPath
 
-def applyDistortion(formatinfo, project, shot, distort=True):
+def applyDistortion(formatinfo, resolver, distort=True):
 	""" Pulls the distortion map from the shot, and switches the script to
 	use the distortion map.
 
 	Args:
 		formatinfo(dict) : Dictionary with custom settings for the project.
-		project(str) : Name of the project to retrieve the distortion maps.
-		shot(str) : Name of the shot to retrieve the distortion maps.
+		resolver(ShotgunResolver) : Resolved shotgun data for the shot.
 		distort(bool) : If True, a distortion map will be applied.  Undistort otherwise.
 
 	"""
 	if distort:
-		variation = "Distorted"
+		versionKey = "stmap_distorted"
 	else:
-		variation = "Undistorted"
+		versionKey = "stmap_undistorted"
 	distortNodeName = formatinfo.get('distortion_node')
 	distortSwitchName = formatinfo.get('distortion_switch')
 	if not distortNodeName:
 		return
-	sg = blursg.sg()
-	sgProject = sg.find_one("Project", [["name", "is", project]], [])
-	sgShot = sg.find_one("Shot", [["project", "is", sgProject], ["code", "is", shot]])
-	stmap = sg.find_one(
-		"Version",
-		[
-			['entity', 'is', sgShot],
-			['sg_version_type', 'is', 'ST Map'],
-			['sg_variation', 'is', variation]
-		],
-		['sg_path_to_movie'],
-		[{'field_name': 'sg_version_number', 'direction' : 'desc'}]
-	)
+	stmap = resolver.version(versionKey)
 	if stmap:
 		distortNode = nuke.toNode(distortNodeName)
 		if distortSwitchName:
@@ -144,44 +220,28 @@ def applyDistortion(formatinfo, project, shot, distort=True):
 			if distortSwitch:
 				distortSwitch["which"].setValue(1)
 
-def getPostmove(formatinfo, project, shot):
+def getPostmove(formatinfo, resolver):
 	""" Checks the shot to see if there is a Postmove version linked.
 
 	Args:
 		formatinfo(dict) : Mapping of custom settings for the project
-		project(str) : Name of the project to retrieve for the post move
-		shot(str) : Name of the shot to retrieve for the post move
+		resolver(ShotgunResolver) : Resolved shotgun data for the shot.
 
 	Returns:
 		Dict - Returns a dictionary that contains the path to the postmove
 
 	"""
-	sg = blursg.sg()
-	sgProject = sg.find_one("Project", [["name", "is", project]], [])
-	sgShot = sg.find_one("Shot", [["project", "is", sgProject], ["code", "is", shot]])
-	sgPostmove = sg.find_one(
-		"Version",
-		[
-			['entity', 'is', sgShot],
-			['sg_version_type', 'is', 'Composition'],
-			['sg_variation', 'is', 'Postmove'],
-			['sg_status_list', 'is', 'apr']
-		],
-		['sg_path_to_movie'],
-		[{'field_name': 'sg_version_number', 'direction' : 'desc'}]
-	)
-	return sgPostmove
+	return resolver.version("postmove")
 
-def applyPostmove(formatinfo, project, shot, readnode):
+def applyPostmove(formatinfo, resolver, readnode):
 	""" Looks for the postmove nuke script for this particular shot, and applies
 	a post move node to the script.
 
 	Args:
 		formatinfo(dict) : Mapping of custom settings for the project
-		project(str) : Name of the project to retrieve for post move
-		shot(str) : Name of the shot to retrieve for the post move
+		resolver(ShotgunResolver) : Resolved shotgun data for the shot.
 	"""
-	sgPostmove = getPostmove(formatinfo, project, shot)
+	sgPostmove = getPostmove(formatinfo, resolver)
 	if sgPostmove:
 		# Retrieve the node from the nuke path specified
 		postmoveNode = nuke.nodePaste(sgPostmove['sg_path_to_movie'])
@@ -270,8 +330,11 @@ def getFrameRange(formatinfo, blastOptions, nodeinstring, nodeoutstring):
 	nodeout = nuke.toNode(nodeoutstring)
 	framein = blastOptions.framein
 	frameout = blastOptions.frameout
-	# If the frame in/out are 0, use the node frame in/out
-	if framein == 0 and frameout == 0:
+	# If the frame in/out are 0, use the input sequence range found by the
+	# client, or else the node frame in/out
+	if framein == 0 and frameout == 0 and blastOptions.inputrange:
+		framein, frameout = blastOptions.inputrange
+	elif framein == 0 and frameout == 0:
 		framerange = nodein.frameRange()
 		framein = framerange.first()
 		frameout = framerange.last()
@@ -303,81 +366,28 @@ def openComp(filepath):
 def render(node, start, end, increment=1):
 	nuke.execute(node, start, end, increment)
 
-def runffmpegaction(framein, filesequence, audio, projectname, shotname=None, assetname=None):
-	"""
-	Runs an ffmpeg command on a given file sequence
-	"""
-	project = trax.api.data.Project.recordByName(projectname)
+def renderMultiple(nodes, start, end, increment=1):
+	nuke.executeMultiple(nodes, ((start, end, increment),))
+
+def renderFrames(nodes, frames):
+	nuke.executeMultiple(nodes, getFrameRanges(frames))
+
+def getMoviePath(filesequence):
+	""" Returns the movie path encoded from the given %04d file sequence. """
 	output = filesequence.replace(".%04d", "")
-	outputpath = os.path.splitext(output)[0] + ".mov"
-	# Build Inputs and Outputs Specifications
-	inputs  = [{
-		'filename' : filesequence,
-		'startFrame' : framein,
-		'framerate' : 23.976
-	}]
-	# If we have an audio file, add it as an input as well
-	if audio and os.path.exists(audio):
-		inputs.append({'filename' : audio})
-	outputs = [{
-		'filename' : outputpath,
-		'forceFormat' : 'mov',
-		'pixelFormat' : 'yuv420p',
-		'videoCodec' : 'h264',
-		'preset' : 'fast',
-		'videoBitrate' : '5M',
-		'maxrate' : '5M',
-		'overwriteExisting' : None,
-		'fps' : 23.976,
-	}]
-	job = "FFMPEG H264 {0}__{1}".format(projectname, os.path.basename(outputpath))
-	kwargs = {
-		"inputs" : inputs,
-		"outputs" : outputs,
-		"project" : project,
-		"job" : job,
-		"runLocal" : True,
-	}
-	blastBackupDir = getBlastBackupNukeDir(projectname, shotname, assetname)
-	datestr = datetime.now().strftime("%m_%d_%y_%H_%M")
-	basename = "{0}_{1}_{2}.bat".format("FFMPEG",shotname, datestr)
-	ffmpegLog = os.path.join(blastBackupDir, basename)
-	action = RunFFMpeg(**kwargs)
-	# Write the command in a log file to be re run if necessary
-	with open(ffmpegLog, "w") as logfile:
-		logfile.write(action.buildWindowsCommand())
-	action()
-
-def runffmpeg(framein, filesequence, audio, formatinfo):
-	"""
-	Runs an ffmpeg command on a given file sequence
-	"""
-	codec = formatinfo['codec']
-	output = filesequence.replace("_%04d", "")
-	outputpath = os.path.splitext(output)[0] + ".mov"
-	ffmpegTemplateCmd = ffmpegargs[codec]
-	kwargs = {
-		"framestart" : framein,
-		"filesequence" : filesequence,
-		"fps" : str(23.976),
-		"output" : outputpath,
-		"audio" : audio
-	}
-	# If there is no audio, remove audio from command template
-	if not audio:
-		ffmpegTemplateCmd = re.sub("-i {audio} ", "", ffmpegTemplateCmd)
-		del kwargs['audio']
-	ffmpegcmd = ffmpegTemplateCmd.format(**kwargs)
-	print "FFMPEG COMMAND: {0}".format(ffmpegcmd)
-	process = subprocess.Popen(
-		ffmpegcmd.split(" "),
-		shell=True,
-		stdout=subprocess.PIPE,
-		stderr=subprocess.PIPE
-	)
-	output, err = process.communicate()
-	print output
-	print err
+	return os.path.splitext(output)[0] + ".mov"
+
+def getPlateFrames(blastOptions):
+	""" Returns the input frames a blast can read, or None if only the
+	sequence on disk tells.  The frame before the range is included for the
+	slate.
+	"""
+	framein, frameout = blastOptions.framein, blastOptions.frameout
+	if framein == 0 and frameout == 0:
+		if not blastOptions.inputrange:
+			return None
+		framein, frameout = blastOptions.inputrange
+	return range(framein - 1, frameout + 1)
 
 def setImageSequence(imageSeq, innode):
 	fileKnob = innode.knob("file")
@@ -426,7 +436,14 @@ def setOutputNode(nodeout, blastOptions, formatinfo, filename):
 			nodeout['mov32_pixel_format'].setValue(pixFmt)
 		newoutput = newoutput + newext
 	else:
-		nodeout["file_type"].setValue(str(newext).strip('.'))
+		intermediate = encodeprofiles.getIntermediate(formatinfo)
+		if intermediate:
+			nodeout["file_type"].setValue(intermediate["fileType"])
+			for knobName, value in intermediate["knobs"].iteritems():
+				if nodeout.knob(knobName):
+					nodeout[knobName].setValue(value)
+		else:
+			nodeout["file_type"].setValue(str(newext).strip('.'))
 		newoutput = newoutput + ".####" + newext
 	nodeout["file"].setValue(newoutput)
 	# Jpeg isn't an option until after you set it
@@ -441,6 +458,7 @@ def addTimeCode(formatinfo, frame):
 			timeCodeNode["frame"].setValue(frame)
 
 def getBlastBackupNukeDir(projectname, shotname=None, assetname=None):
+	import trax
 	assetTypeName = None
 	element = None
 	# Determine whether we are using a shot or asset, then build our
@@ -464,12 +482,24 @@ def getBlastBackupNukeDir(projectname, shotname=None, assetname=None):
 		os.makedirs(blastBackupDir)
 	return blastBackupDir
 
-def getBlastBackupNukePath(blastOptions, formatname):
+def getUserTag(artist):
+	""" Returns the username of the artist, or an empty string. """
+	import trax
+	tEmployee = trax.api.data.Employee.recordByDisplayName(artist)
+	usertag = ""
+	if tEmployee.isRecord():
+		usertag = str(tEmployee.username())
+	return usertag
+
+def getBlastBackupNukePath(blastOptions, formatname, blastBackupDir=None, usertag=None):
 	"""
 	Retrieve the path of the blast backup
 
 	Args:
 		blastOptions(dict) : Dictionary of blast options
+		formatname(str) : Name of the formats the backup is for
+		blastBackupDir(str) : The backup directory, if already looked up
+		usertag(str) : The artist's username, if already looked up
 	"""
 	kwargs = {'projectname' : blastOptions.project}
 	nukeTag = ""
@@ -479,12 +509,11 @@ def getBlastBackupNukePath(blastOptions, formatname):
 	if blastOptions.asset:
 		kwargs['assetname'] = blastOptions.asset
 		nukeTag = blastOptions.asset
-	blastBackupDir = getBlastBackupNukeDir(**kwargs)
+	if blastBackupDir is None:
+		blastBackupDir = getBlastBackupNukeDir(**kwargs)
 	# Retrieve the artists name
-	tEmployee = trax.api.data.Employee.recordByDisplayName(blastOptions.artist)
-	usertag = ""
-	if tEmployee.isRecord():
-		usertag = str(tEmployee.username())
+	if usertag is None:
+		usertag = getUserTag(blastOptions.artist)
 	# Append a datetime to track when it was created
 	datestr = datetime.now().strftime("%m_%d_%y_%H_%M")
 	basename = "{0}_{1}_{2}_{3}.nk".format(
@@ -506,22 +535,9 @@ def getCCCFromCDL(cdlPath):
 		cdlId = element.attrib['id']
 	return cdlId
 
-def setCDL(formatinfo, project, shot):
-	# if not project or not shot:
-	# 	return
+def setCDL(formatinfo, resolver):
 	cdlName = formatinfo.get('cdl_node')
-	sg = blursg.sg()
-	sgProject = sg.find_one("Project", [["name", "is", project]], [])
-	sgShot = sg.find_one("Shot", [["project", "is", sgProject], ["code", "is", shot]])
-	cdl = sg.find_one(
-		"Version",
-		[
-			['entity', 'is', sgShot],
-			['sg_status_list', 'is', 'apr'],
-			['sg_version_type', 'is', 'cdl']
-		],
-		['sg_path_to_movie']
-	)
+	cdl = resolver.version("cdl")
 	if cdlName and cdl:
 		cdlNode = nuke.toNode(cdlName)
 		if cdlNode:
@@ -533,34 +549,113 @@ def setCDL(formatinfo, project, shot):
 			cdlNode["reload"].execute()
 
 
-def set3DL(formatinfo, project, shot):
-	# if not project or not shot:
-	# 	return
+def set3DL(formatinfo, resolver):
 	lutName = formatinfo.get('lut_node')
-	sg = blursg.sg()
-	sgProject = sg.find_one("Project", [["name", "is", project]], [])
-	sgShot = sg.find_one("Shot", [["project", "is", sgProject], ["code", "is", shot]])
-	lut = sg.find_one(
-		"Version",
-		[["entity", "is", sgShot], ["sg_version_type", "is", "3dl"], ["sg_variation", "is", "3DL"]],
-		['sg_path_to_movie'],
-		[{'field_name': 'sg_version_number', 'direction' : 'desc'}]
-	)
+	lut = resolver.version("3dl")
 	if lutName and lut:
 		normalizedLutPath = lut['sg_path_to_movie'].replace("\\", "/")
 		lutNode = nuke.toNode(lutName)
 		if lutNode:
 			lutNode["vfield_file"].setValue(normalizedLutPath)
 
+def getColorSources(blastOptions, resolver):
+	""" Returns the CDL and 3DL of the shot that the blast should apply.
+	Resolved once per blast, every format shares them.
+
+	Returns:
+		dict - The cdlPath, cccid and lutPath, or None if there is no color.
+
+	"""
+	# Matches when prepareGraph sets the color
+	if not blastOptions.shot or blastOptions.noaudio or not hasShotgun():
+		return None
+	sources = {}
+	cdl = None if blastOptions.nocdl else resolver.version("cdl")
+	if cdl:
+		sources["cdlPath"] = cdl['sg_path_to_movie'].replace("\\", "/")
+		sources["cccid"] = getCCCFromCDL(sources["cdlPath"]) or None
+	lut = None if blastOptions.nolut else resolver.version("3dl")
+	if lut:
+		sources["lutPath"] = lut['sg_path_to_movie'].replace("\\", "/")
+	return sources or None
+
+def getBakedLUT(formatinfo, sources):
+	""" Returns the cube LUT baked from the color sources of the shot. """
+	return colorbake.getBakedLUT(
+		size=formatinfo.get("baked_lut_size", colorbake.DEFAULT_LUT_SIZE),
+		**sources
+	)
+
+def setBakedLUT(formatinfo, sources):
+	""" Apply the shot's CDL and 3DL through the format's baked LUT node,
+	bypassing the separate CDL and 3DL nodes.
+
+	Returns:
+		bool - False if the format has no baked LUT node.
+
+	"""
+	node = nuke.toNode(formatinfo.get("baked_lut_node") or "")
+	if not node:
+		return False
+	node["vfield_file"].setValue(getBakedLUT(formatinfo, sources).replace("\\", "/"))
+	node["disable"].setValue(False)
+	setCDLSwitch(formatinfo)
+	setLUTSwitch(formatinfo)
+	return True
+
+def setColor(formatinfo, resolver, sources=None, encodeLUT=False):
+	""" Set the shot's color on the format's nodes.
+
+	Formats with a baked_lut_node apply the CDL and 3DL through a single
+	cached cube LUT.  Formats with encode_lut leave the color to the ffmpeg
+	encode, see getJobLUT.
+
+	Args:
+		formatinfo(dict) : Dictionary of blast format options
+		resolver(ShotgunResolver) : Resolved shotgun data for the shot.
+		sources(dict) : The shot's color, see getColorSources.
+		encodeLUT(bool) : Leave the color to the encode.
+
+	"""
+	if encodeLUT:
+		setCDLSwitch(formatinfo)
+		setLUTSwitch(formatinfo)
+		return
+	if sources and formatinfo.get("baked_lut_node"):
+		try:
+			if setBakedLUT(formatinfo, sources):
+				return
+		except colorbake.ColorBakeException as e:
+			print "Unable to bake the color, applying the CDL and 3DL nodes: {0}".format(e)
+	setCDL(formatinfo, resolver)
+	set3DL(formatinfo, resolver)
+
+def getJobLUT(job):
+	""" Returns the cube LUT the encode of the job applies, if any.
+
+	ffmpeg applies it to the intermediate frames, after the write node
+	converted them to its colorspace, rather than inside the comp where the
+	CDL and 3DL nodes sit.  Formats with encode_lut therefore set colorspace
+	to the space those nodes receive, which blastprefs checks they do.
+	"""
+	if not job.get("colorSources"):
+		return None
+	return getBakedLUT(job["formatinfo"], job["colorSources"])
+
 def setCDLSwitch(formatinfo):
 	if formatinfo.get('cdlswitch'):
 		node = nuke.toNode(formatinfo.get('cdlswitch'))
 		if node:
 			node['which'].setValue(1)
 
-def setFramerate(project):
+def getProjectFramerate(project):
+	import trax
 	proj = trax.api.data.Project.recordByName(project)
-	fps = proj.primaryOutput().fps()
+	return proj.primaryOutput().fps()
+
+def setFramerate(project, fps=None):
+	if fps is None:
+		fps = getProjectFramerate(project)
 	nuke.Root().knob('fps').setValue(fps)
 
 def setLUTSwitch(formatinfo):
@@ -569,185 +664,1730 @@ def setLUTSwitch(formatinfo):
 		if node:
 			node['which'].setValue(1)
 
-def importPlate(project, shot, nodeName, fileType="Flat Plate", variation=""):
-	# if not project or not shot:
-	# 	return
-	sg = blursg.sg()
-	sgProject = sg.find_one("Project", [["name", "is", project]], [])
-	sgShot = sg.find_one("Shot", [["project", "is", sgProject], ["code", "is", shot]])
-	sgFilter = [
-		["entity", "is", sgShot],
-		["sg_version_type", "is", fileType],
-	]
-	plate = sg.find_one(
-		"Version",
-		sgFilter,
-		['sg_path_to_frames'],
-		[{'field_name': 'sg_version_number', 'direction' : 'desc'}]
-	)
+def importPlate(resolver, nodeName, versionKey="flat_plate", plateCache=None, frames=None):
+	plate = resolver.version(versionKey)
 	if plate:
 		pathToFrames = plate['sg_path_to_frames'].replace("\\", "/")
+		if plateCache:
+			pathToFrames = plateCache.fetch(pathToFrames, frames)
 		plateNode = nuke.toNode(nodeName)
 		if plateNode:
 			plateNode["file"].setValue(pathToFrames)
 
-def main():
-	blastOptions = parseArgs()
-	print blastOptions.comp
-	openComp(blastOptions.comp)
-	formatsdata = None
-	# Retrieve the formats presets
-	with open(blastOptions.formatsfile, "r") as formatfile:
-		formatsdata = formatfile.read()
-	# set the framerate to the project framerate
-	setFramerate(blastOptions.project)
-	formatjson = json.loads(formatsdata)
-	for formatname in blastOptions.formats:
+class GraphSnapshot(object):
+	""" Records the state of the nodes a blast edits so it can be reverted
+	between formats without closing and reopening the script.
+
+	Every knob of the recorded nodes is stored as script so animated knobs
+	(such as the slate switch) are restored with their keys.  The node list
+	and inputs of the top level graph are stored as well, so nodes pasted in
+	by the postmove are removed and the connections put back.
+
+	Args:
+		nodeNames(list) : Names of the nodes whose knobs should be recorded.
+
+	"""
+	def __init__(self, nodeNames):
+		self.knobs = {}
+		self.inputs = {}
+		for nodeName in set(nodeNames):
+			node = nuke.toNode(nodeName)
+			if node:
+				self.knobs[nodeName] = self.getKnobScripts(node)
+		self.knobs["root"] = self.getKnobScripts(nuke.Root())
+		for node in nuke.allNodes():
+			self.inputs[node.fullName()] = self.getInputNames(node)
+
+	@classmethod
+	def fromFormats(cls, formatinfos):
+		""" Record every node referenced by the given format settings. """
+		nodeNames = ["Burnin"]
+		for formatinfo in formatinfos:
+			nodeNames.extend(formatinfo["nodes"])
+			for key in SNAPSHOT_NODE_KEYS:
+				if formatinfo.get(key):
+					nodeNames.append(str(formatinfo[key]))
+		return cls(nodeNames)
+
+	@staticmethod
+	def getKnobScripts(node):
+		return dict((name, knob.toScript()) for name, knob in node.knobs().iteritems())
+
+	@staticmethod
+	def getInputNames(node):
+		names = []
+		for index in range(node.inputs()):
+			inputNode = node.input(index)
+			names.append(inputNode.fullName() if inputNode else None)
+		return names
+
+	def restore(self):
+		""" Put the recorded nodes back to the state they were captured in. """
+		for node in nuke.allNodes():
+			if node.fullName() not in self.inputs:
+				nuke.delete(node)
+		for nodeName, inputNames in self.inputs.iteritems():
+			node = nuke.toNode(nodeName)
+			if not node:
+				continue
+			if self.getInputNames(node) == inputNames:
+				continue
+			for index in range(max(node.inputs(), len(inputNames))):
+				inputName = inputNames[index] if index < len(inputNames) else None
+				node.setInput(index, nuke.toNode(inputName) if inputName else None)
+		for nodeName, knobScripts in self.knobs.iteritems():
+			if nodeName == "root":
+				node = nuke.Root()
+			else:
+				node = nuke.toNode(nodeName)
+			if not node:
+				continue
+			# The file type adds and removes knobs, so it has to go first
+			for name in sorted(knobScripts, key=lambda name: name != "file_type"):
+				knob = node.knob(name)
+				if knob is not None and knob.toScript() != knobScripts[name]:
+					knob.fromScript(knobScripts[name])
+
+class BackupWriter(object):
+	""" Writes the blast backup scripts off the critical path.
+
+	The script is saved to local temp space, which is fast, and copied to
+	the backup location on the network from a background thread.
+	"""
+	def __init__(self):
+		self.threads = []
+		self.errors = []
+		self.localDirs = []
+
+	def save(self, path):
+		""" Save the current script and start copying it to path.
+
+		Returns:
+			str - The local copy of the script, which stays until `wait`.
+
+		"""
+		localDir = tempfile.mkdtemp(prefix="BlastBackup")
+		self.localDirs.append(localDir)
+		localPath = os.path.join(localDir, os.path.basename(path))
+		nuke.scriptSave(localPath)
+		thread = threading.Thread(target=self.copy, args=(localPath, path))
+		thread.start()
+		self.threads.append(thread)
+		return localPath
+
+	def copy(self, localPath, path):
+		try:
+			shutil.copyfile(localPath, path)
+		except (IOError, OSError) as e:
+			self.errors.append("Unable to write blast backup {0}: {1}".format(path, e))
+
+	def wait(self):
+		""" Block until every backup has been written. """
+		for thread in self.threads:
+			thread.join()
+		for localDir in self.localDirs:
+			shutil.rmtree(localDir, ignore_errors=True)
+		for error in self.errors:
+			print error
+
+def getFormatGroupKey(formatinfo):
+	""" Returns a key describing everything a format changes in the shared
+	part of the graph.  Formats with the same key can render in one pass.
+	"""
+	shared = dict(
+		(key, value) for key, value in formatinfo.iteritems()
+		if key not in OUTPUT_FORMAT_KEYS
+	)
+	return (formatinfo["nodes"][0], json.dumps(shared, sort_keys=True))
+
+def groupFormats(formatjson, formatnames, multiFormat=False):
+	""" Group the formats that can be rendered together in a single pass.
+
+	Formats are grouped when they read from the same input node, write to
+	different output nodes and agree on every setting that touches the
+	shared graph (frame range, slate, color, distortion...).  Anything else
+	falls back to its own pass.
+
+	Args:
+		formatjson(dict) : The formats presets.
+		formatnames(list) : Names of the formats to blast, in order.
+		multiFormat(bool) : If False every format gets its own pass.
+
+	Returns:
+		list - A list of lists of format names.
+
+	"""
+	if not multiFormat:
+		return [[formatname] for formatname in formatnames]
+	groups = []
+	groupKeys = {}
+	for formatname in formatnames:
 		formatinfo = formatjson[formatname]
-		nodeinName = formatinfo["nodes"][0]
-		nodeout = formatinfo["nodes"][1]
-		inputfilename = os.path.basename(blastOptions.file)
-		print "NODE IN IS {0}".format(nodeinName)
-		print "NODE OUT IS {0}".format(nodeout)
-		# Ensure the input node is correct
-		nodein = nuke.toNode(nodeinName)
-		if not nodein:
-			print "Input node is incorrect: {0}".format(nodeinName)
-			sys.exit(1)
-		# Set the input nodes image sequence
-		setImageSequence(blastOptions.file, nodein)
-
-		# If there is plate importing required, do it here
-		if formatinfo.get("import_flattened_plate"):
-			plateNodeName = formatinfo["import_flattened_plate"]
-			importPlate(blastOptions.project, blastOptions.shot, plateNodeName)
-		# If there is no extension specified, take the extension of the input
-		if not formatinfo.get("ext", None):
-			formatinfo["ext"] = os.path.splitext(nodein['file'].value())[1]
+		key = getFormatGroupKey(formatinfo)
+		group = groupKeys.get(key)
+		outputNodes = [formatjson[name]["nodes"][1] for name in group or []]
+		if group is None or formatinfo["nodes"][1] in outputNodes:
+			group = []
+			groups.append(group)
+			groupKeys[key] = group
+		group.append(formatname)
+	return groups
+
+def prepareGraph(blastOptions, formatinfo, resolver, nodeoutNames, plateCache=None, colorSources=None, encodeLUT=False):
+	""" Set up the shared part of the graph for a format.
+
+	Args:
+		blastOptions(argparse.Namespace) : Options brought from argument parser
+		formatinfo(dict) : Dictionary of blast format options
+		resolver(ShotgunResolver) : Resolved shotgun data for the shot.
+		nodeoutNames(list) : Every output node that will render from this setup.
+		plateCache(PlateCache) : Optional local copy of the input plates.
+		colorSources(dict) : The shot's color, see getColorSources.
+		encodeLUT(bool) : Leave the color to the encodes of every format.
+
+	Returns:
+		tuple - (framein, frameout, increment)
+
+	"""
+	nodeinName = formatinfo["nodes"][0]
+	print "NODE IN IS {0}".format(nodeinName)
+	# Ensure the input node is correct
+	nodein = nuke.toNode(nodeinName)
+	if not nodein:
+		print "Input node is incorrect: {0}".format(nodeinName)
+		sys.exit(1)
+	# Set the input nodes image sequence
+	inputPath = blastOptions.file
+	if plateCache:
+		inputPath = plateCache.fetch(blastOptions.file, getPlateFrames(blastOptions))
+	setImageSequence(inputPath, nodein)
+
+	# If there is plate importing required, do it here
+	if formatinfo.get("import_flattened_plate"):
+		plateNodeName = formatinfo["import_flattened_plate"]
+		importPlate(resolver, plateNodeName, plateCache=plateCache, frames=getPlateFrames(blastOptions))
+	for nodeout in nodeoutNames:
 		framein, frameout = getFrameRange(formatinfo, blastOptions, nodeinName, nodeout)
-		increment = 1
-		# If first/middle/last specified, handle getting those frames
-		if formatinfo.get('fml'):
-			increment = (int(frameout) - int(framein)) // 2
-		# If specified by preferences, set the colorspace to the input
-		if formatinfo.get("overrideJpegColorspace"):
-			bitsPerChannel = nodein.metadata()['input/bitsperchannel']
-			if bitsPerChannel == "8-bit fixed":
-				overrideColorSpace = str(formatinfo.get("overrideJpegColorspace"))
-				nodein['colorspace'].setValue(overrideColorSpace)
-        # If this is a slate frame, make a temporary store the actual frame number
-		slateFrameOut = 0
-		# Make sure the pad the frames by 1 to account for slate
-		if blastOptions.createSlate and formatinfo.get("slate_node"):
-			framein = framein - 1
-		if formatinfo.get('single_frame'):
-			framein = 1000
-			slateFrameOut = blastOptions.frameout
-			frameout = framein
-		# Set the project frame range
-		nuke.Root()['first_frame'].setValue(framein)
-		nuke.Root()['last_frame'].setValue(frameout)
-		# Set the key on the slate to put it at the beginning
-		if blastOptions.createSlate:
-			keySlate(formatinfo, framein)
-		# Fill out the information for the burnin
-		editBurnin(blastOptions, formatinfo)
-		slateFrameIn = framein
-		if not slateFrameOut:
-			slateFrameOut = frameout
-		editSlate(blastOptions, formatinfo, slateFrameIn, slateFrameOut)
-		nukeNodeOut = nuke.toNode(nodeout)
-		outputfilepath = setOutputNode(
-			nukeNodeOut,
-			blastOptions,
-			formatinfo,
-			blastOptions.filename
+	increment = 1
+	# If first/middle/last specified, handle getting those frames
+	if formatinfo.get('fml'):
+		increment = (int(frameout) - int(framein)) // 2
+	# If specified by preferences, set the colorspace to the input
+	if formatinfo.get("overrideJpegColorspace"):
+		bitsPerChannel = nodein.metadata()['input/bitsperchannel']
+		if bitsPerChannel == "8-bit fixed":
+			overrideColorSpace = str(formatinfo.get("overrideJpegColorspace"))
+			nodein['colorspace'].setValue(overrideColorSpace)
+	# If this is a slate frame, make a temporary store the actual frame number
+	slateFrameOut = 0
+	# Make sure the pad the frames by 1 to account for slate
+	if blastOptions.createSlate and formatinfo.get("slate_node"):
+		framein = framein - 1
+	if formatinfo.get('single_frame'):
+		framein = 1000
+		slateFrameOut = blastOptions.frameout
+		frameout = framein
+	# Set the project frame range
+	nuke.Root()['first_frame'].setValue(framein)
+	nuke.Root()['last_frame'].setValue(frameout)
+	# Set the key on the slate to put it at the beginning
+	if blastOptions.createSlate:
+		keySlate(formatinfo, framein)
+	# Fill out the information for the burnin
+	editBurnin(blastOptions, formatinfo)
+	slateFrameIn = framein
+	if not slateFrameOut:
+		slateFrameOut = frameout
+	editSlate(blastOptions, formatinfo, slateFrameIn, slateFrameOut)
+	print "Frame in is {0}. Frame out is {1}".format(framein, frameout)
+	# Set the time code for one frame afterwards
+	addTimeCode(formatinfo, framein)
+
+	# These options are shot dependent and therefore require a shot.
+	if blastOptions.shot:
+		# Avoid color if option is set
+		if blastOptions.nolut or not hasShotgun():
+			setLUTSwitch(formatinfo)
+		if blastOptions.nocdl or not hasShotgun():
+			setCDLSwitch(formatinfo)
+
+		# Apply postmove
+		if blastOptions.applyPostmove:
+			applyPostmove(formatinfo, resolver, nodein)
+
+		# If a postmove is applied, we can disable apply distortion.
+		# However, if apply postmove is specified, this should not change
+		# whether the distortion needs to be applied.
+		if (not blastOptions.applyPostmove and
+				getPostmove(formatinfo, resolver)):
+			blastOptions.applyDistortion = False
+
+		# Apply distortion
+		if blastOptions.applyDistortion:
+			applyDistortion(formatinfo, resolver)
+
+		if blastOptions.applyUndistortion:
+			applyDistortion(formatinfo, resolver, distort=False)
+		# Set the color information. This is retrieved from the shot data
+		if not blastOptions.noaudio and hasShotgun():
+			setColor(formatinfo, resolver, colorSources, encodeLUT)
+	return (framein, frameout, increment)
+
+def prepareOutput(blastOptions, formatname, formatinfo, resolver, framein, frameout, increment, staging=None, colorSources=None):
+	""" Set up the output node of a format.
+
+	Args:
+		blastOptions(argparse.Namespace) : Options brought from argument parser
+		formatname(str) : Name of the format
+		formatinfo(dict) : Dictionary of blast format options
+		resolver(ShotgunResolver) : Resolved shotgun data for the shot.
+		framein(int) : First frame to render
+		frameout(int) : Last frame to render
+		increment(int) : Frame step
+		staging(StagingArea) : Where the intermediates of encoded formats
+			may be rendered instead of the output directory.
+		colorSources(dict) : The shot's color, see getColorSources.
+
+	Returns:
+		dict - The render job for the format.
+
+	"""
+	nodeinName = formatinfo["nodes"][0]
+	nodeout = formatinfo["nodes"][1]
+	print "NODE OUT IS {0}".format(nodeout)
+	intermediate = encodeprofiles.getIntermediate(formatinfo)
+	formatinfo["ext"] = encodeprofiles.getFrameExt(
+		formatinfo,
+		nuke.toNode(nodeinName)['file'].value()
+	)
+	nukeNodeOut = nuke.toNode(nodeout)
+	outputfilepath = setOutputNode(
+		nukeNodeOut,
+		blastOptions,
+		formatinfo,
+		blastOptions.filename
+	)
+	sequencepath = outputfilepath
+	stageDir = None
+	if staging and canStageFormat(blastOptions, formatinfo):
+		stageDir = staging.stage(
+			getStagingBaseDir(formatinfo),
+			formatname,
+			getIntermediateBytes(nukeNodeOut, intermediate, framein, frameout, increment)
 		)
-		print "Frame in is {0}. Frame out is {1}".format(framein, frameout)
-		# Set the time code for one frame afterwards
-		addTimeCode(formatinfo, framein)
-
-		# These options are shot dependent and therefore require a shot.
-		audioFile = None
-		if blastOptions.shot:
-			# Avoid color if option is set
-			if blastOptions.nolut or 'blursg' not in sys.modules.keys():
-				setLUTSwitch(formatinfo)
-			if blastOptions.nocdl or 'blursg' not in sys.modules.keys():
-				setCDLSwitch(formatinfo)
-
-			# Apply postmove
-			if blastOptions.applyPostmove:
-				applyPostmove(formatinfo, blastOptions.project, blastOptions.shot, nodein)
-
-			# If a postmove is applied, we can disable apply distortion.
-			# However, if apply postmove is specified, this should not change
-			# whether the distortion needs to be applied.
-			if (not blastOptions.applyPostmove and
-					getPostmove(formatinfo, blastOptions.project, blastOptions.shot)):
-				blastOptions.applyDistortion = False
-
-			# Apply distortion
-			if blastOptions.applyDistortion:
-				applyDistortion(formatinfo, blastOptions.project, blastOptions.shot)
-
-			if blastOptions.applyUndistortion:
-				applyDistortion(
-					formatinfo,
-					blastOptions.project,
-					blastOptions.shot,
-					distort=False
+	if stageDir:
+		sequencepath = "/".join([stageDir.replace("\\", "/"), os.path.basename(outputfilepath)])
+		nukeNodeOut["file"].setValue(sequencepath)
+	# Set audio on the output node.
+	audioFile = None
+	if blastOptions.shot and not blastOptions.noaudio:
+		audioFile = addAudio(nukeNodeOut, resolver)
+	# Formats with encode_lut get their color from ffmpeg
+	if not formatinfo.get("encode_lut"):
+		colorSources = None
+	return {
+		"name" : formatname,
+		"formatinfo" : formatinfo,
+		"nodeout" : nodeout,
+		"framein" : framein,
+		"frameout" : frameout,
+		"increment" : increment,
+		"outputfilepath" : outputfilepath,
+		"sequencepath" : sequencepath,
+		"stageDir" : stageDir,
+		"audioFile" : audioFile,
+		"colorSources" : colorSources,
+	}
+
+def getJobSequence(job):
+	""" Returns the #### pattern the job's frames are rendered to, which is
+	in a staging directory for staged intermediates.
+	"""
+	return job.get("sequencepath") or job["outputfilepath"]
+
+def getJobFrames(job):
+	""" Returns every frame the job renders. """
+	return range(job["framein"], job["frameout"] + 1, max(job["increment"], 1))
+
+def getFramePath(pattern, frame):
+	""" Returns the path of a frame in a #### file pattern. """
+	return pattern.replace("####", str(frame).zfill(4))
+
+def getFrameRanges(frames):
+	""" Collapse a sorted list of frames into (first, last, 1) ranges. """
+	ranges = []
+	for frame in frames:
+		if ranges and ranges[-1][1] + 1 == frame:
+			ranges[-1] = (ranges[-1][0], frame, 1)
+		else:
+			ranges.append((frame, frame, 1))
+	return ranges
+
+def getFrameChunks(frames, chunks):
+	""" Split the frames into at most chunks contiguous lists of frames. """
+	if not frames:
+		return []
+	size = int(math.ceil(len(frames) / float(max(chunks, 1))))
+	return [frames[index:index + size] for index in range(0, len(frames), size)]
+
+def renderChunks(scriptPath, nodeNames, frames, chunks):
+	""" Render the frames in parallel child Nuke processes.
+
+	Each process renders a contiguous chunk of the frames from the saved
+	script, so the slate keys saved with it land in whichever chunk holds
+	the first frame.  Returns once every chunk has finished.
+
+	Args:
+		scriptPath(str) : The saved script to render from.
+		nodeNames(list) : The write nodes to render.
+		frames(list) : Sorted frames to render.
+		chunks(int) : Number of processes to split the frames across.
+
+	"""
+	frameChunks = getFrameChunks(frames, chunks)
+	if not frameChunks:
+		return
+	threads = max(multiprocessing.cpu_count() // len(frameChunks), 1)
+	processes = []
+	for chunkFrames in frameChunks:
+		cmdArgs = [
+			sys.executable,
+			"-x",
+			"-m", str(threads),
+			"-X", ",".join(nodeNames),
+		]
+		for first, last, increment in getFrameRanges(chunkFrames):
+			cmdArgs.extend(["-F", "{0}-{1}".format(first, last)])
+		cmdArgs.append(scriptPath)
+		print "Rendering chunk: {0}".format(" ".join(cmdArgs))
+		processes.append(subprocess.Popen(cmdArgs))
+	failed = [process for process in processes if process.wait() != 0]
+	if failed:
+		print "{0} of {1} render chunks failed".format(len(failed), len(processes))
+		sys.exit(1)
+
+def renderJobs(jobs, scriptPath, frames=None, chunks=None):
+	""" Render every job.  Several jobs share the frame range and are
+	rendered together so the upstream graph is only evaluated once per frame.
+	Formats asking for render_chunks are split across child Nuke processes
+	rendering from scriptPath, unless chunks overrides it.  frames limits the
+	render to a subset of the frame range.
+	"""
+	nodes = [nuke.toNode(job["nodeout"]) for job in jobs]
+	job = jobs[0]
+	if chunks is None:
+		chunks = int(job["formatinfo"].get("render_chunks", 1))
+	# A movie can only be written by a single process
+	if any(job["formatinfo"]["ext"] == ".mov" for job in jobs):
+		chunks = 1
+	if chunks > 1:
+		renderChunks(
+			scriptPath,
+			[job["nodeout"] for job in jobs],
+			frames or getJobFrames(job),
+			chunks
+		)
+	elif frames is not None:
+		print "Rendering frames {0}".format(
+			", ".join("{0}-{1}".format(first, last) for first, last, _ in getFrameRanges(frames))
+		)
+		renderFrames(nodes, frames)
+	elif len(nodes) == 1:
+		render(nodes[0], job["framein"], job["frameout"], job["increment"])
+	else:
+		print "Rendering {0} in a single pass".format(
+			", ".join(job["name"] for job in jobs)
+		)
+		renderMultiple(nodes, job["framein"], job["frameout"], job["increment"])
+
+def getScratchDir(prefix):
+	""" Returns a new local scratch directory, in shared memory if the
+	machine has it.
+	"""
+	baseDir = None
+	if os.path.isdir("/dev/shm"):
+		baseDir = "/dev/shm"
+	return tempfile.mkdtemp(prefix=prefix, dir=baseDir)
+
+def getFreeBytes(path):
+	""" Returns the space available to the user on the disk holding path. """
+	if hasattr(os, "statvfs"):
+		stats = os.statvfs(path)
+		return stats.f_bavail * stats.f_frsize
+	import ctypes
+	freeBytes = ctypes.c_ulonglong(0)
+	ctypes.windll.kernel32.GetDiskFreeSpaceExW(
+		ctypes.c_wchar_p(path),
+		ctypes.pointer(freeBytes),
+		None,
+		None
+	)
+	return freeBytes.value
+
+def canStageFormat(blastOptions, formatinfo):
+	""" Returns True if the intermediates of the format can be rendered to a
+	local staging directory.  They must stay in the output directory when
+	another task encodes them or an incremental blast renders on top of
+	them, and streamed encodes use their own scratch directory.
+	"""
+	return bool(
+		formatinfo.get("stage_intermediate") and
+		needsEncode(blastOptions, formatinfo) and
+		not (
+			blastOptions.incremental or
+			blastOptions.renderonly or
+			blastOptions.chunk or
+			blastOptions.streamencode
+		)
+	)
+
+def getStagingBaseDir(formatinfo):
+	""" Returns the directory a format stages its intermediates under.
+
+	stage_intermediate may name the directory.  Otherwise BLAST_STAGING_DIR
+	is used, then shared memory and then the temp directory.
+	"""
+	stageIntermediate = formatinfo.get("stage_intermediate")
+	if isinstance(stageIntermediate, basestring):
+		return stageIntermediate
+	if os.environ.get("BLAST_STAGING_DIR"):
+		return os.environ["BLAST_STAGING_DIR"]
+	if os.path.isdir("/dev/shm"):
+		return "/dev/shm"
+	return tempfile.gettempdir()
+
+def getIntermediateBytes(node, intermediate, framein, frameout, increment):
+	""" Returns the most space the intermediates of a job can take. """
+	frames = len(range(framein, frameout + 1, max(increment, 1)))
+	return node.width() * node.height() * intermediate["bytesPerPixel"] * frames
+
+class StagingArea(object):
+	""" Local directories the intermediates of encoded formats are rendered
+	to instead of the network output directory.
+
+	The space of every staged format is reserved until the blast is done,
+	so formats staged side by side can not fill the disk between them.
+	"""
+	# Space left free on top of the estimate of the intermediates.
+	HEADROOM = 1.1
+
+	def __init__(self):
+		self.reserved = {}
+		self.directories = []
+
+	def stage(self, baseDir, name, size):
+		""" Create a staging directory for a format.
+
+		Args:
+			baseDir(str) : The directory to stage under.
+			name(str) : Name of the format.
+			size(int) : Most bytes the intermediates can take.
+
+		Returns:
+			str - The directory, or None if baseDir does not have the space.
+
+		"""
+		try:
+			freeBytes = getFreeBytes(baseDir) - self.reserved.get(baseDir, 0)
+		except OSError as e:
+			print "Unable to stage {0} under {1}: {2}".format(name, baseDir, e)
+			return None
+		if size * self.HEADROOM > freeBytes:
+			print "Not staging {0}, {1} needs {2} MB and has {3} MB free".format(
+				name,
+				baseDir,
+				int(size * self.HEADROOM) // (1024 * 1024),
+				freeBytes // (1024 * 1024)
+			)
+			return None
+		self.reserved[baseDir] = self.reserved.get(baseDir, 0) + size
+		directory = tempfile.mkdtemp(prefix="BlastStage_{0}_".format(name), dir=baseDir)
+		self.directories.append(directory)
+		return directory
+
+	def cleanup(self):
+		""" Remove every staging directory that is left. """
+		for directory in self.directories:
+			shutil.rmtree(directory, ignore_errors=True)
+		self.directories = []
+		self.reserved = {}
+
+class EncodeError(Exception):
+	pass
+
+class StreamEncoder(object):
+	""" An ffmpeg process encoding the movies of a job from frames piped to
+	its stdin.
+
+	Args:
+		outputs(list) : The encodes to write, see getJobEncodeOutputs.
+		audio(str) : Optional audio file to mux in.
+		fps(float) : Frame rate of the movies.
+		lutFile(str) : Optional cube LUT applied to the frames.
+		inputCodec(str) : The ffmpeg codec of the piped frames.
+
+	"""
+	def __init__(self, outputs, audio=None, fps=encodeprofiles.DEFAULT_FPS, lutFile=None, inputCodec="png"):
+		self.outputs = outputs
+		cmdArgs = encodeprofiles.buildEncodeCommand(
+			FFMPEG_EXECUTABLE,
+			encodeprofiles.getPipeInput(fps, inputCodec),
+			outputs,
+			audio if audio and os.path.exists(audio) else None,
+			lutFile,
+			fps
+		)
+		print "FFMPEG COMMAND: {0}".format(" ".join(cmdArgs))
+		self.process = subprocess.Popen(cmdArgs, stdin=subprocess.PIPE)
+
+	def write(self, framePath, remove=True):
+		""" Send a rendered frame to ffmpeg, removing it afterwards unless
+		remove is False.
+		"""
+		with open(framePath, "rb") as frame:
+			shutil.copyfileobj(frame, self.process.stdin)
+		if remove:
+			os.remove(framePath)
+
+	def close(self):
+		""" Finish the movie and return the ffmpeg return code. """
+		self.process.stdin.close()
+		return self.process.wait()
+
+def canStreamJob(blastOptions, job):
+	""" Returns True if the job's frames can be piped straight into ffmpeg.
+	Incremental blasts need the sequence on disk, so they never stream.
+	"""
+	return bool(
+		blastOptions.streamencode and
+		not blastOptions.incremental and
+		needsEncode(blastOptions, job["formatinfo"])
+	)
+
+def streamJobs(jobs):
+	""" Render the jobs one frame at a time into local scratch and pipe every
+	frame into ffmpeg as soon as it is written.  The intermediate sequence
+	never reaches the output directory.
+	"""
+	framein = jobs[0]["framein"]
+	frameout = jobs[0]["frameout"]
+	increment = max(jobs[0]["increment"], 1)
+	scratchDir = getScratchDir("BlastStream")
+	nodes = [nuke.toNode(job["nodeout"]) for job in jobs]
+	encoders = []
+	returncodes = []
+	try:
+		for job, node in zip(jobs, nodes):
+			framePattern = "/".join([
+				scratchDir.replace("\\", "/"),
+				os.path.basename(job["outputfilepath"])
+			])
+			node["file"].setValue(framePattern)
+			job["framePattern"] = framePattern
+			encoders.append(StreamEncoder(
+				getJobEncodeOutputs(job),
+				job["audioFile"],
+				lutFile=getJobLUT(job),
+				inputCodec=encodeprofiles.getIntermediate(job["formatinfo"])["codec"]
+			))
+		for frame in range(framein, frameout + 1, increment):
+			if len(nodes) == 1:
+				render(nodes[0], frame, frame)
+			else:
+				renderMultiple(nodes, frame, frame)
+			for job, encoder in zip(jobs, encoders):
+				encoder.write(job["framePattern"].replace("####", str(frame).zfill(4)))
+	finally:
+		for encoder in encoders:
+			returncodes.append(encoder.close())
+		shutil.rmtree(scratchDir, ignore_errors=True)
+	failed = [
+		encoder.outputs[0]["path"] for encoder, returncode in zip(encoders, returncodes)
+		if returncode != 0
+	]
+	if failed:
+		raise EncodeError("Streaming encode of {0} failed".format(", ".join(failed)))
+
+class SequenceFollower(threading.Thread):
+	""" Encodes a job's image sequence while it is still rendering.
+
+	Frames are piped into ffmpeg in order as they land on disk.  A frame is
+	only taken once the next frame exists or the render has finished, and
+	its size has stopped changing, so a frame still being written is never
+	read.  Missing frames are waited on.
+
+	Args:
+		job(dict) : The render job to follow.
+		pollInterval(float) : Seconds between checks for the next frame.
+		settleInterval(float) : Seconds a frame's size must hold still.
+
+	"""
+	def __init__(self, job, pollInterval=0.5, settleInterval=0.05):
+		super(SequenceFollower, self).__init__()
+		self.daemon = True
+		self.job = job
+		self.pollInterval = pollInterval
+		self.settleInterval = settleInterval
+		self.renderDone = threading.Event()
+		self.returncode = None
+		self.error = None
+
+	def getFramePath(self, frame):
+		return getJobSequence(self.job).replace("####", str(frame).zfill(4))
+
+	def waitForFrame(self, frame, nextFrame):
+		""" Block until the frame is complete.  Returns False if the render
+		finished without writing it, or left it empty.
+		"""
+		framePath = self.getFramePath(frame)
+		nextPath = self.getFramePath(nextFrame)
+		lastSize = -1
+		while True:
+			done = self.renderDone.is_set()
+			if os.path.exists(framePath):
+				# Frames are written in order, so the frame is complete once
+				# the next one exists or the render is over.  Its size must
+				# also settle in case the writer is still flushing it.
+				size = os.path.getsize(framePath)
+				if size and (done or os.path.exists(nextPath)):
+					if size == lastSize:
+						return True
+					lastSize = size
+					time.sleep(self.settleInterval)
+					continue
+				if done:
+					return False
+				lastSize = size
+			elif done:
+				return False
+			time.sleep(self.pollInterval)
+
+	def run(self):
+		job = self.job
+		increment = max(job["increment"], 1)
+		encoder = StreamEncoder(
+			getJobEncodeOutputs(job),
+			job["audioFile"],
+			lutFile=getJobLUT(job),
+			inputCodec=encodeprofiles.getIntermediate(job["formatinfo"])["codec"]
+		)
+		try:
+			for frame in range(job["framein"], job["frameout"] + 1, increment):
+				if not self.waitForFrame(frame, frame + increment):
+					self.error = "Frame {0} was never rendered or is empty".format(self.getFramePath(frame))
+					break
+				encoder.write(self.getFramePath(frame), remove=False)
+		except (IOError, OSError) as e:
+			self.error = str(e)
+		finally:
+			self.returncode = encoder.close()
+
+	def finish(self):
+		""" Wait for the encode to catch up once the render is done.
+
+		Returns:
+			bool - True if the movie was encoded.
+
+		"""
+		self.renderDone.set()
+		self.join()
+		if self.error:
+			print self.error
+		return self.returncode == 0 and not self.error
+
+class SequencePublisher(SequenceFollower):
+	""" Publishes a job's frames while it is still rendering.  Frames are
+	queued for upload as soon as they are complete.
+
+	Args:
+		job(dict) : The render job to follow.
+		publisher(OutputPublisher) : Uploads the frames.
+		pollInterval(float) : Seconds between checks for the next frame.
+
+	"""
+	def __init__(self, job, publisher, pollInterval=0.5):
+		super(SequencePublisher, self).__init__(job, pollInterval)
+		self.publisher = publisher
+
+	def run(self):
+		job = self.job
+		increment = max(job["increment"], 1)
+		try:
+			for frame in range(job["framein"], job["frameout"] + 1, increment):
+				if not self.waitForFrame(frame, frame + increment):
+					self.error = "Frame {0} was never rendered or is empty".format(self.getFramePath(frame))
+					break
+				self.publisher.publish(self.getFramePath(frame))
+		finally:
+			self.returncode = 0
+
+def canWriteBehind(blastOptions):
+	""" Returns True if the blast can render locally and publish its outputs
+	in the background.  Incremental blasts render on top of the outputs
+	already delivered, and farm tasks leave their outputs for the encode
+	task, so they write to the output directory.
+	"""
+	return bool(
+		blastOptions.writebehind and
+		blastOptions.output and
+		not (
+			blastOptions.incremental or
+			blastOptions.renderonly or
+			blastOptions.chunk
+		)
+	)
+
+def canPublishFollowJob(blastOptions, job):
+	""" Returns True if the job's frames can be published as they render.
+	Render chunks write their frames out of order, so their frames are only
+	published once the render is done.
+	"""
+	return bool(
+		"####" in job["outputfilepath"] and
+		not needsEncode(blastOptions, job["formatinfo"]) and
+		int(job["formatinfo"].get("render_chunks", 1)) <= 1
+	)
+
+def publishJob(blastOptions, job, publisher):
+	""" Queue every output of a finished job for upload. """
+	for path in getJobOutputs(blastOptions, job):
+		if os.path.isfile(path):
+			publisher.publish(path)
+
+def getJobOutputs(blastOptions, job):
+	""" Returns the files a finished job leaves in the output directory. """
+	outputfilepath = job["outputfilepath"]
+	if needsEncode(blastOptions, job["formatinfo"]):
+		return [output["path"] for output in getJobEncodeOutputs(job)]
+	if "####" not in outputfilepath:
+		return [outputfilepath]
+	return [getFramePath(outputfilepath, frame) for frame in getJobFrames(job)]
+
+def removeJobOutputs(blastOptions, job, frames=None):
+	""" Remove the outputs the job is about to rewrite.  Stale frames would
+	be picked up by an overlapped encode, and outputs reused from the render
+	cache may be links that must not be overwritten in place.
+
+	Args:
+		blastOptions(argparse.Namespace) : Options brought from argument parser
+		job(dict) : The render job.
+		frames(list) : Only remove these frames of the sequence.
+
+	"""
+	sequence = getJobSequence(job)
+	paths = []
+	if needsEncode(blastOptions, job["formatinfo"]):
+		paths.extend(output["path"] for output in getJobEncodeOutputs(job))
+	if "####" in sequence:
+		if frames is None:
+			frames = getJobFrames(job)
+		paths.extend(getFramePath(sequence, frame) for frame in frames)
+	else:
+		paths.append(sequence)
+	for path in paths:
+		if os.path.isfile(path):
+			os.remove(path)
+
+def getManifestPath(job):
+	""" Returns the frame manifest path stored next to the job's outputs.
+	It is named after the format, as formats can share an output directory
+	and basename.
+	"""
+	directory, basename = os.path.split(job["outputfilepath"])
+	name = os.path.splitext(re.sub(r"[._]?####", "", basename))[0]
+	return "/".join([directory, "{0}.{1}.blastmanifest.json".format(name, job["name"])])
+
+def getChangedFrames(blastOptions, jobs, fingerprint):
+	""" Work out which frames an incremental blast has to render.
+
+	Every output frame is keyed by the stats of its source frame and the
+	render settings of its format.  Frames whose key matches the manifest
+	left by the previous blast, and whose output still exists, are skipped.
+
+	Returns:
+		list - Sorted frames to render, or None if the jobs do not write an
+		image sequence and have to render in full.
+
+	"""
+	changed = set()
+	for job in jobs:
+		outputfilepath = job["outputfilepath"]
+		if "####" not in outputfilepath:
+			return None
+		settingsDigest = fingerprint.getSettingsDigest([job["name"]])
+		job["frameDigests"] = dict(
+			(frame, FrameManifest.getFrameDigest(
+				settingsDigest,
+				getFramePath(blastOptions.file, frame)
+			))
+			for frame in getJobFrames(job)
+		)
+		job["manifest"] = FrameManifest(getManifestPath(job))
+		changed.update(job["manifest"].getChangedFrames(
+			job["frameDigests"],
+			lambda frame: getFramePath(outputfilepath, frame)
+		))
+	return sorted(changed)
+
+def completeJob(blastOptions, job, follower=None, renderCache=None, publisher=None):
+	""" Finish the encode of a rendered job, cache its outputs and queue
+	them for upload.
+	"""
+	if follower is None:
+		encodeJob(blastOptions, job)
+	else:
+		finishFollower(follower, keepSequence=blastOptions.incremental)
+	if renderCache:
+		renderCache.store(job["fingerprint"], getJobOutputs(blastOptions, job), blastOptions.output)
+	if publisher:
+		publishJob(blastOptions, job, publisher)
+
+def finishFollower(follower, keepSequence=False):
+	""" Wait for an overlapped encode and clean up its sequence. """
+	if not follower.finish():
+		raise EncodeError("Overlapped encode of {0} failed".format(follower.job["name"]))
+	if not keepSequence:
+		deleteJobSequence(follower.job)
+
+class EncodePool(object):
+	""" Runs the encodes on a bounded pool of threads so the next format can
+	render while the previous one encodes.  Failures are collected and
+	reported together once every encode has finished.
+
+	Args:
+		size(int) : Number of encodes allowed to run at once.
+		timer(BlastTimer) : Optional timer recording every encode.
+
+	"""
+	def __init__(self, size, timer=None):
+		self.pool = ThreadPool(max(size, 1))
+		self.timer = timer
+		self.results = []
+		self.errors = []
+
+	def submit(self, name, func, *args):
+		self.results.append((name, self.pool.apply_async(self.run, (name, func) + args)))
+
+	def run(self, name, func, *args):
+		if self.timer is None:
+			return func(*args)
+		with self.timer.span("encode", formats=[name]):
+			return func(*args)
+
+	def wait(self):
+		""" Block until every encode is done.
+
+		Returns:
+			list - A message for every encode that failed.
+
+		"""
+		self.pool.close()
+		self.pool.join()
+		results, self.results = self.results, []
+		for name, result in results:
+			try:
+				result.get()
+			except Exception as e:
+				self.errors.append("{0}: {1}".format(name, e))
+		return self.errors
+
+def canOverlapJob(blastOptions, job):
+	""" Returns True if the job can be encoded while it renders.  Following
+	the sequence relies on a single writer rendering the frames in order,
+	which render chunks and farm chunks do not.  Incremental blasts render
+	between frames already on disk, so they never overlap either.
+	"""
+	return bool(
+		blastOptions.overlapencode and
+		needsEncode(blastOptions, job["formatinfo"]) and
+		int(job["formatinfo"].get("render_chunks", 1)) <= 1 and
+		not blastOptions.chunk and
+		not blastOptions.incremental
+	)
+
+def deleteJobSequence(job):
+	""" Delete the review image file sequence of an encoded job. """
+	if job.get("stageDir"):
+		shutil.rmtree(job["stageDir"], ignore_errors=True)
+		return
+	fileSequencePath = job["outputfilepath"].replace(
+		"####",
+		"{0}-{1}".format(
+			str(job["framein"]).zfill(4),
+			str(job["frameout"]).zfill(4)
+		)
+	)
+	from blur3d.pipe.cinematic.api.filesequence import FileSequence
+	fileSequence = FileSequence(fileSequencePath)
+	fileSequence.delete()
+
+def needsEncode(blastOptions, formatinfo):
+	""" Returns True if the format's image sequence is encoded to a movie. """
+	return bool(blastOptions.runffmpeg and encodeprofiles.isEncoded(formatinfo))
+
+def getJobEncodeOutputs(job):
+	""" Returns the encodes of the job with the movie each one writes. """
+	return encodeprofiles.getEncodeOutputs(
+		job["formatinfo"],
+		getMoviePath(job["outputfilepath"].replace("####", "%04d"))
+	)
+
+def writeEncodeLog(blastOptions, cmdArgs, blastBackupDir=None):
+	""" Write the ffmpeg command to the blast backup directory so the encode
+	can be run again by hand.
+
+	Args:
+		blastOptions(argparse.Namespace) : Options brought from argument parser
+		cmdArgs(list) : The ffmpeg command.
+		blastBackupDir(str) : The backup directory, looked up in trax if
+			not given.
+
+	Returns:
+		str - The path of the command file.
+
+	"""
+	if blastBackupDir is None:
+		blastBackupDir = getBlastBackupNukeDir(
+			blastOptions.project,
+			blastOptions.shot,
+			blastOptions.asset
+		)
+	datestr = datetime.now().strftime("%m_%d_%y_%H_%M")
+	basename = "{0}_{1}_{2}.bat".format("FFMPEG", blastOptions.shot, datestr)
+	commandPath = os.path.join(blastBackupDir, basename)
+	with open(commandPath, "w") as logfile:
+		logfile.write(subprocess.list2cmdline(cmdArgs))
+	return commandPath
+
+def encodeJob(blastOptions, job):
+	""" Run the ffmpeg step on a rendered job if the format needs it.
+
+	Every movie of the format is written by a single ffmpeg process, so
+	the sequence is only read and decoded once.
+	"""
+	if not needsEncode(blastOptions, job["formatinfo"]):
+		return
+	audio = job["audioFile"]
+	cmdArgs = encodeprofiles.buildEncodeCommand(
+		FFMPEG_EXECUTABLE,
+		encodeprofiles.getSequenceInput(
+			str(getJobSequence(job).replace("####", "%04d")),
+			job["framein"]
+		),
+		getJobEncodeOutputs(job),
+		audio if audio and os.path.exists(audio) else None,
+		getJobLUT(job)
+	)
+	print "FFMPEG COMMAND: {0}".format(" ".join(cmdArgs))
+	# Encodes run on pool threads, which must not call trax themselves
+	commandPath = writeEncodeLog(blastOptions, cmdArgs, job.get("backupDir"))
+	# The ffmpeg output is logged next to the command, with its progress
+	returncode, output, error = processlog.runStreamed(
+		cmdArgs,
+		os.path.splitext(commandPath)[0] + "_{0}.log".format(job["name"])
+	)
+	if returncode != 0:
+		raise EncodeError("ffmpeg failed encoding {0} with return code {1}:\n{2}".format(
+			job["name"],
+			returncode,
+			"\n".join(error.splitlines()[-20:])
+		))
+	# Incremental blasts render on top of the sequence next time
+	if not blastOptions.incremental:
+		deleteJobSequence(job)
+
+def reuseCachedJobs(blastOptions, jobs, renderCache, fingerprint):
+	""" Reuse the cached outputs of every job whose inputs have not changed.
+
+	Returns:
+		list - The jobs that still need to be rendered.
+
+	"""
+	remaining = []
+	for job in jobs:
+		job["fingerprint"] = fingerprint.getDigest([job["name"]])
+		if renderCache.fetch(job["fingerprint"], blastOptions.output) is not None:
+			print "Reusing the cached render of {0}".format(job["name"])
+			continue
+		remaining.append(job)
+	return remaining
+
+def getChunkFrames(chunk, frames):
+	""" Returns the frames of one chunk of a farm blast.
+
+	Args:
+		chunk(str) : The chunk as INDEX/COUNT, INDEX starting at 0.
+		frames(list) : Sorted frames of the whole blast.
+
+	Returns:
+		list - The frames to render, empty if the chunk has none.
+
+	"""
+	index, count = [int(value) for value in chunk.split("/")]
+	frameChunks = getFrameChunks(frames, count)
+	if index >= len(frameChunks):
+		return []
+	return frameChunks[index]
+
+def getJobFilePath(blastBackupDir, formatname):
+	""" Returns where a render only blast leaves the job for its encode. """
+	return "/".join([blastBackupDir, ".blastjobs", formatname + ".json"])
+
+def writeJobFile(blastOptions, job):
+	""" Record what the encode of a render only blast needs.
+
+	Returns:
+		str - The job file, kept with the blast backup.
+
+	"""
+	path = getJobFilePath(job.get("backupDir") or blastOptions.output, job["name"])
+	makeDirs(os.path.dirname(path))
+	keys = ["name", "formatinfo", "framein", "frameout", "increment", "outputfilepath", "audioFile", "colorSources"]
+	jobinfo = {
+		"job" : dict((key, job.get(key)) for key in keys),
+		"options" : {
+			"runffmpeg" : blastOptions.runffmpeg,
+			"project" : blastOptions.project,
+			"shot" : blastOptions.shot,
+			"asset" : blastOptions.asset,
+			"incremental" : blastOptions.incremental,
+		},
+	}
+	# Every chunk writes the same job, so write it aside and move it in
+	writeFile(path, json.dumps(jobinfo))
+	return path
+
+def claimEncode(jobFile, chunk, farmJob=None):
+	""" Record that a chunk of a farm graph blast finished rendering.
+
+	The farm runs the chunks of a format in any order, so the last one to
+	finish encodes the movie.  Every chunk leaves a marker next to the job
+	file, and the encode is claimed by creating a file exclusively so only
+	one chunk runs it when several finish at once.
+
+	Args:
+		jobFile(str) : The job written by writeJobFile.
+		chunk(str) : The chunk as INDEX/COUNT.
+		farmJob(str) : Id shared by the chunks of the blast, which keeps
+			markers left by an earlier submission from counting.
+
+	Returns:
+		str - The claim, to remove if the encode fails so a retried chunk
+		can run it.  None if the encode is left to another chunk.
+
+	"""
+	index, count = [int(value) for value in chunk.split("/")]
+	prefix = "{0}.{1}".format(jobFile, farmJob or "chunks")
+	writeFile("{0}.{1}.done".format(prefix, index), "")
+	if not all(os.path.exists("{0}.{1}.done".format(prefix, other)) for other in range(count)):
+		return None
+	claimPath = prefix + ".encode"
+	try:
+		os.close(os.open(claimPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+	except OSError:
+		return None
+	return claimPath
+
+def finishRenderOnlyJob(blastOptions, job):
+	""" Leave the job for its encode.  A chunk of a farm graph blast runs
+	the encode itself once every chunk of the format has rendered.
+
+	Returns:
+		bool - False if the encode ran and failed.
+
+	"""
+	jobFile = writeJobFile(blastOptions, job)
+	if not blastOptions.chunk:
+		return True
+	claimPath = claimEncode(jobFile, blastOptions.chunk, blastOptions.farmjob)
+	if claimPath is None:
+		return True
+	print "Every chunk of {0} rendered, encoding it".format(job["name"])
+	if runEncodeJob(jobFile) == 0:
+		return True
+	os.remove(claimPath)
+	return False
+
+def runEncodeJob(jobFile):
+	""" Encode the frames of a render only blast.  Does not need Nuke.
+
+	Args:
+		jobFile(str) : The job left by the render tasks.
+
+	Returns:
+		int - The return code of the encode.
+
+	"""
+	if not os.path.exists(jobFile):
+		print "Nothing to encode, {0} does not exist".format(jobFile)
+		return 0
+	with open(jobFile, "r") as fileinfo:
+		jobinfo = json.loads(fileinfo.read())
+	try:
+		encodeJob(argparse.Namespace(**jobinfo["options"]), jobinfo["job"])
+	except Exception:
+		traceback.print_exc()
+		return 1
+	# Remove the job along with the chunk markers of a farm graph blast
+	jobDir, jobName = os.path.split(jobFile)
+	for name in os.listdir(jobDir):
+		if name == jobName or name.startswith(jobName + "."):
+			os.remove(os.path.join(jobDir, name))
+	try:
+		os.rmdir(jobDir)
+	except OSError:
+		pass
+	return 0
+
+class PrefetchError(Exception):
+	pass
+
+class BlastPrefetch(object):
+	""" Runs the Shotgun and trax lookups of a blast on background threads.
+
+	The lookups only depend on the command line, so they are started before
+	the comp is opened and the blast collects the results as it needs them.
+	trax is not known to be thread safe, so the trax lookups run one after
+	the other on a single thread of their own.
+
+	Args:
+		blastOptions(argparse.Namespace) : Options brought from argument parser
+		resolver(ShotgunResolver) : Resolver for the blast's shot.
+		timeout(float) : Seconds to wait on a lookup.
+
+	"""
+	def __init__(self, blastOptions, resolver, timeout=PREFETCH_TIMEOUT, plateCache=None):
+		self.timeout = timeout
+		self.plateCache = plateCache
+		# Lookups that gave up, raised again instead of waited on twice
+		self.failed = {}
+		self.pool = ThreadPool(2)
+		self.traxPool = ThreadPool(1)
+		self.results = {
+			"framerate" : self.traxPool.apply_async(getProjectFramerate, (blastOptions.project,)),
+			"shotgun" : self.pool.apply_async(resolver.resolve),
+			"backupDir" : self.traxPool.apply_async(
+				getBlastBackupNukeDir,
+				(blastOptions.project, blastOptions.shot, blastOptions.asset)
+			),
+			"usertag" : self.traxPool.apply_async(getUserTag, (blastOptions.artist,)),
+		}
+		if plateCache:
+			# Copying the plates does not depend on the comp either
+			self.results["plate"] = self.pool.apply_async(
+				plateCache.fetch,
+				(blastOptions.file, getPlateFrames(blastOptions))
+			)
+		self.pool.close()
+		self.traxPool.close()
+
+	def get(self, name, timeout=-1):
+		""" Wait for a lookup and return its result.
+
+		Errors raised by the lookup are raised again here.
+
+		Args:
+			name(str) : The lookup.
+			timeout(float) : Seconds to wait, the prefetch timeout by default
+				and forever if None.
+
+		Raises:
+			PrefetchError : If the lookup did not finish within the timeout.
+
+		"""
+		if name in self.failed:
+			raise self.failed[name]
+		if timeout == -1:
+			timeout = self.timeout
+		try:
+			return self.results[name].get(timeout)
+		except multiprocessing.TimeoutError:
+			self.failed[name] = PrefetchError(
+				"Gave up on the {0} lookup after {1} seconds.  Shotgun or trax "
+				"is not responding.".format(name, timeout)
+			)
+			raise self.failed[name]
+
+	def isReady(self, name):
+		""" Returns True if the lookup finished and did not time out. """
+		return name not in self.failed and self.results[name].ready()
+
+def getReportPath(blastOptions, timer, blastBackupDir):
+	""" Returns where the timing report of the blast is written, next to the
+	blast backup scripts.
+	"""
+	tag = blastOptions.shot or blastOptions.asset or "blast"
+	datestr = datetime.fromtimestamp(timer.started).strftime("%m_%d_%y_%H_%M_%S")
+	return os.path.join(blastBackupDir, "{0}_{1}_blastreport.json".format(tag, datestr))
+
+def writeTimingReport(blastOptions, timer, returncode, prefetch):
+	""" Write the timing report and, if asked for, the Chrome trace.  A
+	report that can not be written never fails the blast.
+	"""
+	# Once a lookup gave up, the trax thread may be stuck for good
+	if prefetch.failed and not prefetch.isReady("backupDir"):
+		print "Unable to write the blast report, the backupDir lookup did not finish"
+		return
+	try:
+		reportPath = getReportPath(blastOptions, timer, prefetch.get("backupDir"))
+		timer.writeReport(
+			reportPath,
+			comp=blastOptions.comp,
+			project=blastOptions.project,
+			shot=blastOptions.shot,
+			asset=blastOptions.asset,
+			formats=blastOptions.formats,
+			args=blastOptions.args,
+			returncode=returncode,
+		)
+		print "Blast report written to {0}".format(reportPath)
+		if blastOptions.chrometrace:
+			tracePath = os.path.splitext(reportPath)[0] + ".trace.json"
+			timer.writeChromeTrace(tracePath)
+			print "Blast trace written to {0}".format(tracePath)
+	except Exception:
+		print "Unable to write the blast report"
+		traceback.print_exc()
+
+def blast(blastOptions):
+	""" Run a blast in the current Nuke session and write its timing report.
+
+	Args:
+		blastOptions(argparse.Namespace) : Options brought from argument parser
+
+	Returns:
+		int - The return code of the blast.
+
+	"""
+	timer = BlastTimer()
+	if blastOptions.clientspans:
+		launched = timer.load(blastOptions.clientspans)
+		if launched:
+			# Nuke startup, or the wait for the worker
+			timer.add("launch", launched, timer.started, "client")
+	sgCache = None
+	if not blastOptions.nosgcache:
+		sgCache = ShotgunCache()
+	resolver = ShotgunResolver(blastOptions.project, blastOptions.shot, cache=sgCache)
+	plateCache = PlateCache() if blastOptions.platecache else None
+	# Overlap the remote lookups and the plate copy with the comp open
+	prefetch = BlastPrefetch(blastOptions, resolver, plateCache=plateCache)
+	staging = StagingArea()
+	encodePool = EncodePool(blastOptions.encodethreads, timer)
+	publisher = None
+	if canWriteBehind(blastOptions):
+		publisher = OutputPublisher(
+			tempfile.mkdtemp(prefix="BlastPublish_", dir=getPublishBaseDir()),
+			blastOptions.output
+		)
+		print "Rendering to {0}, publishing to {1}".format(publisher.localDir, publisher.deliveryDir)
+		# Everything the blast writes goes to the local directory
+		blastOptions = argparse.Namespace(**vars(blastOptions))
+		blastOptions.output = publisher.localDir
+	returncode = 1
+	try:
+		returncode = runBlast(blastOptions, timer, prefetch, resolver, encodePool, staging, publisher)
+	except PrefetchError as e:
+		print e
+	finally:
+		# A failed blast leaves encodes running that still use the staging
+		# area and the publisher
+		encodePool.wait()
+		staging.cleanup()
+		if publisher:
+			# The blast is not done until the delivery share holds its outputs
+			with timer.span("publishWait"):
+				publishErrors = publisher.flush()
+			if publishErrors:
+				print "{0} output(s) failed to publish, they are left in {1}:".format(
+					len(publishErrors),
+					publisher.localDir
 				)
-			# Set audio on the output node.
-			if not blastOptions.noaudio:
-				audioFile = addAudio(nukeNodeOut, blastOptions.project, blastOptions.shot)
-			# Set the color information. This is retrieved from the shot data
-				if 'blursg' in sys.modules.keys():
-					setCDL(formatinfo, blastOptions.project, blastOptions.shot)
-					set3DL(formatinfo, blastOptions.project, blastOptions.shot)
-		# Testing to see if closing the script and opening again will fix this issue
-		shotScriptPath = getBlastBackupNukePath(blastOptions, formatname)
-		print "Saving the script"
-		nuke.scriptSave(shotScriptPath)
-		print "Closing the script"
-		nuke.scriptClose()
-		print "Reopening the script"
-		nuke.scriptOpen(shotScriptPath)
-		nukeNodeOut = nuke.toNode(nodeout)
-		render(nukeNodeOut, framein, frameout, increment)
-		if blastOptions.runffmpeg and formatinfo["ext"] == ".png" and formatinfo.get("runffmpeg"):
-			# Create a FileSequence object to generate a movie
-			fsFilepath = outputfilepath.replace("####", "%04d")
-			if blastOptions.shot:
-				elementKwarg = {'shotname' : blastOptions.shot}
-			elif blastOptions.asset:
-				elementKwarg = {'assetname' : blastOptions.asset}
+				for error in publishErrors:
+					print error
+				returncode = 1
 			else:
-				elementKwarg = {}
-			runffmpegaction(
-				framein,
-				str(fsFilepath),
-				audioFile,
-				blastOptions.project,
-				**elementKwarg
+				publisher.cleanup()
+		writeTimingReport(blastOptions, timer, returncode, prefetch)
+	if sgCache:
+		print sgCache.stats()
+	if plateCache:
+		print plateCache.stats()
+	if publisher:
+		print publisher.stats()
+	return returncode
+
+def runBlast(blastOptions, timer, prefetch, resolver, encodePool, staging=None, publisher=None):
+	""" Run the stages of a blast, timing each of them.
+
+	Args:
+		blastOptions(argparse.Namespace) : Options brought from argument parser
+		timer(BlastTimer) : Collects the stage timings.
+		prefetch(BlastPrefetch) : The remote lookups started for the blast.
+		resolver(ShotgunResolver) : Resolver for the blast's shot.
+		encodePool(EncodePool) : Runs the encodes handed off by the renders.
+		staging(StagingArea) : Where intermediates may be staged.
+		publisher(OutputPublisher) : Uploads the outputs of a write-behind
+			blast as they are finished.
+
+	Returns:
+		int - The return code of the blast.
+
+	"""
+	print blastOptions.comp
+	# Retrieve the formats presets, failing before the comp is opened
+	try:
+		with timer.span("loadFormats"):
+			formatjson = blastprefs.loadFormats(blastOptions.formatsfile, blastOptions.formats)
+	except blastprefs.BlastPrefsException as e:
+		print e
+		return 1
+	with timer.span("openComp"):
+		openComp(blastOptions.comp)
+	# set the framerate to the project framerate
+	with timer.span("setFramerate"):
+		setFramerate(blastOptions.project, prefetch.get("framerate"))
+	# Resolve all the shot dependent shotgun data once for every format
+	with timer.span("shotgun"):
+		prefetch.get("shotgun")
+	with timer.span("colorSources"):
+		colorSources = getColorSources(blastOptions, resolver)
+	if prefetch.plateCache:
+		# Large plates take as long as they take to copy
+		with timer.span("plateCache"):
+			prefetch.get("plate", timeout=None)
+	snapshot = None
+	if not blastOptions.reopen:
+		with timer.span("snapshot"):
+			snapshot = GraphSnapshot.fromFormats(
+				[formatjson[formatname] for formatname in blastOptions.formats]
+			)
+	backupWriter = BackupWriter()
+	renderCache = None
+	# Farm tasks only produce part of the blast
+	if blastOptions.rendercache and not (blastOptions.renderonly or blastOptions.chunk):
+		renderCache = RenderCache()
+	fingerprint = None
+	if renderCache or blastOptions.incremental:
+		with timer.span("fingerprint"):
+			fingerprint = BlastFingerprint(blastOptions.args, resolver.resolve())
+	allJobs = []
+	for index, formatnames in enumerate(
+			groupFormats(formatjson, blastOptions.formats, blastOptions.multiformat)):
+		formatinfos = [formatjson[formatname] for formatname in formatnames]
+		# Revert the edits of the previous format
+		if snapshot and index:
+			with timer.span("restoreSnapshot", formats=formatnames):
+				snapshot.restore()
+		nodeoutNames = [formatinfo["nodes"][1] for formatinfo in formatinfos]
+		# The color can only be left to the encodes if every format of the
+		# pass encodes it, otherwise the graph applies it for all of them
+		encodeLUT = all(formatinfo.get("encode_lut") for formatinfo in formatinfos)
+		with timer.span("prepareGraph", formats=formatnames):
+			framein, frameout, increment = prepareGraph(
+				blastOptions,
+				formatinfos[0],
+				resolver,
+				nodeoutNames,
+				prefetch.plateCache,
+				colorSources,
+				encodeLUT
 			)
-			fileSequencePath = outputfilepath.replace(
-				"####",
-				"{0}-{1}".format(
-					str(framein).zfill(4),
-					str(frameout).zfill(4)
+		with timer.span("prepareOutput", formats=formatnames):
+			jobs = [
+				prepareOutput(
+					blastOptions,
+					formatname,
+					formatinfo,
+					resolver,
+					framein,
+					frameout,
+					increment,
+					staging,
+					colorSources if encodeLUT else None
 				)
+				for formatname, formatinfo in zip(formatnames, formatinfos)
+			]
+		for job in jobs:
+			job["backupDir"] = prefetch.get("backupDir")
+		allJobs.extend(jobs)
+		if renderCache:
+			with timer.span("renderCacheFetch", formats=formatnames):
+				remaining = reuseCachedJobs(blastOptions, jobs, renderCache, fingerprint)
+			if publisher:
+				for job in jobs:
+					if job not in remaining:
+						publishJob(blastOptions, job, publisher)
+			jobs = remaining
+			if not jobs:
+				continue
+		frames = None
+		if blastOptions.incremental:
+			with timer.span("changedFrames", formats=formatnames):
+				frames = getChangedFrames(blastOptions, jobs, fingerprint)
+			if frames == []:
+				print "No frames changed for {0}".format(", ".join(formatnames))
+				# Only encode the movies that went missing
+				for job in jobs:
+					if (needsEncode(blastOptions, job["formatinfo"]) and
+							not os.path.exists(getJobOutputs(blastOptions, job)[0])):
+						encodePool.submit(job["name"], completeJob, blastOptions, job, None, renderCache, publisher)
+				continue
+		if blastOptions.chunk:
+			frames = getChunkFrames(blastOptions.chunk, frames or getJobFrames(jobs[0]))
+			if not frames:
+				print "Chunk {0} has no frames to render".format(blastOptions.chunk)
+				if blastOptions.renderonly:
+					for job in jobs:
+						if (needsEncode(blastOptions, job["formatinfo"]) and
+								not finishRenderOnlyJob(blastOptions, job)):
+							encodePool.errors.append("Encode of {0} failed".format(job["name"]))
+				continue
+		with timer.span("removeOutputs", formats=formatnames):
+			for job in jobs:
+				removeJobOutputs(blastOptions, job, frames)
+		with timer.span("saveScript", formats=formatnames, reopen=blastOptions.reopen):
+			shotScriptPath = getBlastBackupNukePath(
+				blastOptions,
+				"_".join(formatnames),
+				prefetch.get("backupDir"),
+				prefetch.get("usertag")
+			)
+			renderScriptPath = shotScriptPath
+			if blastOptions.reopen:
+				# Some comps only evaluate correctly from a freshly opened script
+				print "Saving the script"
+				nuke.scriptSave(shotScriptPath)
+				print "Closing the script"
+				nuke.scriptClose()
+				print "Reopening the script"
+				nuke.scriptOpen(shotScriptPath)
+			else:
+				print "Saving the script"
+				renderScriptPath = backupWriter.save(shotScriptPath)
+		renderFrameCount = len(frames if frames is not None else getJobFrames(jobs[0]))
+		# A farm chunk is already one of the format's render_chunks
+		localChunks = 1 if blastOptions.chunk else None
+		if blastOptions.renderonly:
+			with timer.span("render", formats=formatnames, frames=renderFrameCount):
+				renderJobs(jobs, renderScriptPath, frames, localChunks)
+			for job in jobs:
+				if (needsEncode(blastOptions, job["formatinfo"]) and
+						not finishRenderOnlyJob(blastOptions, job)):
+					encodePool.errors.append("Encode of {0} failed".format(job["name"]))
+			continue
+		if all(canStreamJob(blastOptions, job) for job in jobs):
+			try:
+				with timer.span("render", formats=formatnames, frames=renderFrameCount, stream=True):
+					streamJobs(jobs)
+			except EncodeError as e:
+				encodePool.errors.append(str(e))
+			else:
+				for job in jobs:
+					if renderCache:
+						renderCache.store(
+							job["fingerprint"],
+							getJobOutputs(blastOptions, job),
+							blastOptions.output
+						)
+					if publisher:
+						publishJob(blastOptions, job, publisher)
+			continue
+		# Start following the sequences before the first frame lands
+		followers = {}
+		for job in jobs:
+			if canOverlapJob(blastOptions, job):
+				followers[job["name"]] = SequenceFollower(job)
+				followers[job["name"]].start()
+		# Upload the frames that are not encoded while the rest render
+		publishFollowers = []
+		if publisher:
+			for job in jobs:
+				if job["name"] not in followers and canPublishFollowJob(blastOptions, job):
+					publishFollowers.append(SequencePublisher(job, publisher))
+					publishFollowers[-1].start()
+		try:
+			with timer.span("render", formats=formatnames, frames=renderFrameCount):
+				renderJobs(jobs, renderScriptPath, frames, localChunks)
+		finally:
+			for follower in followers.itervalues():
+				follower.renderDone.set()
+			# Whatever they missed is published with the rest of the job
+			for follower in publishFollowers:
+				follower.finish()
+		for job in jobs:
+			if job.get("manifest"):
+				job["manifest"].update(job["frameDigests"], frames)
+				job["manifest"].save()
+		# Hand the encodes off so the next format can start rendering
+		for job in jobs:
+			encodePool.submit(
+				job["name"],
+				completeJob,
+				blastOptions,
+				job,
+				followers.get(job["name"]),
+				renderCache,
+				publisher
 			)
-			# Delete the review image file sequence
-			fileSequence = FileSequence(fileSequencePath)
-			fileSequence.delete()
-			# ffmpegCmd = fileSequence.generateMovie(fps=23.976, videoCodec=VideoCodec(formatinfo['codec']))
-		# print ffmpegCmd
 
 	# nuke.scriptSave(blastOptions.comp)
 	# TODO Create a backup in a specific shot folder
-	nuke.scriptSave("C:/temp/blast_backup.nk")
-	sys.exit(0)
+	with timer.span("finalSave"):
+		nuke.scriptSave("C:/temp/blast_backup.nk")
+	with timer.span("encodeWait"):
+		encodeErrors = encodePool.wait()
+	with timer.span("backupWait"):
+		backupWriter.wait()
+	if encodeErrors:
+		print "{0} encode(s) failed:".format(len(encodeErrors))
+		for error in encodeErrors:
+			print error
+		return 1
+	if renderCache and not blastOptions.renderonly and not blastOptions.chunk:
+		# Point the whole blast at the format entries so a resubmit can skip
+		# launching Nuke
+		with timer.span("renderCacheStore"):
+			renderCache.storeEntries(fingerprint.getDigest(), [job["fingerprint"] for job in allJobs])
+	return 0
+
+class TeeStream(object):
+	""" Writes to a stream while keeping its last lines for the job result,
+	like processlog does for the processes it runs.
+	"""
+	def __init__(self, stream, tailLines=processlog.TAIL_LINES):
+		self.stream = stream
+		self.lines = collections.deque(maxlen=tailLines)
+		self.pending = ""
+
+	def write(self, text):
+		self.stream.write(text)
+		lines = processlog.LINE_END_REGEX.split(self.pending + text)
+		self.pending = lines.pop()
+		self.lines.extend(lines)
+
+	def flush(self):
+		self.stream.flush()
+
+	def getvalue(self):
+		return "\n".join(list(self.lines) + ([self.pending] if self.pending else []))
+
+def runJob(args):
+	""" Run a single worker job in a clean script.
+
+	Args:
+		args(list) : The run.py command line arguments for the blast.
+
+	Returns:
+		tuple - (returncode, output, error)
+
+	"""
+	# Json hands back unicode, the blast expects the same str args as the cli
+	args = [arg.encode("utf-8") if isinstance(arg, unicode) else arg for arg in args]
+	stdout, stderr = sys.stdout, sys.stderr
+	sys.stdout = TeeStream(stdout)
+	sys.stderr = TeeStream(stderr)
+	returncode = 1
+	try:
+		returncode = blast(parseArgs(args))
+	except SystemExit as e:
+		returncode = e.code if isinstance(e.code, int) else 1
+	except Exception:
+		traceback.print_exc()
+	finally:
+		output = sys.stdout.getvalue()
+		error = sys.stderr.getvalue()
+		sys.stdout, sys.stderr = stdout, stderr
+		# Leave nothing behind for the next job
+		nuke.scriptClear()
+	return (returncode, output, error)
+
+def prefetchBatch(batchArgs):
+	""" Resolve the Shotgun data of every shot in a batch with one query
+	per project, ahead of the blasts.
+	"""
+	shotsByProject = {}
+	for args in batchArgs:
+		try:
+			blastOptions = parseArgs(args)
+		except SystemExit:
+			# Reported when the blast itself runs
+			continue
+		if blastOptions.nosgcache or not blastOptions.project:
+			continue
+		shotsByProject.setdefault(blastOptions.project, []).append(blastOptions.shot)
+	if not shotsByProject:
+		return
+	sgCache = ShotgunCache()
+	for project, shots in shotsByProject.iteritems():
+		try:
+			ShotgunResolver.prefetch(project, shots, sgCache)
+		except Exception:
+			# Every blast still resolves its own shot if this fails
+			traceback.print_exc()
+
+def runBatch(batchFile):
+	""" Blast every shot of a batch file in this Nuke process.
+
+	Args:
+		batchFile(str) : Json file with a "blasts" list of run.py argument
+			lists.
+
+	Returns:
+		int - 0 if every shot blasted, 1 otherwise.
+
+	"""
+	with open(batchFile, "r") as fileinfo:
+		batchArgs = [
+			[arg.encode("utf-8") if isinstance(arg, unicode) else arg for arg in args]
+			for args in json.loads(fileinfo.read())["blasts"]
+		]
+	prefetchBatch(batchArgs)
+	failures = []
+	for index, args in enumerate(batchArgs):
+		print "Blasting {0} of {1}: {2}".format(index + 1, len(batchArgs), " ".join(args))
+		# Already echoed as the blast ran
+		returncode, output, error = runJob(args)
+		if returncode != 0:
+			failures.append(" ".join(args))
+	print "Batch finished: {0} succeeded, {1} failed".format(
+		len(batchArgs) - len(failures),
+		len(failures)
+	)
+	for failure in failures:
+		sys.stderr.write("Blast failed: {0}\n".format(failure))
+	return 1 if failures else 0
+
+def measureStartup():
+	""" Print how long run.py took to load and how long each of the packages
+	it imports on demand takes, without running a blast.
+
+	Returns:
+		int - The return code.
+
+	"""
+	print "run.py loaded in {0:.3f}s".format(IMPORT_FINISHED - IMPORT_STARTED)
+	for name in LAZY_IMPORTS:
+		start = time.time()
+		try:
+			__import__(name)
+		except ImportError as e:
+			print "{0} failed to import: {1}".format(name, e)
+			continue
+		print "{0} imported in {1:.3f}s".format(name, time.time() - start)
+	return 0
+
+def main():
+	if "--startuptime" in sys.argv:
+		sys.exit(measureStartup())
+	if "--worker" in sys.argv:
+		blastworker.serve(runJob)
+		return
+	if "--encodejob" in sys.argv:
+		sys.exit(runEncodeJob(sys.argv[sys.argv.index("--encodejob") + 1]))
+	if "--batch" in sys.argv:
+		sys.exit(runBatch(sys.argv[sys.argv.index("--batch") + 1]))
+	sys.exit(blast(parseArgs()))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,142 @@
+# =============================================================================
+# Blast - Sequence index
+# Indexes an image sequence on disk in a single directory pass, so a blast
+# can check its input is complete before Nuke is launched.
+# =============================================================================
+import os
+import re
+
+try:
+	from os import scandir
+except ImportError as e:
+	try:
+		from scandir import scandir
+	except ImportError as e:
+		scandir = None
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+FRAME_TOKEN = "####"
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def getFrameRegex(basename):
+	""" Returns a regex matching the file names of a #### pattern, with the
+	frame number as its only group.
+	"""
+	prefix, suffix = basename.split(FRAME_TOKEN, 1)
+	return re.compile("^" + re.escape(prefix) + r"(-?\d+)" + re.escape(suffix) + "$")
+
+def listFiles(directory):
+	""" Yields the name and size of every file in the directory.  Uses
+	scandir when available, which gets the sizes along with the listing on
+	Windows.
+	"""
+	if scandir is not None:
+		for entry in scandir(directory):
+			try:
+				yield entry.name, entry.stat().st_size
+			except OSError:
+				continue
+		return
+	for name in os.listdir(directory):
+		try:
+			yield name, os.path.getsize(os.path.join(directory, name))
+		except OSError:
+			continue
+
+def collapseFrames(frames):
+	""" Returns the sorted frames as a "1001-1010, 1012" string. """
+	ranges = []
+	for frame in sorted(frames):
+		if ranges and ranges[-1][1] + 1 == frame:
+			ranges[-1][1] = frame
+		else:
+			ranges.append([frame, frame])
+	return ", ".join(
+		str(first) if first == last else "{0}-{1}".format(first, last)
+		for first, last in ranges
+	)
+
+def indexSequence(pattern, minBytes=1):
+	""" Index the frames of a #### file pattern.
+
+	Args:
+		pattern(str) : The sequence, such as /plates/A_0010.####.exr
+		minBytes(int) : Frames smaller than this are reported as truncated.
+
+	Returns:
+		SequenceIndex - The index, or None if the pattern is not a sequence.
+
+	"""
+	directory, basename = os.path.split(pattern)
+	if FRAME_TOKEN not in basename:
+		return None
+	regex = getFrameRegex(basename)
+	sizes = {}
+	try:
+		for name, size in listFiles(directory or "."):
+			match = regex.match(name)
+			if match:
+				sizes[int(match.group(1))] = size
+	except OSError:
+		pass
+	return SequenceIndex(pattern, sizes, minBytes)
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+class SequenceIndex(object):
+	""" The frames of a sequence found on disk.
+
+	Args:
+		pattern(str) : The #### file pattern that was indexed.
+		sizes(dict) : Mapping of frame number to file size.
+		minBytes(int) : Frames smaller than this are reported as truncated.
+
+	"""
+	def __init__(self, pattern, sizes, minBytes=1):
+		self.pattern = pattern
+		self.sizes = sizes
+		self.frames = sorted(sizes)
+		self.truncated = [frame for frame in self.frames if sizes[frame] < minBytes]
+
+	@property
+	def first(self):
+		return self.frames[0] if self.frames else None
+
+	@property
+	def last(self):
+		return self.frames[-1] if self.frames else None
+
+	def getMissing(self, first=None, last=None):
+		""" Returns the frames missing between first and last, which default
+		to the range found on disk.
+		"""
+		if not self.frames:
+			return []
+		first = self.first if first is None else first
+		last = self.last if last is None else last
+		return [frame for frame in range(first, last + 1) if frame not in self.sizes]
+
+	def getProblems(self, first=None, last=None):
+		""" Describe every missing or truncated frame within the range.
+
+		Returns:
+			list - Messages, empty if the sequence is complete.
+
+		"""
+		if not self.frames:
+			return ["No frames found for {0}".format(self.pattern)]
+		first = self.first if first is None else first
+		last = self.last if last is None else last
+		problems = []
+		missing = self.getMissing(first, last)
+		if missing:
+			problems.append("Missing frames {0} of {1}".format(collapseFrames(missing), self.pattern))
+		truncated = [frame for frame in self.truncated if first <= frame <= last]
+		if truncated:
+			problems.append("Truncated frames {0} of {1}".format(collapseFrames(truncated), self.pattern))
+		return problems
@@ -0,0 +1,146 @@
+# =============================================================================
+# Blast - Shotgun metadata cache
+# Local sqlite store of resolved shot data, shared by every blast running on
+# the same machine.
+# =============================================================================
+from datetime import datetime
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+from fileutils import makeDirs
+
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+# Seconds a cached entry is trusted without asking Shotgun whether it changed.
+DEFAULT_TTL = int(os.environ.get("BLAST_SG_CACHE_TTL", 3600))
+
+SHOT_KEY = "__shot__"
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def getCacheDir():
+	""" Returns the local directory the blast caches are stored in. """
+	cacheDir = os.environ.get(
+		"BLAST_CACHE_DIR",
+		os.path.join(tempfile.gettempdir(), "BlastCache")
+	)
+	makeDirs(cacheDir)
+	return cacheDir
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+class ShotgunCache(object):
+	""" Caches resolved Shotgun records keyed by project, shot and version type.
+
+	Entries younger than the ttl are used without touching the network.  Once
+	they are older, the resolver asks Shotgun whether anything on the shot was
+	updated since the entry was cached and only refetches if it was.
+
+	Args:
+		path(str) : Location of the sqlite file.  Defaults to the blast cache dir.
+		ttl(int) : Seconds an entry is used without revalidating.
+
+	"""
+	def __init__(self, path=None, ttl=DEFAULT_TTL):
+		self.path = path or os.path.join(getCacheDir(), "shotgun.sqlite")
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.revalidations = 0
+		self._connection = None
+
+	@property
+	def connection(self):
+		if self._connection is None:
+			# Several blasts can share the file, so wait on locks instead of
+			# failing.  The blast resolves on a prefetch thread and then only
+			# reads the results, so the connection is never used concurrently.
+			self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+			self._connection.execute(
+				"CREATE TABLE IF NOT EXISTS versions ("
+				"project TEXT, shot TEXT, version_type TEXT, data TEXT, cached_at REAL, "
+				"PRIMARY KEY (project, shot, version_type))"
+			)
+			self._connection.commit()
+		return self._connection
+
+	def load(self, project, shot, keys):
+		""" Load every cached entry for the shot.
+
+		Args:
+			project(str) : Name of the project.
+			shot(str) : Code of the shot.
+			keys(list) : Version type keys that must be present.
+
+		Returns:
+			tuple - (sgShot, versions, cachedAt) or None if any key is missing.
+			cachedAt is the epoch time the oldest entry was cached.
+
+		"""
+		rows = self.connection.execute(
+			"SELECT version_type, data, cached_at FROM versions WHERE project=? AND shot=?",
+			(project, shot)
+		).fetchall()
+		entries = dict((row[0], (json.loads(row[1]), row[2])) for row in rows)
+		if SHOT_KEY not in entries or any(key not in entries for key in keys):
+			return None
+		cachedAt = min(entries[key][1] for key in keys + [SHOT_KEY])
+		sgShot = entries.pop(SHOT_KEY)[0]
+		versions = dict(
+			(key, value[0]) for key, value in entries.iteritems()
+			if key in keys and value[0] is not None
+		)
+		return (sgShot, versions, cachedAt)
+
+	def isFresh(self, cachedAt):
+		""" Returns True if an entry cached at cachedAt is still within the ttl. """
+		return (time.time() - cachedAt) < self.ttl
+
+	def store(self, project, shot, sgShot, versions, keys):
+		""" Store the resolved shot and versions.  Missing version types are
+		stored as well so a shot without audio does not query every time.
+		"""
+		now = time.time()
+		rows = [(project, shot, SHOT_KEY, json.dumps(sgShot), now)]
+		for key in keys:
+			rows.append((project, shot, key, json.dumps(versions.get(key)), now))
+		self.connection.executemany(
+			"INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, ?)",
+			rows
+		)
+		self.connection.commit()
+
+	def touch(self, project, shot):
+		""" Mark every entry for the shot as freshly validated. """
+		self.connection.execute(
+			"UPDATE versions SET cached_at=? WHERE project=? AND shot=?",
+			(time.time(), project, shot)
+		)
+		self.connection.commit()
+
+	def invalidate(self, project, shot):
+		""" Drop every entry for the shot. """
+		self.connection.execute(
+			"DELETE FROM versions WHERE project=? AND shot=?",
+			(project, shot)
+		)
+		self.connection.commit()
+
+	@staticmethod
+	def since(cachedAt):
+		""" Returns cachedAt as a datetime suitable for a Shotgun filter. """
+		return datetime.fromtimestamp(cachedAt)
+
+	def stats(self):
+		""" Returns a one line summary of the cache usage for this run. """
+		return "Shotgun cache: {0} hits, {1} misses, {2} revalidated".format(
+			self.hits,
+			self.misses,
+			self.revalidations,
+		)
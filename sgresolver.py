@@ -0,0 +1,282 @@
+# =============================================================================
+# Blast - Shotgun resolver
+# Resolves every shot dependent Shotgun record a blast needs in as few
+# round-trips as possible.
+# =============================================================================
+# =============================================================================
+# CONSTANTS
+# =============================================================================
+# Every Version type a blast can ask for.  The filters are applied on top of
+# the shot entity filter, and the newest version number wins.
+VERSION_TYPES = {
+	"audio" : [
+		['sg_version_type', 'is', 'Audio'],
+	],
+	"stmap_distorted" : [
+		['sg_version_type', 'is', 'ST Map'],
+		['sg_variation', 'is', 'Distorted'],
+	],
+	"stmap_undistorted" : [
+		['sg_version_type', 'is', 'ST Map'],
+		['sg_variation', 'is', 'Undistorted'],
+	],
+	"postmove" : [
+		['sg_version_type', 'is', 'Composition'],
+		['sg_variation', 'is', 'Postmove'],
+		['sg_status_list', 'is', 'apr'],
+	],
+	"cdl" : [
+		['sg_version_type', 'is', 'cdl'],
+		['sg_status_list', 'is', 'apr'],
+	],
+	"3dl" : [
+		['sg_version_type', 'is', '3dl'],
+		['sg_variation', 'is', '3DL'],
+	],
+	"flat_plate" : [
+		['sg_version_type', 'is', 'Flat Plate'],
+	],
+}
+
+VERSION_FIELDS = [
+	'sg_path_to_movie',
+	'sg_path_to_frames',
+	'sg_version_type',
+	'sg_variation',
+	'sg_status_list',
+	'sg_version_number',
+]
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def connect():
+	""" Returns a new Shotgun connection, or None if blursg is unavailable.
+	blursg is only imported once a blast needs Shotgun.
+	"""
+	try:
+		import blursg
+	except ImportError as e:
+		return None
+	return blursg.sg()
+
+def getVersionTypesFilter():
+	""" Returns a filter matching a Version of any of the version types. """
+	return {
+		"filter_operator" : "any",
+		"filters" : [
+			{"filter_operator" : "all", "filters" : filters}
+			for filters in VERSION_TYPES.itervalues()
+		],
+	}
+
+def isFieldMatch(value, expected):
+	""" Returns True if a Version field matches the value of an is filter.
+	Shotgun compares text case-insensitively, so this does too.
+	"""
+	if isinstance(value, basestring) and isinstance(expected, basestring):
+		return value.lower() == expected.lower()
+	return value == expected
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+class ShotgunResolver(object):
+	""" Resolves the Project, Shot and every Version type a blast needs once.
+
+	The Shot is looked up through its project name in a single query and all
+	of the Version types are fetched in one batched query.  Helpers then read
+	the results with `version` instead of talking to Shotgun themselves.
+
+	Args:
+		project(str) : Name of the project to resolve.
+		shot(str) : Code of the shot to resolve.
+		sg(Shotgun) : Optional connection to reuse.  One is created otherwise.
+		cache(ShotgunCache) : Optional local cache consulted before Shotgun.
+
+	"""
+	def __init__(self, project, shot, sg=None, cache=None):
+		self.project = project
+		self.shot = shot
+		self.cache = cache
+		self._sg = sg
+		self._sgShot = None
+		self._versions = None
+
+	@property
+	def sg(self):
+		""" The Shotgun connection, created on first use. """
+		if self._sg is None:
+			self._sg = connect()
+		return self._sg
+
+	@property
+	def sgShot(self):
+		""" The Shotgun Shot entity, or None if it could not be found. """
+		self.resolve()
+		return self._sgShot
+
+	def resolve(self):
+		""" Run the Shot and Version queries if they have not run yet.
+
+		Returns:
+			dict - Mapping of version type key to the newest matching Version.
+
+		"""
+		if self._versions is not None:
+			return self._versions
+		self._versions = {}
+		if not self.project or not self.shot:
+			return self._versions
+		if self.cache is not None and self.resolveFromCache():
+			return self._versions
+		if self.sg is None:
+			return self._versions
+		self.query()
+		if self.cache is not None and self._sgShot:
+			self.cache.misses += len(VERSION_TYPES)
+			self.cache.store(
+				self.project,
+				self.shot,
+				self._sgShot,
+				self._versions,
+				VERSION_TYPES.keys()
+			)
+		return self._versions
+
+	def resolveFromCache(self):
+		""" Use the cached entries for the shot if they are still valid.
+
+		Returns:
+			bool - True if the cache satisfied the lookup.
+
+		"""
+		keys = VERSION_TYPES.keys()
+		cached = self.cache.load(self.project, self.shot, keys)
+		if cached is None:
+			return False
+		sgShot, versions, cachedAt = cached
+		if not self.cache.isFresh(cachedAt):
+			if self.sg is None or self.hasUpdatesSince(sgShot, self.cache.since(cachedAt)):
+				return False
+			self.cache.touch(self.project, self.shot)
+			self.cache.revalidations += len(keys)
+		self.cache.hits += len(keys)
+		self._sgShot = sgShot
+		self._versions = versions
+		return True
+
+	def hasUpdatesSince(self, sgShot, since):
+		""" Returns True if the shot or any of its versions changed after since. """
+		shotUpdate = self.sg.find_one(
+			"Shot",
+			[["id", "is", sgShot["id"]], ["updated_at", "greater_than", since]],
+		)
+		if shotUpdate:
+			return True
+		versionUpdate = self.sg.find_one(
+			"Version",
+			[["entity", "is", sgShot], ["updated_at", "greater_than", since]],
+		)
+		return bool(versionUpdate)
+
+	def query(self):
+		""" Query Shotgun for the shot and every version type. """
+		self._sgShot = self.sg.find_one(
+			"Shot",
+			[
+				["project.Project.name", "is", self.project],
+				["code", "is", self.shot]
+			],
+		)
+		if not self._sgShot:
+			return
+		versions = self.sg.find(
+			"Version",
+			[['entity', 'is', self._sgShot], getVersionTypesFilter()],
+			VERSION_FIELDS,
+			[{'field_name': 'sg_version_number', 'direction' : 'desc'}]
+		)
+		self._versions = self.matchVersions(versions)
+
+	@classmethod
+	def prefetch(cls, project, shots, cache, sg=None):
+		""" Resolve many shots of a project with a single Shot query and a
+		single Version query, and store them in the cache so the resolvers
+		created for each shot afterwards never go to Shotgun.
+
+		Shots that already have fresh cache entries are skipped.
+
+		Args:
+			project(str) : Name of the project.
+			shots(list) : Codes of the shots to resolve.
+			cache(ShotgunCache) : The cache to fill.
+			sg(Shotgun) : Optional connection to reuse.
+
+		"""
+		keys = VERSION_TYPES.keys()
+		missing = []
+		for shot in set(shots):
+			if not shot:
+				continue
+			cached = cache.load(project, shot, keys)
+			if cached is None or not cache.isFresh(cached[2]):
+				missing.append(shot)
+		if not project or not missing:
+			return
+		if sg is None:
+			sg = connect()
+			if sg is None:
+				return
+		sgShots = sg.find(
+			"Shot",
+			[["project.Project.name", "is", project], ["code", "in", missing]],
+			["code"]
+		)
+		if not sgShots:
+			return
+		versions = sg.find(
+			"Version",
+			[['entity', 'in', sgShots], getVersionTypesFilter()],
+			VERSION_FIELDS + ['entity'],
+			[{'field_name': 'sg_version_number', 'direction' : 'desc'}]
+		)
+		versionsByShot = {}
+		for version in versions:
+			# Cache the same fields query() does, the render cache
+			# fingerprints them
+			versionsByShot.setdefault(version.pop('entity')['id'], []).append(version)
+		for sgShot in sgShots:
+			cache.store(
+				project,
+				sgShot["code"],
+				{"type" : sgShot["type"], "id" : sgShot["id"]},
+				cls.matchVersions(versionsByShot.get(sgShot["id"], [])),
+				keys
+			)
+
+	@staticmethod
+	def matchVersions(versions):
+		""" Pick the newest Version for each version type key.
+
+		Args:
+			versions(list) : Versions sorted by descending version number.
+
+		Returns:
+			dict - Mapping of version type key to Version.
+
+		"""
+		matched = {}
+		for version in versions:
+			for key, filters in VERSION_TYPES.iteritems():
+				if key in matched:
+					continue
+				if all(isFieldMatch(version.get(field), value) for field, _, value in filters):
+					matched[key] = version
+		return matched
+
+	def version(self, key):
+		""" Returns the newest Version for the version type key, or None. """
+		if key not in VERSION_TYPES:
+			raise KeyError("Unknown version type: {0}".format(key))
+		return self.resolve().get(key)